@@ -14,5 +14,98 @@ DATE_NOW = datetime.now().isoformat()[0:10]  # YYYY-MM-DD
 DIST_DIR = f"dist/" + DATE_NOW
 DECP_PROCESSING_PUBLISH = os.getenv("DECP_PROCESSING_PUBLISH")
 
+# Ne traiter que les fichiers source qui ont changé depuis le précédent traitement
+DECP_PROCESSING_INCREMENTAL = (
+    os.getenv("DECP_PROCESSING_INCREMENTAL", "False").lower() == "true"
+)
+DECP_MANIFEST_PATH = os.getenv("DECP_MANIFEST_PATH", "dist/manifest.json")
+
+# Schéma des DECP sources : noms, noms aplatis et types des champs
+DECP_SOURCE_SCHEMA_PATH = os.getenv(
+    "DECP_SOURCE_SCHEMA_PATH", "data/schema_source_decp_2022.json"
+)
+
+# TableSchema des DECP tabulaires : copie locale et source de sa mise à jour
+DECP_TABLESCHEMA_PATH = os.getenv("DECP_TABLESCHEMA_PATH", "data/tableschema_decp.json")
+DECP_TABLESCHEMA_URL = os.getenv(
+    "DECP_TABLESCHEMA_URL",
+    "https://raw.githubusercontent.com/ColinMaudry/decp-table-schema/refs/heads/main/schema.json",
+)
+DECP_TABLESCHEMA_REFRESH = (
+    os.getenv("DECP_TABLESCHEMA_REFRESH", "False").lower() == "true"
+)
+
+# Règles de normalisation des dates (formats, corrections d'années, période plausible)
+DECP_DATE_RULES_PATH = os.getenv("DECP_DATE_RULES_PATH", "data/date_rules.json")
+
+# Nombre de marchés lus à la fois dans les fichiers JSON (mémoire bornée)
+DECP_JSON_BATCH_SIZE = int(os.getenv("DECP_JSON_BATCH_SIZE", 10000))
+
+# Nombre de fichiers source normalisés et nettoyés en parallèle (processus)
+DECP_PROCESSING_WORKERS = int(os.getenv("DECP_PROCESSING_WORKERS", 1))
+
+# Fichiers Parquet triés, avec statistiques et index de pages, et en option un jeu
+# de données partitionné par année de notification
+DECP_PARQUET_OPTIMIZED = os.getenv("DECP_PARQUET_OPTIMIZED", "True").lower() == "true"
+DECP_PARQUET_PARTITION_BY_YEAR = (
+    os.getenv("DECP_PARQUET_PARTITION_BY_YEAR", "False").lower() == "true"
+)
+
+# Formats CSV compressés écrits en plus des CSV (csv.gz, csv.zst), et découpage
+# optionnel des CSV par année de notification
+DECP_CSV_COMPRESSED_FORMATS = [
+    file_format.strip()
+    for file_format in os.getenv("DECP_CSV_COMPRESSED_FORMATS", "csv.gz").split(",")
+    if file_format.strip()
+]
+DECP_CSV_SPLIT_BY_YEAR = os.getenv("DECP_CSV_SPLIT_BY_YEAR", "False").lower() == "true"
+
+# Index de recherche plein texte (FTS5) sur l'objet des marchés dans datalab.sqlite
+DECP_SQLITE_FTS = os.getenv("DECP_SQLITE_FTS", "True").lower() == "true"
+
+# Clés entières dans les tables normalisées de datalab.sqlite, et correspondance
+# avec les clés naturelles conservée d'un traitement à l'autre
+DECP_SQLITE_SURROGATE_KEYS = (
+    os.getenv("DECP_SQLITE_SURROGATE_KEYS", "False").lower() == "true"
+)
+DECP_SURROGATE_KEYS_DIR = os.getenv("DECP_SURROGATE_KEYS_DIR", "dist/surrogate_keys")
+
+# Nombre de tranches de lignes de decp.parquet validées en parallèle avec le
+# TableSchema
+DECP_VALIDATION_SHARDS = int(os.getenv("DECP_VALIDATION_SHARDS", 1))
+
+# Vérifier que les lignes d'un même marché ne diffèrent que par le titulaire lors
+# de la création de decp-sans-titulaires
+DECP_CHECK_SANS_TITULAIRES = (
+    os.getenv("DECP_CHECK_SANS_TITULAIRES", "False").lower() == "true"
+)
+
+# Enrichissement des DECP avec les fichiers stock SIRENE (CSV) : noms des
+# acheteurs, données des titulaires (decp-titulaires)
+DECP_ENRICH_SIRENE = os.getenv("DECP_ENRICH_SIRENE", "False").lower() == "true"
+SIRENE_ETABLISSEMENTS_PATH = os.getenv("SIRENE_ETABLISSEMENTS_PATH")
+SIRENE_UNITES_LEGALES_PATH = os.getenv("SIRENE_UNITES_LEGALES_PATH")
+
+# Copie locale des stocks SIRENE en Parquet trié, refaite à chaque nouveau stock
+DECP_SIRENE_STORE_DIR = os.getenv("DECP_SIRENE_STORE_DIR", "data/sirene")
+
+# Index des clés (uid + titulaire) de toutes les lignes fusionnées, conservé d'un
+# traitement à l'autre pour le dédoublonnage
+DECP_UID_INDEX_PATH = os.getenv("DECP_UID_INDEX_PATH", "dist/uid_index.parquet")
+
+# Normalisation et nettoyage de chaque source en un seul plan Polars, sans
+# écrire les fichiers intermédiaires get/ (sauf en mode debug)
+DECP_PROCESSING_FUSED = os.getenv("DECP_PROCESSING_FUSED", "True").lower() == "true"
+DECP_PROCESSING_DEBUG = os.getenv("DECP_PROCESSING_DEBUG", "False").lower() == "true"
+
+# Nombre maximum de téléchargements simultanés depuis data.gouv.fr
+DECP_DOWNLOAD_CONCURRENCY = int(os.getenv("DECP_DOWNLOAD_CONCURRENCY", 4))
+
+# Cache des fichiers téléchargés et taille maximale (en Mo) avant éviction
+DECP_CACHE_DIR = os.getenv("DECP_CACHE_DIR", "data/cache")
+DECP_CACHE_MAX_SIZE = int(os.getenv("DECP_CACHE_MAX_SIZE", 10000)) * 1024 * 1024
+
+DATAGOUVFR_API = os.getenv("DATAGOUVFR_API", "https://www.data.gouv.fr/api/1")
+
 with open(os.environ["DECP_JSON_FILES_PATH"]) as f:
     DECP_JSON_FILES = json.load(f)
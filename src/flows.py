@@ -1,64 +1,135 @@
 import os.path
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from prefect import flow, task
 import polars as pl
 
 from tasks.get import get_decp_json
-from tasks.clean import clean_decp_json
+from tasks.clean import get_clean_decp_json
 from tasks.transform import (
     merge_decp_json,
-    normalize_tables,
+    make_normalized_tables,
+    save_normalized_tables,
     setup_tableschema_columns,
     make_decp_sans_titulaires,
+    extract_unique_acheteurs_siret,
+    extract_unique_titulaires_siret,
+    make_acheteur_nom,
+    improve_titulaire_unite_legale_data,
+    rename_titulaire_sirene_columns,
 )
 from tasks.output import (
     save_to_files,
     save_to_sqlite,
+    open_sqlite_database,
     make_data_package,
 )
+from tasks.enrich import (
+    add_etablissement_data_to_acheteurs,
+    add_unite_legale_data_to_acheteurs,
+    add_etablissement_data_to_titulaires,
+    add_unite_legale_data_to_titulaires,
+    merge_sirets_acheteurs,
+    merge_sirets_titulaires,
+)
+from tasks.sirene import update_sirene_store
+from tasks.manifest import load_manifest, save_manifest, pipeline_fingerprint
 from tasks.publish import publish_to_datagouv
+from tasks.nested import make_nested_tables, save_nested_tables
+from tasks.tableschema import get_tableschema
 from tasks.test import validate_decp_against_tableschema
-from config import DECP_PROCESSING_PUBLISH, DIST_DIR
+from config import (
+    DECP_PROCESSING_PUBLISH,
+    DECP_PROCESSING_INCREMENTAL,
+    DECP_ENRICH_SIRENE,
+    DIST_DIR,
+)
+
+# Cache global des chaînes des colonnes Categorical : les fichiers de chaque source
+# partagent les mêmes codes, leur fusion (pl.concat) n'a pas à réencoder les valeurs
+pl.enable_string_cache()
 
 
 @task(log_prints=True)
 def get_clean_merge():
-    if os.path.exists(DIST_DIR):
-        shutil.rmtree(DIST_DIR)
-    os.mkdir(DIST_DIR)
+    """Récupération, nettoyage et fusion des sources, écriture des fichiers decp.*
+
+    Mémoire : chaque source est traitée seule (clean/), la fusion ne garde en
+    mémoire que l'index des clés (tasks.uid_index) et écrit les lignes retenues en
+    streaming (merge/), et les fichiers decp.* sont écrits en streaming à partir de
+    decp.parquet (cf. save_to_files), sauf avec DECP_ENRICH_SIRENE : ils sont alors
+    écrits une seule fois, par enrich_from_sirene. Les DECP fusionnées ne sont
+    chargées qu'une fois, à la fin, pour les flows suivants.
+    """
+    if DECP_PROCESSING_INCREMENTAL:
+        # Les fichiers des sources inchangées peuvent être dans DIST_DIR
+        os.makedirs(DIST_DIR, exist_ok=True)
+        manifest = load_manifest()
+    else:
+        if os.path.exists(DIST_DIR):
+            shutil.rmtree(DIST_DIR)
+        os.mkdir(DIST_DIR)
+        manifest = {"pipeline": pipeline_fingerprint(), "sources": {}}
 
     print("Récupération des données source...")
-    files = get_decp_json()
+    sources = get_decp_json(manifest)
 
-    print("Nettoyage des données source et typage des colonnes...")
-    files = clean_decp_json(files)
+    print("Normalisation, nettoyage des données source et typage des colonnes...")
+    files = get_clean_decp_json(sources, manifest)
+    save_manifest(manifest)
 
     print("Fusion des dataframes...")
-    df = merge_decp_json(files)
+    df = merge_decp_json(files, manifest)
+    save_manifest(manifest)
 
-    print("Taille après merge: ", df.shape)
+    print(
+        "Taille après merge: ",
+        (df.select(pl.len()).collect().item(), len(df.collect_schema())),
+    )
+
+    if DECP_ENRICH_SIRENE:
+        # Les fichiers decp.* sont écrits avec le nom des acheteurs, par
+        # enrich_from_sirene
+        return df.collect()
 
     print("Enregistrement des DECP aux formats CSV, Parquet...")
-    save_to_files(df, f"{DIST_DIR}/decp")
+    df = save_to_files(df, f"{DIST_DIR}/decp")
+
+    # Seul chargement en mémoire des DECP, partagé par les flows suivants : les
+    # fichiers ont été écrits en streaming
+    return df.collect()
 
 
 @flow(log_prints=True)
-def make_datalab_data():
+def make_datalab_data(df=None):
     """Tâches consacrées à la transformation des données dans un format
     adapté aux activités du Datalab d'Anticor."""
 
-    df: pl.DataFrame = pl.read_parquet(f"{DIST_DIR}/decp.parquet")
+    if df is None:
+        df = pl.read_parquet(f"{DIST_DIR}/decp.parquet")
 
-    print("Enregistrement des DECP aux formats SQLite...")
-    save_to_sqlite(
-        df,
-        "datalab",
-        "data.gouv.fr.2022.clean",
-        "uid, titulaire_id, titulaire_typeIdentifiant",
-    )
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        # Les tables normalisées et les tables des champs imbriqués sont calculées
+        # pendant l'écriture de la table complète
+        print("Normalisation des tables...")
+        normalized_tables = executor.submit(make_normalized_tables, df.lazy())
+        print("Extraction des champs imbriqués...")
+        nested_tables = executor.submit(make_nested_tables)
 
-    print("Normalisation des tables...")
-    normalize_tables(df)
+        with open_sqlite_database("datalab") as connection:
+            print("Enregistrement des DECP aux formats SQLite...")
+            save_to_sqlite(
+                df,
+                connection,
+                "data.gouv.fr.2022.clean",
+                "uid, titulaire_id, titulaire_typeIdentifiant",
+            )
+
+            print("Enregistrement des tables normalisées...")
+            save_normalized_tables(normalized_tables.result(), connection)
+
+            print("Enregistrement des tables des champs imbriqués...")
+            save_nested_tables(nested_tables.result(), connection)
 
     if DECP_PROCESSING_PUBLISH.lower() == "true":
         print("Publication sur data.gouv.fr...")
@@ -68,14 +139,17 @@ def make_datalab_data():
 
 
 @flow(log_prints=True)
-def make_decpinfo_data():
+def make_decpinfo_data(df=None):
     """Tâches consacrées à la transformation des données dans un format
     # adapté à decp.info"""
 
-    df: pl.DataFrame = pl.read_parquet(f"{DIST_DIR}/decp.parquet")
+    if df is None:
+        df = pl.read_parquet(f"{DIST_DIR}/decp.parquet")
 
     # DECP sans titulaires
-    save_to_files(make_decp_sans_titulaires(df), f"{DIST_DIR}/decp-sans-titulaires")
+    df_sans_titulaires = make_decp_sans_titulaires(df)
+    save_to_files(df_sans_titulaires, f"{DIST_DIR}/decp-sans-titulaires")
+    data_package_frames = {"decp": df, "decp-sans-titulaires": df_sans_titulaires}
 
     # print("Ajout des colonnes manquantes...")
     df = setup_tableschema_columns(df)
@@ -83,10 +157,10 @@ def make_decpinfo_data():
     # CREATION D'UN DATA PACKAGE (FRICTIONLESS DATA)
 
     print("Validation des données DECP avec le TableSchema...")
-    validate_decp_against_tableschema()
+    validate_decp_against_tableschema(df, get_tableschema())
 
     print("Création du data package (JSON)....")
-    make_data_package()
+    make_data_package(data_package_frames, get_tableschema())
 
     # PUBLICATION DES FICHIERS SUR DATA.GOUV.FR
     if DECP_PROCESSING_PUBLISH.lower() == "true":
@@ -105,73 +179,74 @@ def make_decpinfo_data():
 @flow(log_prints=True)
 def decp_processing():
     # Données nettoyées et fusionnées
-    get_clean_merge()
+    df = get_clean_merge()
+
+    # Nom des acheteurs et données des titulaires (SIRENE)
+    if DECP_ENRICH_SIRENE:
+        df = enrich_from_sirene(df)
 
     # Fichiers dédiés à l'Open Data et decp.info
-    make_decpinfo_data()
+    make_decpinfo_data(df)
 
     # Base de données SQLite dédiée aux activités du Datalab d'Anticor
-    make_datalab_data()
+    make_datalab_data(df)
 
 
 @task(log_prints=True)
-def enrich_from_sirene(df):
+def enrich_from_sirene(df: pl.DataFrame):
+    """Ajout du nom des acheteurs aux DECP et création de decp-titulaires avec les
+    données SIRENE des titulaires."""
+
+    print("Mise à jour de la copie locale des stocks SIRENE...")
+    update_sirene_store()
+
     # DONNÉES SIRENE ACHETEURS
 
-    # Enrichissement des données pas prioritaire
     # cf https://github.com/ColinMaudry/decp-processing/issues/17
 
-    # print("Extraction des SIRET des acheteurs...")
-    # df_sirets_acheteurs = extract_unique_acheteurs_siret(df)
+    print("Extraction des SIRET des acheteurs...")
+    df_sirets_acheteurs = extract_unique_acheteurs_siret(df)
 
-    # print("Ajout des données établissements (acheteurs)...")
-    # df_sirets_acheteurs = add_etablissement_data_to_acheteurs(df_sirets_acheteurs)
+    print("Ajout des données établissements (acheteurs)...")
+    df_sirets_acheteurs = add_etablissement_data_to_acheteurs(df_sirets_acheteurs)
 
-    # print("Ajout des données unités légales (acheteurs)...")
-    # df_sirets_acheteurs = add_unite_legale_data_to_acheteurs(df_sirets_acheteurs)
+    print("Ajout des données unités légales (acheteurs)...")
+    df_sirets_acheteurs = add_unite_legale_data_to_acheteurs(df_sirets_acheteurs)
 
-    # print("Construction du champ acheteur_id à partir des données SIRENE...")
-    # df_sirets_acheteurs = make_acheteur_nom(df_sirets_acheteurs)
+    print("Construction du champ acheteur_nom à partir des données SIRENE...")
+    df_sirets_acheteurs = make_acheteur_nom(df_sirets_acheteurs)
 
-    # print("Jointure des données acheteurs enrichies avec les DECP...")
-    # df = merge_sirets_acheteurs(df, df_sirets_acheteurs)
-    # del df_sirets_acheteurs
+    print("Jointure des données acheteurs enrichies avec les DECP...")
+    df = merge_sirets_acheteurs(df, df_sirets_acheteurs)
+    del df_sirets_acheteurs
 
-    # print("Enregistrement des DECP aux formats CSV et Parquet...")
-    # save_to_files(df, f"{DIST_DIR}/decp")
-
-    # print("Suppression de colonnes et déduplication pour les DECP Sans Titulaires...")
-    # df_decp_sans_titulaires = make_decp_sans_titulaires(df)
-    # save_to_files(df_decp_sans_titulaires, f"{DIST_DIR}/decp-sans-titulaires")
-    # del df_decp_sans_titulaires
+    print("Enregistrement des DECP aux formats CSV et Parquet...")
+    save_to_files(df, f"{DIST_DIR}/decp")
 
     # DONNÉES SIRENE TITULAIRES
 
-    # Enrichissement des données pas prioritaire
-    # cf https://github.com/ColinMaudry/decp-processing/issues/17
-
-    # print("Extraction des SIRET des titulaires...")
-    # df_sirets_titulaires = extract_unique_titulaires_siret(df)
+    print("Extraction des SIRET des titulaires...")
+    df_sirets_titulaires = extract_unique_titulaires_siret(df)
 
-    # print("Ajout des données établissements (titulaires)...")
-    # df_sirets_titulaires = add_etablissement_data_to_titulaires(df_sirets_titulaires)
+    print("Ajout des données établissements (titulaires)...")
+    df_sirets_titulaires = add_etablissement_data_to_titulaires(df_sirets_titulaires)
 
-    # print("Ajout des données unités légales (titulaires)...")
-    # df_sirets_titulaires = add_unite_legale_data_to_titulaires(df_sirets_titulaires)
+    print("Ajout des données unités légales (titulaires)...")
+    df_sirets_titulaires = add_unite_legale_data_to_titulaires(df_sirets_titulaires)
 
-    # print("Amélioration des données unités légales des titulaires...")
-    # df_sirets_titulaires = improve_titulaire_unite_legale_data(df_sirets_titulaires)
+    print("Amélioration des données unités légales des titulaires...")
+    df_sirets_titulaires = improve_titulaire_unite_legale_data(df_sirets_titulaires)
 
-    # print("Renommage de certaines colonnes unités légales (titulaires)...")
-    # df_sirets_titulaires = rename_titulaire_sirene_columns(df_sirets_titulaires)
+    print("Renommage de certaines colonnes unités légales (titulaires)...")
+    df_sirets_titulaires = rename_titulaire_sirene_columns(df_sirets_titulaires)
 
-    # print("Jointure pour créer les données DECP Titulaires...")
-    # df_decp_titulaires = merge_sirets_titulaires(df, df_sirets_titulaires)
-    # del df_sirets_titulaires
+    print("Jointure pour créer les données DECP Titulaires...")
+    df_decp_titulaires = merge_sirets_titulaires(df, df_sirets_titulaires)
+    del df_sirets_titulaires
 
-    # print("Enregistrement des DECP Titulaires aux formats CSV et Parquet...")
-    # save_to_files(df_decp_titulaires, f"{DIST_DIR}/decp-titulaires")
-    # del df_decp_titulaires
+    print("Enregistrement des DECP Titulaires aux formats CSV et Parquet...")
+    save_to_files(df_decp_titulaires, f"{DIST_DIR}/decp-titulaires")
+    del df_decp_titulaires
 
     return df
 
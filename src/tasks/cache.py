@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from config import DECP_CACHE_DIR, DECP_CACHE_MAX_SIZE
+
+# Cache des fichiers téléchargés, adressé par contenu : chaque fichier est stocké
+# sous le nom de son empreinte sha1 ({DECP_CACHE_DIR}/{sha1}.json), et l'index
+# associe l'URL de chaque ressource à la dernière version connue
+# (sha1, last_modified, filesize).
+
+CACHE_INDEX_PATH = f"{DECP_CACHE_DIR}/index.json"
+
+
+def load_cache_index() -> dict:
+    if not os.path.exists(CACHE_INDEX_PATH):
+        return {}
+    with open(CACHE_INDEX_PATH, encoding="utf8") as f:
+        return json.load(f)
+
+
+def save_cache_index(index: dict):
+    os.makedirs(DECP_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{CACHE_INDEX_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf8") as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_path, CACHE_INDEX_PATH)
+
+
+def cache_path(sha1: str) -> Path:
+    return Path(f"{DECP_CACHE_DIR}/{sha1}.json")
+
+
+def get_cached_file(sha1: str):
+    """Retourne le chemin du fichier en cache pour cette empreinte, ou None.
+
+    La date de modification du fichier est mise à jour pour que l'éviction
+    supprime en priorité les fichiers les moins récemment utilisés.
+    """
+    if sha1 is None:
+        return None
+    path = cache_path(sha1)
+    if not os.path.exists(path):
+        return None
+    os.utime(path)
+    return path
+
+
+def get_remote_sha1(metadata: dict):
+    """Empreinte sha1 d'une ressource d'après ses métadonnées data.gouv.fr."""
+    if metadata is None:
+        return None
+    checksum = metadata.get("checksum") or {}
+    if checksum.get("type", "sha1") != "sha1":
+        return None
+    return checksum.get("value")
+
+
+def find_in_cache(index: dict, url: str, metadata: dict):
+    """Recherche une ressource dans le cache à partir de ses métadonnées.
+
+    L'empreinte sha1 publiée par data.gouv.fr est utilisée en priorité. À défaut,
+    la version en cache est réutilisée si la date de dernière modification de la
+    ressource n'a pas changé.
+    """
+    sha1 = get_remote_sha1(metadata)
+    if sha1 is not None:
+        return get_cached_file(sha1)
+
+    entry = index.get(url)
+    if (
+        entry is not None
+        and metadata is not None
+        and metadata.get("last_modified") is not None
+        and entry.get("last_modified") == metadata["last_modified"]
+    ):
+        return get_cached_file(entry["sha1"])
+
+    return None
+
+
+def file_sha1(path) -> str:
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def evict_cache(keep: list, max_size: int = DECP_CACHE_MAX_SIZE):
+    """Suppression des fichiers les moins récemment utilisés au-delà de max_size octets.
+
+    Les fichiers de keep (utilisés par le traitement en cours) ne sont jamais
+    supprimés.
+    """
+    if not os.path.exists(DECP_CACHE_DIR):
+        return
+
+    keep = {os.path.abspath(path) for path in keep}
+    files = [
+        entry
+        for entry in os.scandir(DECP_CACHE_DIR)
+        if entry.is_file()
+        and entry.name.endswith(".json")
+        and entry.name != os.path.basename(CACHE_INDEX_PATH)
+    ]
+    total_size = sum(entry.stat().st_size for entry in files)
+
+    for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+        if total_size <= max_size:
+            break
+        if os.path.abspath(entry.path) in keep:
+            continue
+        total_size -= entry.stat().st_size
+        os.remove(entry.path)
+        print(f"Cache : suppression de {entry.name}")
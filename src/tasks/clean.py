@@ -1,133 +1,305 @@
 import polars as pl
+import json
 import os
-from tasks.output import save_to_files
+import shutil
+from datetime import date, timedelta
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 from prefect import task
+from tasks.get import (
+    normalize_decp_json,
+    create_resources_artifact,
+    json_to_parquet_parts,
+    scan_parquet_parts,
+)
 from tasks.transform import explode_titulaires
-from config import DIST_DIR
+from tasks.manifest import record_artifact
+from tasks.schema import get_target_dtypes
+from config import (
+    DIST_DIR,
+    DATE_NOW,
+    DECP_PROCESSING_WORKERS,
+    DECP_PROCESSING_FUSED,
+    DECP_PROCESSING_DEBUG,
+    DECP_DATE_RULES_PATH,
+)
 
 
 @task
-def clean_decp_json(files: list):
-    return_files = []
-    for file in files:
-        #
-        # CLEAN DATA
-        #
-
-        df = pl.scan_parquet(f"{file}.parquet")
-
-        # Explosion des titulaires
-        df = explode_titulaires(df)
-
-        # Colonnes exclues pour l'instant
-        # df = df.rename({
-        #     "typesPrix_typePrix": "typesPrix",
-        #     "considerationsEnvironnementales_considerationEnvironnementale": "considerationsEnvironnementales",
-        #     "considerationsSociales_considerationSociale": "considerationsSociales",
-        #     "techniques_technique": "techniques",
-        #     "modalitesExecution_modaliteExecution": "modalitesExecution"
-        # })
-
-        # Remplacement des valeurs nulles
-        df = df.with_columns(pl.col(pl.String).replace("NC", None))
-        # Nettoyage des identifiants de marchés
-        df = df.with_columns(pl.col("id").str.replace_all(r"[ ,\\./]", "_"))
-
-        # Ajout du champ uid
-        # TODO: à déplacer autre part, dans transform
-        df = df.with_columns((pl.col("acheteur_id") + pl.col("id")).alias("uid"))
-
-        # Suppression des lignes en doublon par UID (acheteur id + id)
-        # Exemple : 20005584600014157140791205100
-        # index_size_before = df.height
-        # df = df.unique(subset=["uid"], maintain_order=False)
-        # print("-- ", index_size_before - df.height, " doublons supprimés (uid)")
-
-        # Dates
-        date_replacements = {
-            # ID marché invalide et SIRET de l'acheteur
-            "0002-11-30": "",
-            "September, 16 2021 00:00:00": "2021-09-16",  # 2000769
-            # 5800012 19830766200017 (plein !)
-            "16 2021 00:00:00": "",
-            "0222-04-29": "2022-04-29",  # 202201L0100
-            "0021-12-05": "2022-12-05",  # 20222022/1400
-            "0001-06-21": "",  # 0000000000000000 21850109600018
-            "0019-10-18": "",  # 0000000000000000 34857909500012
-            "5021-02-18": "2021-02-18",  # 20213051200 21590015000016
-            "2921-11-19": "",  # 20220057201 20005226400013
-            "0022-04-29": "2022-04-29",  # 2022AOO-GASL0100 25640454200035
-        }
-
-        # Using replace_many for efficient replacement of multiple date values
-        df = df.with_columns(
-            pl.col(["datePublicationDonnees", "dateNotification"])
-            .str.replace_many(date_replacements)
-            .cast(pl.Utf8)
-        )
+def get_clean_decp_json(sources: list, manifest: dict) -> list:
+    """Normalisation et nettoyage de chaque source, en parallèle.
 
-        # Nature
-        df = df.with_columns(
-            pl.col("nature").str.replace_many(
-                {"Marche": "Marché", "subsequent": "subséquent"}
+    Chaque source est traitée de bout en bout (get puis clean) dans un processus
+    séparé, jusqu'à DECP_PROCESSING_WORKERS à la fois. Les sources inchangées
+    (cf. manifeste) ne sont pas traitées à nouveau.
+    """
+    sources_to_process = [source for source in sources if source["clean"] is None]
+    processed_sources = {
+        source["file_name"]: source for source in process_sources(sources_to_process)
+    }
+    for i, source in enumerate(sources):
+        if source["file_name"] not in processed_sources:
+            continue
+        source = processed_sources[source["file_name"]]
+        sources[i] = source
+        for step in ["get", "clean"]:
+            if source[step] is None:
+                # Pas de fichier get/ en mode DECP_PROCESSING_FUSED
+                continue
+            record_artifact(
+                manifest, source["file_name"], source["sha1"], step, source[step]
             )
-        )
+        manifest["sources"][source["file_name"]]["date_source"] = source["date_source"]
 
-        # Fix datatypes
-        df = fix_data_types(df)
+    create_resources_artifact(sources)
 
-        file = f"{DIST_DIR}/clean/{file.split('/')[-1]}"
-        return_files.append(file)
-        if not os.path.exists(f"{DIST_DIR}/clean"):
-            os.mkdir(f"{DIST_DIR}/clean")
+    return [source["clean"] for source in sources]
 
-        df = df.collect()
-        save_to_files(df, file, ["parquet"])
 
-    return return_files
+def process_sources(sources_to_process: list) -> list:
+    """get_clean_source pour chaque source, dans DECP_PROCESSING_WORKERS
+    processus à la fois."""
+    if DECP_PROCESSING_WORKERS > 1 and len(sources_to_process) > 1:
+        workers = min(DECP_PROCESSING_WORKERS, len(sources_to_process))
 
+        # Polars utilise tous les cœurs par défaut, on les répartit entre les processus
+        polars_max_threads = os.environ.get("POLARS_MAX_THREADS")
+        os.environ["POLARS_MAX_THREADS"] = str(max(1, os.cpu_count() // workers))
+        try:
+            with ProcessPoolExecutor(
+                max_workers=workers, mp_context=get_context("spawn")
+            ) as executor:
+                return list(executor.map(get_clean_source, sources_to_process))
+        finally:
+            if polars_max_threads is None:
+                del os.environ["POLARS_MAX_THREADS"]
+            else:
+                os.environ["POLARS_MAX_THREADS"] = polars_max_threads
 
-def fix_data_types(df: pl.LazyFrame):
-    numeric_dtypes = {
-        "dureeMois": pl.Int16,
-        # "dureeMoisModification": pl.Int16,
-        # "dureeMoisActeSousTraitance": pl.Int16,
-        # "dureeMoisModificationActeSousTraitance": pl.Int16,
-        "offresRecues": pl.Int16,
-        "montant": pl.Float64,
-        # "montantModification": pl.Float64,
-        # "montantActeSousTraitance": pl.Float64,
-        # "montantModificationActeSousTraitance": pl.Float64,
-        "tauxAvance": pl.Float64,
-        # "variationPrixActeSousTraitance": pl.Float64,
-    }
+    return [get_clean_source(source) for source in sources_to_process]
 
-    for column, dtype in numeric_dtypes.items():
-        # Les valeurs qui ne sont pas des chiffres sont converties en null
-        df = df.with_columns(pl.col(column).cast(dtype, strict=False))
 
-    # Convert date columns to datetime using str.strptime
-    df = df.with_columns(
-        # Les valeurs qui ne sont pas des dates sont converties en null
-        pl.col(
-            [
-                "dateNotification",
-                # "dateNotificationActeSousTraitance",
-                # "dateNotificationModificationModification",
-                # "dateNotificationModificationSousTraitanceModificationActeSousTraitance",
-                "datePublicationDonnees",
-                # "datePublicationDonneesActeSousTraitance",
-                # "datePublicationDonneesModificationActeSousTraitance",
-                # "datePublicationDonneesModificationModification",
-            ]
-        ).str.strptime(pl.Date, format="%Y-%m-%d", strict=False)
+def get_clean_source(source: dict) -> dict:
+    """Normalisation (si nécessaire) puis nettoyage d'une source."""
+    if source["get"] is None and DECP_PROCESSING_FUSED:
+        source["clean"] = get_clean_fused(source)
+        return source
+
+    if source["get"] is None:
+        source["get"] = normalize_decp_json(source)
+    source["clean"] = clean_decp_file(source["get"], source["date_source"])
+    return source
+
+
+def get_clean_fused(source: dict) -> str:
+    """Normalisation et nettoyage d'une source en un seul plan Polars.
+
+    Les lots de marchés aplatis sont lus directement par le plan de nettoyage,
+    exécuté en streaming jusqu'au fichier clean/. Le fichier get/ n'est écrit
+    qu'en mode DECP_PROCESSING_DEBUG.
+    """
+    filename = source["file_name"]
+    file = f"{DIST_DIR}/get/{filename}_{DATE_NOW}"
+    os.makedirs(f"{DIST_DIR}/get", exist_ok=True)
+
+    parts = json_to_parquet_parts(source["json"], filename, f"{file}_parts")
+    df = scan_parquet_parts(parts)
+
+    if DECP_PROCESSING_DEBUG:
+        df.sink_parquet(f"{file}.parquet")
+        source["get"] = file
+
+    df_shape = (df.select(pl.len()).collect().item(), len(df.collect_schema()))
+    print(f"[{filename}]", df_shape)
+    source["artifact"]["column_number"] = df_shape[1]
+    source["artifact"]["row_number"] = df_shape[0]
+
+    clean_file = f"{DIST_DIR}/clean/{file.split('/')[-1]}"
+    os.makedirs(f"{DIST_DIR}/clean", exist_ok=True)
+    clean_decp(df, source["date_source"]).sink_parquet(f"{clean_file}.parquet")
+    print_date_rules(clean_file)
+
+    shutil.rmtree(f"{file}_parts")
+
+    return clean_file
+
+
+def clean_decp_file(file: str, date_source: str) -> str:
+    df = pl.scan_parquet(f"{file}.parquet")
+    df = clean_decp(df, date_source)
+
+    file = f"{DIST_DIR}/clean/{file.split('/')[-1]}"
+    os.makedirs(f"{DIST_DIR}/clean", exist_ok=True)
+
+    df.sink_parquet(f"{file}.parquet")
+    print_date_rules(file)
+
+    return file
+
+
+def clean_decp(df: pl.LazyFrame, date_source: str) -> pl.LazyFrame:
+    #
+    # CLEAN DATA
+    #
+
+    # Explosion des titulaires
+    df = explode_titulaires(df)
+
+    # Colonnes exclues pour l'instant
+    # df = df.rename({
+    #     "typesPrix_typePrix": "typesPrix",
+    #     "considerationsEnvironnementales_considerationEnvironnementale": "considerationsEnvironnementales",
+    #     "considerationsSociales_considerationSociale": "considerationsSociales",
+    #     "techniques_technique": "techniques",
+    #     "modalitesExecution_modaliteExecution": "modalitesExecution"
+    # })
+
+    # Remplacement des valeurs nulles
+    df = df.with_columns(pl.col(pl.String).replace("NC", None))
+    # Nettoyage des identifiants de marchés
+    df = df.with_columns(pl.col("id").str.replace_all(r"[ ,\\./]", "_"))
+
+    # Ajout du champ uid
+    # TODO: à déplacer autre part, dans transform
+    df = df.with_columns((pl.col("acheteur_id") + pl.col("id")).alias("uid"))
+
+    # Suppression des lignes en doublon par UID (acheteur id + id)
+    # Exemple : 20005584600014157140791205100
+    # index_size_before = df.height
+    # df = df.unique(subset=["uid"], maintain_order=False)
+    # print("-- ", index_size_before - df.height, " doublons supprimés (uid)")
+
+    # Dates
+    df = normalize_dates(
+        df,
+        [name for name, dtype in get_target_dtypes().items() if dtype == pl.Date],
+        date_source,
     )
 
-    # Champs booléens
+    # Nature
     df = df.with_columns(
-        pl.col(["sousTraitanceDeclaree", "attributionAvance", "marcheInnovant"]).eq(
-            "true"
+        pl.col("nature").str.replace_many(
+            {"Marche": "Marché", "subsequent": "subséquent"}
         )
     )
 
+    # Fix datatypes
+    df = fix_data_types(df)
+
+    return df
+
+
+@lru_cache
+def load_date_rules() -> dict:
+    with open(DECP_DATE_RULES_PATH, encoding="utf8") as f:
+        return json.load(f)
+
+
+def normalize_dates(df: pl.LazyFrame, columns: list, date_source: str) -> pl.LazyFrame:
+    """Conversion des colonnes de dates d'après les règles de DECP_DATE_RULES_PATH.
+
+    Pour chaque valeur, la première correction d'année qui correspond est
+    appliquée, puis les formats sont essayés dans l'ordre. Les dates hors de la
+    période plausible sont converties en null : sa borne supérieure dépend de la
+    date de la source (AAAA-MM-JJ, cf. tasks.get.get_source_date), pas du jour du
+    traitement. La règle appliquée est gardée dans la colonne {colonne}_regle
+    ("correction+format", "invalide", "hors_periode").
+    """
+    rules = load_date_rules()
+    min_date = date.fromisoformat(rules["plausibility"]["min"])
+    max_date = date.fromisoformat(date_source) + timedelta(
+        days=rules["plausibility"]["maxDaysAfterSource"]
+    )
+
+    expressions = []
+    for column in columns:
+        value = pl.col(column).str.strip_chars()
+        value = pl.when(value != "").then(value)
+
+        fixup_name = pl.coalesce(
+            pl.when(value.str.contains(fixup["pattern"])).then(pl.lit(fixup["name"]))
+            for fixup in rules["yearFixups"]
+        )
+        fixed_value = pl.coalesce(
+            [
+                pl.when(value.str.contains(fixup["pattern"])).then(
+                    value.str.replace(fixup["pattern"], fixup["replacement"])
+                )
+                for fixup in rules["yearFixups"]
+            ]
+            + [value]
+        )
+
+        parsed_dates = []
+        for date_format in rules["formats"]:
+            parsed_value = fixed_value
+            if "extract" in date_format:
+                parsed_value = parsed_value.str.extract(date_format["extract"], 1)
+            parsed_dates.append(
+                (
+                    date_format["name"],
+                    parsed_value.str.strptime(
+                        pl.Date, format=date_format["format"], strict=False
+                    ),
+                )
+            )
+
+        parsed_date = pl.coalesce(parsed_date for _, parsed_date in parsed_dates)
+        format_name = pl.coalesce(
+            pl.when(parsed_date.is_not_null()).then(pl.lit(name))
+            for name, parsed_date in parsed_dates
+        )
+        plausible = parsed_date.is_between(min_date, max_date)
+
+        rule = (
+            pl.when(value.is_null())
+            .then(None)
+            .when(parsed_date.is_null())
+            .then(pl.lit("invalide"))
+            .when(~plausible)
+            .then(pl.lit("hors_periode"))
+            .otherwise(
+                pl.concat_str(
+                    [fixup_name, format_name], separator="+", ignore_nulls=True
+                )
+            )
+        )
+
+        expressions.append(pl.when(plausible).then(parsed_date).alias(column))
+        expressions.append(rule.alias(f"{column}_regle"))
+
+    return df.with_columns(expressions)
+
+
+def print_date_rules(file: str):
+    """Affichage du nombre de dates converties par chaque règle."""
+    df = pl.scan_parquet(f"{file}.parquet")
+    for column in df.collect_schema().names():
+        if not column.endswith("_regle"):
+            continue
+        counts = (
+            df.group_by(column)
+            .len()
+            .drop_nulls()
+            .sort("len", descending=True)
+            .collect()
+        )
+        counts = ", ".join(f"{rule}: {count}" for rule, count in counts.iter_rows())
+        print(f"[{file.split('/')[-1]}] {column} : {counts}")
+
+
+def fix_data_types(df: pl.LazyFrame):
+    """Application des types cibles du schéma source.
+
+    Les types sont déjà appliqués à la lecture du JSON, et les dates converties
+    par normalize_dates.
+    """
+    columns = df.collect_schema()
+    for column, dtype in get_target_dtypes().items():
+        if column not in columns or columns[column] == dtype:
+            continue
+        # Les valeurs qui ne sont pas du bon type sont converties en null
+        df = df.with_columns(pl.col(column).cast(dtype, strict=False))
+
     return df
@@ -1,89 +1,52 @@
 import polars as pl
-from os import getenv
 
+from tasks.sirene import scan_sirene_store
 
-def add_etablissement_data_to_acheteurs(df_siret_acheteurs: pl.DataFrame):
-    etablissement_df_chunked = pl.read_csv(
-        getenv("SIRENE_ETABLISSEMENTS_PATH"),
-        chunksize=1000000,
-        dtype="object",
-        index_col=None,
-        usecols=[
+# Les données SIRENE sont lues dans la copie locale triée des fichiers stock
+# (cf. tasks.sirene, mise à jour par update_sirene_store) : seules les colonnes
+# utilisées sont lues, et le filtre sur les SIRET/SIREN des DECP est appliqué à la
+# lecture, ce qui écarte les groupes de lignes qui ne peuvent pas les contenir.
+
+
+def join_sirene(
+    df: pl.DataFrame, sirene: pl.LazyFrame, left_on: str, right_on: str
+) -> pl.DataFrame:
+    """Jointure interne de df avec les lignes SIRENE dont la clé est dans df."""
+    keys = df.get_column(left_on).unique().drop_nulls().cast(pl.String)
+    sirene = sirene.filter(pl.col(right_on).is_in(keys)).collect(engine="streaming")
+    return df.join(sirene, left_on=left_on, right_on=right_on, how="inner")
+
+
+def add_etablissement_data_to_acheteurs(df_sirets_acheteurs: pl.DataFrame):
+    etablissements = scan_sirene_store(
+        "etablissements",
+        [
             "siret",
             "siren",
             # "denominationUsuelleEtablissement", vide
             "enseigne1Etablissement",
         ],
     )
-
-    merged_chunks_list = []
-
-    with etablissement_df_chunked as reader:
-        for df_chunk in reader:
-            merge = pl.merge(
-                df_siret_acheteurs,
-                df_chunk,
-                how="inner",
-                left_on="acheteur_id",
-                right_on="siret",
-            )
-            if merge.index.size > 0:
-                merged_chunks_list.append(merge)
-
-    decp_acheteurs_df = pl.concat(merged_chunks_list).drop(columns=["siret"])
-
-    del etablissement_df_chunked, df_chunk
-
-    return decp_acheteurs_df
+    return join_sirene(df_sirets_acheteurs, etablissements, "acheteur_id", "siret")
 
 
 def add_unite_legale_data_to_acheteurs(decp_acheteurs_df: pl.DataFrame):
-    unite_legale_df_chunked = pl.read_csv(
-        getenv("SIRENE_UNITES_LEGALES_PATH"),
-        index_col=None,
-        dtype="object",
-        sep=",",
-        chunksize=1000000,
-        usecols=[
+    unites_legales = scan_sirene_store(
+        "unites_legales",
+        [
             "siren",
             "denominationUniteLegale",
             # "sigleUniteLegale" trop variable, parfois long
         ],
     )
-
-    merged_chunks_list = []
-
-    with unite_legale_df_chunked as reader:
-        for df_chunk in reader:
-            merge = pl.merge(decp_acheteurs_df, df_chunk, how="inner", on="siren")
-            if not merge.empty and merge.notnull().any().any() and len(merge) >= 1:
-                merged_chunks_list.append(merge)
-    del unite_legale_df_chunked, df_chunk
-
-    decp_acheteurs_df = pl.concat(merged_chunks_list)
-
-    del merged_chunks_list
-
-    return decp_acheteurs_df
+    return join_sirene(decp_acheteurs_df, unites_legales, "siren", "siren")
 
 
 def add_etablissement_data_to_titulaires(df_sirets_titulaires: pl.DataFrame):
     # Récupération des données SIRET titulaires
-    dtypes_etablissements = {
-        "siret": "object",
-        "siren": "object",
-        "longitude": "float",
-        "latitude": "float",
-        "activitePrincipaleEtablissement": "object",
-        "codeCommuneEtablissement": "object",
-        "etatAdministratifEtablissement": "category",
-    }
-    etablissement_df_chunked = pl.read_csv(
-        getenv("SIRENE_ETABLISSEMENTS_PATH"),
-        chunksize=(500000),
-        dtype=dtypes_etablissements,
-        index_col=None,
-        usecols=[
+    etablissements = scan_sirene_store(
+        "etablissements",
+        [
             "siret",
             "siren",
             "longitude",
@@ -93,128 +56,56 @@ def add_etablissement_data_to_titulaires(df_sirets_titulaires: pl.DataFrame):
             "etatAdministratifEtablissement",
         ],
     )
-
-    merged_chunks_list = []
-
-    # 6 min 20 en gardant tous les merges, 10 000 chunks. Resultat 38M rows!
-    # 6 min 27 avec inner merge et en ne gardant que les merge non vides
-    # 4 min 04 avec 200 000 chunks
-    # 3 min 27 avec 500 000 chunks
-    # 3 min 05 avec 1M chunks
-
-    with etablissement_df_chunked as reader:
-        for df_chunk in reader:
-            merge = pl.merge(
-                df_sirets_titulaires,
-                df_chunk,
-                how="inner",
-                left_on="titulaire_id",
-                right_on="siret",
-            )
-            if merge.index.size > 0:
-                merged_chunks_list.append(merge)
-
-    df_sirets_titulaires = pl.concat(merged_chunks_list).drop(columns=["siret"])
-
-    del etablissement_df_chunked, df_chunk
-
-    return df_sirets_titulaires
+    return join_sirene(df_sirets_titulaires, etablissements, "titulaire_id", "siret")
 
 
 def add_unite_legale_data_to_titulaires(df_sirets_titulaires: pl.DataFrame):
-    dtypes_uniteLegales = {
-        "siren": "object",
-        "categorieEntreprise": "object",  # doit être object, car il y a des NaN
-        "etatAdministratifUniteLegale": "category",
-        "economieSocialeSolidaireUniteLegale": "object",  # doit être object, car il y a des NaN
-        "categorieJuridiqueUniteLegale": "object",  # object plutôt que catégorie pour faire des modifications plus tard
-    }
-
-    unite_legale_df_chunked = pl.read_csv(
-        getenv("SIRENE_UNITES_LEGALES_PATH"),
-        index_col=None,
-        dtype=dtypes_uniteLegales,
-        sep=",",
-        chunksize=500000,
-        usecols=[
+    unites_legales = scan_sirene_store(
+        "unites_legales",
+        [
             "siren",
+            "denominationUniteLegale",
             "categorieEntreprise",
             "etatAdministratifUniteLegale",
             "economieSocialeSolidaireUniteLegale",
             "categorieJuridiqueUniteLegale",
         ],
     )
-
-    merged_chunks_list = []
-
-    with unite_legale_df_chunked as reader:
-        for df_chunk in reader:
-            merge = pl.merge(df_sirets_titulaires, df_chunk, how="inner", on="siren")
-            if not merge.empty and merge.notnull().any().any() and len(merge) >= 1:
-                merged_chunks_list.append(merge)
-    del unite_legale_df_chunked, df_chunk
-
-    df_sirets_titulaires = pl.concat(merged_chunks_list)
-
-    del merged_chunks_list
-
-    return df_sirets_titulaires
+    return join_sirene(df_sirets_titulaires, unites_legales, "siren", "siren")
 
 
 def merge_sirets_acheteurs(decp_df: pl.DataFrame, df_sirets_acheteurs: pl.DataFrame):
-    final_columns = ["acheteur_id", "acheteur_id"]
+    final_columns = ["acheteur_id", "acheteur_nom"]
 
-    decp_df = decp_df.drop(columns=["acheteur_id"])
-    decp_df = pl.merge(
-        decp_df,
-        df_sirets_acheteurs[final_columns],
+    decp_df = decp_df.drop("acheteur_nom", strict=False)
+    decp_df = decp_df.join(
+        df_sirets_acheteurs.select(final_columns),
         on="acheteur_id",
         how="left",
     )
 
-    del df_sirets_acheteurs
-
     return decp_df
 
 
 def merge_sirets_titulaires(decp_df: pl.DataFrame, df_sirets_titulaires: pl.DataFrame):
-    final_columns = [
-        "id",
-        "uid",
-        "acheteur_id",
-        "acheteur_id",
-        "nature",
-        "objet",
-        "codeCPV",
-        "lieuExecution_code",
-        "lieuExecution_typeCode",
-        "lieuExecution.nom",
-        "dureeMois",
-        "dateNotification",
-        "montant",
-        "titulaire_id",
-        "titulaire_typeIdentifiant",
-        "titulaire.denominationSociale",
+    sirene_columns = [
+        "titulaire_denominationSociale",
         "codeAPE",
         "departement",
         "categorieEntreprise",  # plutôt que categorie
         "categorieJuridique",  # libellé
-        # "categorieJuridiqueLibelle1",
-        # "categorieJuridiqueLibelle2",
         "etatEtablissement",
         "etatEntreprise",
         "longitude",
         "latitude",
-        "donneesActuelles",
-        "anomalies",
     ]
 
-    df_decp_titulaires = pl.merge(
-        decp_df,
-        df_sirets_titulaires,
+    df_decp_titulaires = decp_df.drop(sirene_columns, strict=False).join(
+        df_sirets_titulaires.select(
+            "titulaire_id", "titulaire_typeIdentifiant", *sirene_columns
+        ),
         on=["titulaire_id", "titulaire_typeIdentifiant"],
         how="left",
     )
-    df_decp_titulaires = df_decp_titulaires[final_columns]
 
     return df_decp_titulaires
@@ -1,31 +1,64 @@
 import polars as pl
-from httpx import get
+from httpx import Client, Limits
+import hashlib
 import os
-import json
+import shutil
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
-from polars.polars import ColumnNotFoundError
+import ijson
 from prefect import task
 from pathlib import Path
 
-from tasks.output import save_to_files
 from tasks.setup import create_table_artifact
-from config import DIST_DIR, DECP_JSON_FILES, DATE_NOW
+from tasks.manifest import get_artifact
+from tasks.schema import get_ingest_schema, get_nested_paths, find_unknown_fields
+from tasks.cache import (
+    file_sha1,
+    load_cache_index,
+    save_cache_index,
+    find_in_cache,
+    get_remote_sha1,
+    cache_path,
+    evict_cache,
+)
+from config import (
+    DIST_DIR,
+    DECP_JSON_FILES,
+    DATE_NOW,
+    DECP_JSON_BATCH_SIZE,
+    DECP_DOWNLOAD_CONCURRENCY,
+    DATAGOUVFR_API,
+    DECP_CACHE_DIR,
+)
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # 1 Mo
+DOWNLOAD_TIMEOUT = 300
 
-@task(retries=5, retry_delay_seconds=5)
-def get_json(date_now, json_file: dict):
+
+def get_json(client: Client, json_file: dict, metadata: dict, cache_index: dict):
     url = json_file["url"]
     filename = json_file["file_name"]
 
-    if url.startswith("https"):
-        # Prod file
-        decp_json_file: Path = Path(f"data/{filename}_{date_now}.json")
-        if not (os.path.exists(decp_json_file)):
-            request = get(url, follow_redirects=True)
-            with open(decp_json_file, "wb") as file:
-                file.write(request.content)
+    if url.startswith("http"):
+        # Prod file, réutilisé depuis le cache si la ressource n'a pas changé
+        decp_json_file = find_in_cache(cache_index, url, metadata)
+        if decp_json_file is None:
+            tmp_path = Path(f"{DECP_CACHE_DIR}/{filename}.tmp")
+            sha1 = download_file(client, url, tmp_path)
+
+            remote_sha1 = get_remote_sha1(metadata)
+            if remote_sha1 is not None and remote_sha1 != sha1:
+                os.remove(tmp_path)
+                raise ValueError(
+                    f"[{filename}] Empreinte sha1 invalide : {sha1} au lieu de {remote_sha1}"
+                )
+
+            decp_json_file = cache_path(sha1)
+            os.replace(tmp_path, decp_json_file)
         else:
-            print(f"[{filename}] DECP d'aujourd'hui déjà téléchargées ({date_now})")
+            print(f"[{filename}] Fichier inchangé, utilisation du cache")
     else:
         # Test file, pas de téléchargement
         decp_json_file: Path = Path(url)
@@ -33,123 +66,433 @@ def get_json(date_now, json_file: dict):
     return decp_json_file
 
 
-@task(retries=5, retry_delay_seconds=5)
-def get_json_metadata(json_file: dict) -> dict:
+def download_file(client: Client, url: str, path: Path) -> str:
+    """Téléchargement d'un fichier par morceaux, sans garder la réponse en mémoire.
+
+    Retourne l'empreinte sha1 du fichier, calculée pendant le téléchargement.
+    """
+    sha1 = hashlib.sha1()
+    with client.stream("GET", url) as response:
+        response.raise_for_status()
+        with open(path, "wb") as file:
+            for chunk in response.iter_bytes(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                sha1.update(chunk)
+                file.write(chunk)
+    return sha1.hexdigest()
+
+
+def get_json_metadata(client: Client, json_file: dict) -> dict:
     """Téléchargement des métadonnées d'une ressoure (fichier)."""
     resource_id = json_file["url"].split("/")[-1]
-    api_url = f"http://www.data.gouv.fr/api/1/datasets/5cd57bf68b4c4179299eb0e9/resources/{resource_id}/"
-    json_metadata = get(api_url, follow_redirects=True).json()
-    return json_metadata
+    api_url = (
+        f"{DATAGOUVFR_API}/datasets/5cd57bf68b4c4179299eb0e9/resources/{resource_id}/"
+    )
+    response = client.get(api_url)
+    response.raise_for_status()
+    return response.json()
+
+
+def fetch_json_file(client: Client, json_file: dict, cache_index: dict) -> dict:
+    """Téléchargement d'une ressource et de ses métadonnées data.gouv.fr.
+
+    Les métadonnées sont récupérées en premier pour savoir si la version en cache
+    de la ressource est toujours à jour.
+    """
+    decp_json_metadata = None
+    if json_file["url"].startswith("http"):
+        decp_json_metadata = get_json_metadata(client, json_file)
+
+    decp_json_file: Path = get_json(client, json_file, decp_json_metadata, cache_index)
+
+    return {
+        "json_file": json_file,
+        "path": decp_json_file,
+        "metadata": decp_json_metadata,
+    }
+
+
+@task(retries=5, retry_delay_seconds=5)
+def fetch_decp_json_files(json_files: list) -> list:
+    """Téléchargement en parallèle des ressources à traiter et de leurs métadonnées.
+
+    Un seul client HTTP (pool de connexions) est partagé entre les téléchargements,
+    dont le nombre simultané est limité par DECP_DOWNLOAD_CONCURRENCY. Seules les
+    ressources qui ont changé depuis le dernier téléchargement sont téléchargées,
+    les autres sont lues depuis le cache (DECP_CACHE_DIR).
+    """
+    json_files = [json_file for json_file in json_files if json_file["process"] is True]
+
+    os.makedirs(DECP_CACHE_DIR, exist_ok=True)
+    cache_index = load_cache_index()
+
+    limits = Limits(
+        max_connections=DECP_DOWNLOAD_CONCURRENCY,
+        max_keepalive_connections=DECP_DOWNLOAD_CONCURRENCY,
+    )
+    with Client(
+        limits=limits, timeout=DOWNLOAD_TIMEOUT, follow_redirects=True
+    ) as client, ThreadPoolExecutor(max_workers=DECP_DOWNLOAD_CONCURRENCY) as executor:
+        fetched_files = list(
+            executor.map(
+                lambda json_file: fetch_json_file(client, json_file, cache_index),
+                json_files,
+            )
+        )
+
+    for fetched_file in fetched_files:
+        metadata = fetched_file["metadata"]
+        if metadata is not None:
+            cache_index[fetched_file["json_file"]["url"]] = {
+                "sha1": Path(fetched_file["path"]).stem,
+                "last_modified": metadata.get("last_modified"),
+                "filesize": metadata.get("filesize"),
+            }
+    save_cache_index(cache_index)
+    evict_cache(keep=[fetched_file["path"] for fetched_file in fetched_files])
+
+    return fetched_files
 
 
 @task
-def get_decp_json() -> list:
-    """Téléchargement des DECP publiées par Bercy sur data.gouv.fr."""
+def get_decp_json(manifest: dict) -> list:
+    """Téléchargement des DECP publiées par Bercy sur data.gouv.fr.
+
+    Retourne une liste de sources : {"file_name", "json", "sha1", "date_source",
+    "get", "clean", "artifact"}. Les chemins "get" et "clean" sont renseignés quand les fichiers
+    Parquet d'une source inchangée (d'après le manifeste) peuvent être réutilisés.
+    """
 
     json_files = DECP_JSON_FILES
     date_now = DATE_NOW
 
-    return_files = []
-    artefact = []
-    for json_file in json_files:
+    print("Téléchargement des fichiers JSON...")
+    fetched_files = fetch_decp_json_files(json_files)
+
+    sources = []
+    for fetched_file in fetched_files:
+        json_file = fetched_file["json_file"]
+        decp_json_file: Path = fetched_file["path"]
+        decp_json_metadata = fetched_file["metadata"]
+
         artifact_row = {}
-        if json_file["process"] is True:
-            decp_json_file: Path = get_json(date_now, json_file)
-
-            if json_file["url"].startswith("https"):
-                decp_json_metadata = get_json_metadata(json_file)
-                artifact_row = {
-                    "open_data_filename": decp_json_metadata["title"],
-                    "open_data_id": decp_json_metadata["id"],
-                    "sha1": decp_json_metadata["checksum"]["value"],
-                    "created_at": decp_json_metadata["created_at"],
-                    "last_modified": decp_json_metadata["last_modified"],
-                    "filesize": decp_json_metadata["filesize"],
-                    "views": decp_json_metadata["metrics"]["views"],
-                }
+        if decp_json_metadata is not None:
+            artifact_row = {
+                "open_data_filename": decp_json_metadata["title"],
+                "open_data_id": decp_json_metadata["id"],
+                "sha1": decp_json_metadata["checksum"]["value"],
+                "created_at": decp_json_metadata["created_at"],
+                "last_modified": decp_json_metadata["last_modified"],
+                "filesize": decp_json_metadata["filesize"],
+                "views": decp_json_metadata["metrics"]["views"],
+            }
 
-            with open(decp_json_file, encoding="utf8") as f:
-                decp_json = json.load(f)
-
-            filename = json_file["file_name"]
-            path = decp_json["marches"]["marche"]
-            df: pl.DataFrame = pl.json_normalize(
-                path,
-                strict=False,
-                infer_schema_length=10000,
-                encoder="utf8",
-                separator="_",
-                # Remplacement des "." dans les noms de colonnes par des "_" car
-                # en SQL ça oblige à entourer les noms de colonnes de guillemets
-            )
+        filename = json_file["file_name"]
+        source_sha1 = get_remote_sha1(decp_json_metadata) or file_sha1(decp_json_file)
+        source = {
+            "file_name": filename,
+            "json": str(decp_json_file),
+            "sha1": source_sha1,
+            "date_source": get_source_date(
+                manifest, filename, source_sha1, decp_json_metadata
+            ),
+            "get": None,
+            "clean": get_artifact(manifest, filename, source_sha1, "clean"),
+            "artifact": artifact_row,
+        }
+        if source["clean"] is None:
+            source["get"] = get_artifact(manifest, filename, source_sha1, "get")
+        if source["clean"] is not None or source["get"] is not None:
+            print(f"[{filename}] Source inchangée, fichiers Parquet réutilisés")
 
-            artifact_row["open_data_dataset"] = "data.gouv.fr JSON"
-            artifact_row["download_date"] = date_now
-            artifact_row["column_number"] = len(df.columns)
-            artifact_row["row_number"] = df.height
+        artifact_row["open_data_dataset"] = "data.gouv.fr JSON"
+        artifact_row["download_date"] = date_now
 
-            artefact.append(artifact_row)
+        sources.append(source)
+
+    return sources
+
+
+def get_source_date(
+    manifest: dict, source_name: str, source_sha1: str, metadata: dict
+) -> str:
+    """Date (AAAA-MM-JJ) de cette version de la source, borne des dates plausibles
+    (cf. tasks.clean.normalize_dates).
+
+    C'est la date de dernière modification de la ressource sur data.gouv.fr, ou à
+    défaut celle du premier téléchargement de cette version du fichier, gardée dans
+    le manifeste : un même fichier est toujours nettoyé de la même façon.
+    """
+    entry = manifest["sources"].get(source_name)
+    if entry is not None and entry["sha1"] == source_sha1 and "date_source" in entry:
+        return entry["date_source"]
+    if metadata is not None:
+        return metadata["last_modified"][:10]
+    return DATE_NOW
 
-            df = df.with_columns(
-                pl.lit(f"data.gouv.fr {filename}.json").alias("source_open_data")
-            )
 
-            # Pour l'instant on ne garde pas les champs qui demandent une explosion
-            # ou une eval à part titulaires
-
-            columns_to_drop = [
-                # Pas encore incluses
-                "typesPrix_typePrix",
-                "considerationsEnvironnementales_considerationEnvironnementale",
-                "considerationsSociales_considerationSociale",
-                "techniques_technique",
-                "modalitesExecution_modaliteExecution",
-                "modifications",
-                "actesSousTraitance",
-                "modificationsActesSousTraitance",
-                # Champs de concessions
-                "_type",  # Marché ou Contrat de concession
-                "autoriteConcedante",
-                "concessionnaires",
-                "donneesExecution",
-                "valeurGlobale",
-                "montantSubventionPublique",
-                "dateSignature",
-                "dateDebutExecution",
-                # Champs ajoutés par e-marchespublics (decp-2022)
-                "offresRecues_source",
-                "marcheInnovant_source",
-                "attributionAvance_source",
-                "sousTraitanceDeclaree_source",
-                "dureeMois_source",
-            ]
-
-            absent_columns = []
-            for col in columns_to_drop:
-                try:
-                    df = df.drop(col)
-                except ColumnNotFoundError:
-                    absent_columns.append(col)
-                    pass
-
-            if len(absent_columns) > 0:
-                print(f"{filename}: colonnes à supprimer absentes : {absent_columns}")
-            print(f"[{filename}]", df.shape)
-
-            file = f"{DIST_DIR}/get/{filename}_{date_now}"
-            if not os.path.exists(f"{DIST_DIR}/get"):
-                os.mkdir(f"{DIST_DIR}/get")
-            save_to_files(df, file, ["parquet"])
-
-            return_files.append(file)
+def normalize_decp_json(source: dict) -> str:
+    """Aplatissement d'un fichier JSON source dans DIST_DIR/get."""
+    filename = source["file_name"]
+    file = f"{DIST_DIR}/get/{filename}_{DATE_NOW}"
+    os.makedirs(f"{DIST_DIR}/get", exist_ok=True)
+    df_shape = json_stream_to_parquet(source["json"], filename, file)
 
+    source["artifact"]["column_number"] = df_shape[1]
+    source["artifact"]["row_number"] = df_shape[0]
+
+    return file
+
+
+def create_resources_artifact(sources: list):
     # Stock les statistiques dans prefect cloud
     create_table_artifact(
-        table=artefact,
+        table=[source["artifact"] for source in sources],
         key="datagouvfr-json-resources",
-        description=f"Les ressources JSON des DECP consolidées au format JSON ({date_now})",
+        description=f"Les ressources JSON des DECP consolidées au format JSON ({DATE_NOW})",
     )
-    return return_files
+
+
+def json_stream_to_parquet(decp_json_file: Path, filename: str, file: str) -> tuple:
+    """Lecture incrémentale du tableau marches.marche et écriture en Parquet.
+
+    Les marchés sont lus par lots de DECP_JSON_BATCH_SIZE, aplatis et écrits dans
+    des fichiers Parquet intermédiaires, puis fusionnés dans {file}.parquet sans
+    charger tout le fichier JSON en mémoire. Retourne (lignes, colonnes).
+    """
+    parts = json_to_parquet_parts(decp_json_file, filename, f"{file}_parts")
+    scan_parquet_parts(parts).sink_parquet(f"{file}.parquet")
+    shutil.rmtree(f"{file}_parts")
+
+    lf = pl.scan_parquet(f"{file}.parquet")
+    shape = (lf.select(pl.len()).collect().item(), len(lf.collect_schema()))
+    print(f"[{filename}]", shape)
+
+    return shape
+
+
+def json_to_parquet_parts(decp_json_file: Path, filename: str, parts_dir: str) -> list:
+    """Aplatissement des marchés par lots de DECP_JSON_BATCH_SIZE, chaque lot
+    étant écrit dans un fichier Parquet de parts_dir. Retourne les chemins des lots.
+    """
+    if os.path.exists(parts_dir):
+        shutil.rmtree(parts_dir)
+    os.mkdir(parts_dir)
+
+    parts = []
+    seen_columns = set()
+    listed_values = Counter()
+    null_values = Counter()
+    with open(decp_json_file, "rb") as f:
+        marches = ijson.items(f, "marches.marche.item", use_float=True)
+        while True:
+            batch = list(islice(marches, DECP_JSON_BATCH_SIZE))
+            if len(batch) == 0:
+                break
+
+            for marche in batch:
+                seen_columns.update(flatten_keys(marche))
+                coerce_nested_fields(marche, listed_values, null_values)
+
+            df: pl.DataFrame = normalize_batch(batch, null_values)
+            del batch
+
+            df = df.with_columns(
+                pl.lit(f"data.gouv.fr {filename}.json").alias("source_open_data")
+            )
+
+            part = f"{parts_dir}/{len(parts):05}"
+            df.write_parquet(f"{part}.parquet")
+            parts.append(f"{part}.parquet")
+            del df
+
+    unknown_columns = find_unknown_fields(seen_columns)
+    if len(unknown_columns) > 0:
+        print(f"{filename}: champs absents du schéma source : {unknown_columns}")
+    if len(listed_values) > 0:
+        print(
+            f"{filename}: valeurs uniques mises en liste : {dict(sorted(listed_values.items()))}"
+        )
+    if len(null_values) > 0:
+        print(
+            f"{filename}: valeurs d'un type inattendu remplacées par null : "
+            f"{dict(sorted(null_values.items()))}"
+        )
+
+    if len(parts) == 0:
+        print(f"[{filename}] Aucun marché trouvé")
+        part = f"{parts_dir}/{len(parts):05}"
+        pl.DataFrame(schema=get_ingest_schema()).with_columns(
+            pl.lit(None, pl.String).alias("source_open_data")
+        ).write_parquet(f"{part}.parquet")
+        parts.append(f"{part}.parquet")
+
+    return parts
+
+
+def scan_parquet_parts(parts: list) -> pl.LazyFrame:
+    # Tous les lots ont le même schéma (celui du schéma source)
+    return pl.concat([pl.scan_parquet(part) for part in parts])
+
+
+def normalize_batch(batch: list, null_values: Counter = None) -> pl.DataFrame:
+    """Aplatissement d'un lot de marchés, typé d'après le schéma source.
+
+    Les champs absents du schéma ne sont pas gardés. Les valeurs des champs simples
+    converties en null sont comptées par champ dans null_values.
+    """
+    try:
+        return pl.json_normalize(
+            batch,
+            schema=get_ingest_schema(),
+            strict=False,
+            encoder="utf8",
+            separator="_",
+            # Remplacement des "." dans les noms de colonnes par des "_" car
+            # en SQL ça oblige à entourer les noms de colonnes de guillemets
+        )
+    except pl.exceptions.ComputeError:
+        # Au moins une valeur n'est pas du type attendu (ex : "NC" dans montant) :
+        # lecture des champs simples en texte, puis conversion. Les valeurs qui ne
+        # peuvent pas être converties deviennent nulles.
+        ingest_schema = get_ingest_schema()
+        df = pl.json_normalize(
+            batch,
+            schema={
+                name: dtype if dtype.is_nested() else pl.String
+                for name, dtype in ingest_schema.items()
+            },
+            strict=False,
+            encoder="utf8",
+            separator="_",
+        )
+        casts = {
+            name: cast_from_string(pl.col(name), dtype)
+            for name, dtype in ingest_schema.items()
+            if not dtype.is_nested()
+        }
+        if null_values is not None:
+            counts = df.select(
+                (pl.col(name).is_not_null() & cast.is_null()).sum().alias(name)
+                for name, cast in casts.items()
+            )
+            null_values.update(
+                {
+                    name: count
+                    for name, count in counts.row(0, named=True).items()
+                    if count
+                }
+            )
+        return df.with_columns(cast.alias(name) for name, cast in casts.items())
+
+
+def cast_from_string(expr: pl.Expr, dtype: pl.DataType) -> pl.Expr:
+    """Conversion d'un champ lu en texte, comme coerce_scalar : les valeurs qui ne
+    sont pas du type du champ ("oui" pour un booléen, "12.7" pour un entier)
+    deviennent nulles."""
+    if dtype == pl.Boolean:
+        value = expr.str.to_lowercase()
+        return pl.when(value.is_in(["true", "false"])).then(value == "true")
+    if dtype.is_integer():
+        # "12.0" -> 12
+        number = expr.cast(pl.Float64, strict=False)
+        return pl.when(number == number.floor()).then(number.cast(dtype, strict=False))
+    return expr.cast(dtype, strict=False)
+
+
+def coerce_nested_fields(marche: dict, listed_values: Counter, null_values: Counter):
+    """Mise en conformité des champs imbriqués d'un marché avec le schéma source.
+
+    json_normalize remplace sans erreur par null les listes et objets dont une
+    valeur n'est pas du type attendu. Une valeur unique à la place d'une liste
+    (ex : {"typePrix": "Forfaitaire"}) est mise en liste, les nombres en texte sont
+    convertis, et les autres valeurs d'un type inattendu (ex : "NC" dans le montant
+    d'une modification) sont remplacées par null. Les corrections sont comptées par
+    champ dans listed_values et null_values.
+    """
+    for path, dtype in get_nested_paths():
+        parent = marche
+        for key in path[:-1]:
+            parent = parent.get(key)
+            if not isinstance(parent, dict):
+                break
+        else:
+            if path[-1] in parent:
+                parent[path[-1]] = coerce_value(
+                    parent[path[-1]], dtype, ".".join(path), listed_values, null_values
+                )
+
+
+def coerce_value(
+    value, dtype: pl.DataType, path: str, listed_values: Counter, null_values: Counter
+):
+    if value is None:
+        return None
+
+    if isinstance(dtype, pl.List):
+        if not isinstance(value, list):
+            listed_values[path] += 1
+            value = [value]
+        return [
+            coerce_value(item, dtype.inner, path, listed_values, null_values)
+            for item in value
+        ]
+
+    if isinstance(dtype, pl.Struct):
+        if not isinstance(value, dict):
+            null_values[path] += 1
+            return None
+        return {
+            field.name: coerce_value(
+                value.get(field.name),
+                field.dtype,
+                f"{path}.{field.name}",
+                listed_values,
+                null_values,
+            )
+            for field in dtype.fields
+        }
+
+    try:
+        return coerce_scalar(value, dtype)
+    except (TypeError, ValueError):
+        null_values[path] += 1
+        return None
+
+
+def coerce_scalar(value, dtype: pl.DataType):
+    """Conversion d'une valeur JSON au type d'un champ, comme cast_from_string."""
+    if isinstance(value, (dict, list)):
+        raise TypeError(value)
+    if dtype == pl.String:
+        return value if isinstance(value, str) else str(value)
+    if dtype == pl.Boolean:
+        if isinstance(value, bool):
+            return value
+        if str(value).lower() not in ("true", "false"):
+            raise ValueError(value)
+        return str(value).lower() == "true"
+    if isinstance(value, bool):
+        raise TypeError(value)
+    if dtype.is_integer():
+        # "12.0" -> 12
+        number = float(value)
+        if not number.is_integer():
+            raise ValueError(value)
+        return int(number)
+    if dtype.is_float():
+        return float(value)
+    return value
+
+
+def flatten_keys(marche: dict, prefix: str = "") -> list:
+    """Noms des colonnes qu'aura un marché une fois aplati par json_normalize."""
+    keys = []
+    for key, value in marche.items():
+        if isinstance(value, dict) and len(value) > 0:
+            keys.extend(flatten_keys(value, f"{prefix}{key}_"))
+        else:
+            keys.append(f"{prefix}{key}")
+    return keys
 
 
 def get_stats():
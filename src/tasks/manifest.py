@@ -0,0 +1,107 @@
+import json
+import os
+import shutil
+
+from tasks.cache import file_sha1
+from config import (
+    DECP_MANIFEST_PATH,
+    DECP_SOURCE_SCHEMA_PATH,
+    DECP_DATE_RULES_PATH,
+    DIST_DIR,
+)
+
+# Le manifeste garde, d'un traitement à l'autre, l'empreinte de chaque fichier
+# source et celles des fichiers Parquet qui en sont dérivés (get/, clean/, et
+# merge/ et nested/ avec l'empreinte des lignes retenues, cf. tasks.uid_index).
+# Une source inchangée n'est pas traitée à nouveau, ses fichiers Parquet de la
+# précédente exécution sont réutilisés.
+#
+# {
+#     "pipeline": "<empreinte du code de traitement>",
+#     "sources": {
+#         "decp-2024": {
+#             "sha1": "<empreinte du fichier JSON>",
+#             "date_source": "<date de cette version, cf. tasks.get.get_source_date>",
+#             "get": {"path": "dist/.../get/decp-2024_....parquet", "sha1": "..."},
+#             "clean": {"path": "dist/.../clean/decp-2024_....parquet", "sha1": "..."}
+#         }
+#     }
+# }
+
+# Fichiers dont une modification invalide les fichiers déjà produits
+PIPELINE_FILES = [
+    "src/tasks/get.py",
+    "src/tasks/clean.py",
+    "src/tasks/transform.py",
+    "src/tasks/schema.py",
+    "src/tasks/uid_index.py",
+    DECP_SOURCE_SCHEMA_PATH,
+    DECP_DATE_RULES_PATH,
+]
+
+
+def pipeline_fingerprint() -> str:
+    return "-".join(file_sha1(path)[:12] for path in PIPELINE_FILES)
+
+
+def load_manifest() -> dict:
+    manifest = {"pipeline": pipeline_fingerprint(), "sources": {}}
+    if not os.path.exists(DECP_MANIFEST_PATH):
+        return manifest
+
+    with open(DECP_MANIFEST_PATH, encoding="utf8") as f:
+        previous_manifest = json.load(f)
+
+    if previous_manifest.get("pipeline") != manifest["pipeline"]:
+        print("Le code de traitement a changé, toutes les sources seront traitées")
+        return manifest
+
+    manifest["sources"] = previous_manifest.get("sources", {})
+    return manifest
+
+
+def save_manifest(manifest: dict):
+    os.makedirs(os.path.dirname(DECP_MANIFEST_PATH), exist_ok=True)
+    tmp_path = f"{DECP_MANIFEST_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, DECP_MANIFEST_PATH)
+
+
+def get_artifact(manifest: dict, source_name: str, source_sha1: str, step: str):
+    """Chemin (sans extension) du fichier {step} produit à partir de cette version
+    de la source, ou None s'il faut le produire à nouveau.
+
+    Le fichier est copié dans le DIST_DIR du jour s'il provient d'une exécution
+    précédente, et le manifeste pointe alors vers la copie : les dossiers
+    dist/<date> des exécutions précédentes peuvent être supprimés.
+    """
+    entry = manifest["sources"].get(source_name)
+    if entry is None or entry["sha1"] != source_sha1 or step not in entry:
+        return None
+
+    path = entry[step]["path"]
+    if not os.path.exists(f"{path}.parquet"):
+        return None
+    if file_sha1(f"{path}.parquet") != entry[step]["sha1"]:
+        print(f"[{source_name}] Le fichier {path}.parquet a été modifié")
+        return None
+
+    dist_path = f"{DIST_DIR}/{step}/{os.path.basename(path)}"
+    if path != dist_path:
+        os.makedirs(f"{DIST_DIR}/{step}", exist_ok=True)
+        shutil.copyfile(f"{path}.parquet", f"{dist_path}.parquet")
+        entry[step] = {**entry[step], "path": dist_path}
+
+    return dist_path
+
+
+def record_artifact(
+    manifest: dict, source_name: str, source_sha1: str, step: str, path: str
+):
+    entry = manifest["sources"].get(source_name)
+    if entry is None or entry["sha1"] != source_sha1:
+        entry = {"sha1": source_sha1}
+        manifest["sources"][source_name] = entry
+
+    entry[step] = {"path": path, "sha1": file_sha1(f"{path}.parquet")}
@@ -0,0 +1,225 @@
+from glob import glob
+
+import polars as pl
+
+from tasks.clean import normalize_dates
+from tasks.manifest import load_manifest
+from tasks.output import save_to_files, save_to_sqlite
+from tasks.surrogate_keys import add_surrogate_keys, load_surrogate_keys
+from config import DIST_DIR, DATE_NOW, DECP_SQLITE_SURROGATE_KEYS
+
+# Tables filles des champs imbriqués des marchés, gardés par la fusion dans
+# {DIST_DIR}/nested/ (une ligne par marché). Les listes sont explosées par Polars
+# (une ligne par élément), sans lecture ligne à ligne :
+#
+# - modifications, actes_sous_traitance, modifications_actes_sous_traitance :
+#   marche_uid | rang (position dans la liste) | champs de l'objet
+# - sous_traitants : id | typeIdentifiant
+# - marches_typesPrix, marches_considerationsSociales... : marche_uid | valeur
+
+# Table: (champ imbriqué, objet englobant de chaque élément)
+CHILD_TABLES = {
+    "modifications": ("modifications", "modification"),
+    "actes_sous_traitance": ("actesSousTraitance", "acteSousTraitance"),
+    "modifications_actes_sous_traitance": (
+        "modificationsActesSousTraitance",
+        "modificationActeSousTraitance",
+    ),
+}
+
+# Table: (champ imbriqué, nom de la colonne des valeurs)
+LINK_TABLES = {
+    "marches_typesPrix": ("typesPrix_typePrix", "typePrix"),
+    "marches_considerationsSociales": (
+        "considerationsSociales_considerationSociale",
+        "considerationSociale",
+    ),
+    "marches_considerationsEnvironnementales": (
+        "considerationsEnvironnementales_considerationEnvironnementale",
+        "considerationEnvironnementale",
+    ),
+    "marches_techniques": ("techniques_technique", "technique"),
+    "marches_modalitesExecution": (
+        "modalitesExecution_modaliteExecution",
+        "modaliteExecution",
+    ),
+}
+
+
+def scan_nested_fields():
+    """Champs imbriqués de tous les marchés, ou None s'il n'y en a pas.
+
+    Chaque uid n'apparaît que dans un fichier, celui de la ligne retenue pour le
+    marché par la fusion (cf. tasks.uid_index.latest_marches).
+    """
+    files = sorted(glob(f"{DIST_DIR}/nested/*.parquet"))
+    if not files:
+        return None
+
+    return pl.concat([pl.scan_parquet(file) for file in files], how="diagonal_relaxed")
+
+
+def latest_source_date() -> str:
+    """Date de la source la plus récente d'après le manifeste (cf.
+    tasks.get.get_source_date), borne des dates plausibles des tables filles."""
+    return max(
+        (
+            entry["date_source"]
+            for entry in load_manifest()["sources"].values()
+            if "date_source" in entry
+        ),
+        default=DATE_NOW,
+    )
+
+
+def extract_child_table(
+    df: pl.LazyFrame, column: str, item: str, date_source: str
+) -> pl.LazyFrame:
+    """Une ligne par élément de la liste column, une colonne par champ de l'objet
+    item. Les dates sont converties comme celles des marchés."""
+    df = (
+        df.select(
+            pl.col("uid").alias("marche_uid"),
+            pl.int_ranges(1, pl.col(column).list.len() + 1, dtype=pl.UInt32).alias(
+                "rang"
+            ),
+            column,
+        )
+        .explode(["rang", column])
+        .filter(pl.col(column).is_not_null())
+        .select("marche_uid", "rang", pl.col(column).struct.field(item))
+        .unnest(item)
+    )
+
+    columns = df.collect_schema()
+    if "sousTraitant" in columns:
+        df = df.with_columns(
+            pl.col("sousTraitant").struct.field("id").alias("sousTraitant_id"),
+            pl.col("sousTraitant")
+            .struct.field("typeIdentifiant")
+            .alias("sousTraitant_typeIdentifiant"),
+        ).drop("sousTraitant")
+
+    date_columns = [name for name in columns if name.startswith("date")]
+    return normalize_dates(df, date_columns, date_source).drop(
+        f"{name}_regle" for name in date_columns
+    )
+
+
+def extract_link_table(df: pl.LazyFrame, column: str, name: str) -> pl.LazyFrame:
+    """Une ligne par marché et par valeur distincte de la liste column."""
+    return (
+        df.select(pl.col("uid").alias("marche_uid"), pl.col(column).alias(name))
+        .explode(name)
+        .drop_nulls(name)
+        .unique(maintain_order=True)
+    )
+
+
+def make_nested_tables() -> dict:
+    """Tables filles des champs imbriqués, calculées ensemble par pl.collect_all.
+
+    Retourne {nom de la table: (dataframe, clé primaire)}.
+    """
+    df = scan_nested_fields()
+    if df is None:
+        print("Aucun champ imbriqué à extraire")
+        return {}
+
+    columns = df.collect_schema()
+    date_source = latest_source_date()
+    plans = {}
+    for table_name, (column, item) in CHILD_TABLES.items():
+        if column in columns:
+            plans[table_name] = (
+                extract_child_table(df, column, item, date_source),
+                "marche_uid, rang",
+            )
+
+    if "actes_sous_traitance" in plans:
+        # En premier : ses clés entières sont utilisées par actes_sous_traitance
+        plan_sous_traitants = (
+            plans["actes_sous_traitance"][0]
+            .select(
+                pl.col("sousTraitant_id").alias("id"),
+                pl.col("sousTraitant_typeIdentifiant").alias("typeIdentifiant"),
+            )
+            .drop_nulls("id")
+            .unique()
+            .sort("id", "typeIdentifiant")
+        )
+        plans = {
+            "sous_traitants": (plan_sous_traitants, "id, typeIdentifiant"),
+            **plans,
+        }
+
+    for table_name, (column, name) in LINK_TABLES.items():
+        if column in columns:
+            plans[table_name] = (
+                extract_link_table(df, column, name),
+                f'marche_uid, "{name}"',
+            )
+
+    results = pl.collect_all([plan for plan, _ in plans.values()])
+    return {
+        table_name: (df_table, primary_key)
+        for (table_name, (_, primary_key)), df_table in zip(plans.items(), results)
+    }
+
+
+def save_nested_tables(tables: dict, connection):
+    """Enregistrement des tables filles en Parquet ({DIST_DIR}/{table}.parquet) et
+    dans la base SQLite.
+
+    En mode DECP_SQLITE_SURROGATE_KEYS, les références aux marchés et aux
+    sous-traitants de la base SQLite sont des clés entières (marche_cle,
+    sousTraitant_cle), celles des fichiers Parquet restent les clés naturelles.
+    """
+    for table_name, (df_table, primary_key) in tables.items():
+        save_to_files(df_table, f"{DIST_DIR}/{table_name}", ["parquet"])
+
+        unique_key = None
+        if DECP_SQLITE_SURROGATE_KEYS:
+            df_table, primary_key, unique_key = sqlite_surrogate_keys(
+                df_table, table_name, primary_key
+            )
+        save_to_sqlite(
+            df_table, connection, table_name, primary_key, unique_key=unique_key
+        )
+
+
+def sqlite_surrogate_keys(df: pl.DataFrame, table_name: str, primary_key: str):
+    """Remplacement des clés naturelles par les clés entières de tasks.surrogate_keys.
+
+    Retourne (dataframe, clé primaire, clé unique).
+    """
+    if table_name == "sous_traitants":
+        df = add_surrogate_keys(df, "sous_traitants", ["id", "typeIdentifiant"])
+        return df.select("cle", "id", "typeIdentifiant"), "cle", primary_key
+
+    marches = load_surrogate_keys("marches", ["uid"])
+    df = df.join(
+        marches.select(
+            pl.col("uid").alias("marche_uid"), pl.col("cle").alias("marche_cle")
+        ),
+        on="marche_uid",
+        how="left",
+    )
+    df = df.select("marche_cle", pl.exclude("marche_uid", "marche_cle"))
+
+    if "sousTraitant_id" in df.columns:
+        sous_traitants = load_surrogate_keys(
+            "sous_traitants", ["id", "typeIdentifiant"]
+        )
+        df = df.join(
+            sous_traitants.select(
+                pl.col("id").alias("sousTraitant_id"),
+                pl.col("typeIdentifiant").alias("sousTraitant_typeIdentifiant"),
+                pl.col("cle").alias("sousTraitant_cle"),
+            ),
+            on=["sousTraitant_id", "sousTraitant_typeIdentifiant"],
+            how="left",
+            nulls_equal=True,
+        ).drop("sousTraitant_id", "sousTraitant_typeIdentifiant")
+
+    return df, primary_key.replace("marche_uid", "marche_cle"), None
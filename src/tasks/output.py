@@ -1,27 +1,388 @@
+import hashlib
+import json
 import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import os
+import shutil
 import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-from config import DIST_DIR
+from tasks.schema import sqlite_type
+from config import (
+    DIST_DIR,
+    DECP_PARQUET_OPTIMIZED,
+    DECP_PARQUET_PARTITION_BY_YEAR,
+    DECP_CSV_COMPRESSED_FORMATS,
+    DECP_CSV_SPLIT_BY_YEAR,
+)
+
+# Nombre de lignes insérées à la fois dans les tables SQLite
+SQLITE_BATCH_SIZE = 50000
+
+# Formats CSV compressés et algorithme de compression correspondant
+CSV_COMPRESSIONS = {"csv.gz": "gzip", "csv.zst": "zstd"}
+
+# Nombre de lignes lues à la fois pour les CSV par année
+CSV_BATCH_SIZE = 100000
+
+# Taille des blocs lus dans un CSV pour sa compression
+CSV_CHUNK_BYTES = 16 * 1024 * 1024
+
+# Tri des fichiers Parquet et nombre de lignes par groupe : plus les groupes sont
+# petits, plus les lecteurs peuvent en ignorer, mais plus les métadonnées sont lourdes
+PARQUET_SORT_COLUMNS = ["acheteur_id", "dateNotification"]
+PARQUET_ROW_GROUP_SIZE = 100000
+
+# Niveaux de compression zstd, plus élevés pour les colonnes de texte volumineuses
+PARQUET_ZSTD_LEVEL = 6
+PARQUET_ZSTD_LEVELS = {"objet": 12, "uid": 9, "id": 9, "idAccordCadre": 9}
+
+# Colonnes indexées (B-tree) dans toutes les tables SQLite qui les contiennent
+SQLITE_INDEXED_COLUMNS = [
+    "acheteur_id",
+    "titulaire_id",
+    "codeCPV",
+    "dateNotification",
+    "acheteur_cle",
+    "titulaire_cle",
+]
+
+# Réglages appliqués pendant le chargement des bases SQLite
+SQLITE_LOAD_PRAGMAS = [
+    "page_size = 65536",
+    "journal_mode = OFF",
+    "synchronous = OFF",
+    "cache_size = -262144",  # 256 Mo
+    "temp_store = MEMORY",
+    "locking_mode = EXCLUSIVE",
+]
 
 
 def save_to_files(df: pl.DataFrame, path: str, file_format=None):
+    """Écriture de df dans chaque format.
+
+    Avec DECP_PARQUET_OPTIMIZED, les lignes sont d'abord triées (cf.
+    write_optimized_parquet), dans le même ordre pour tous les formats.
+
+    Si df est un LazyFrame, son plan n'est exécuté qu'une fois, pour écrire le
+    fichier Parquet en premier : les autres formats sont ensuite écrits à partir de
+    ce fichier, sans le charger en mémoire. Le CSV n'est produit qu'une fois, puis
+    compressé dans chaque format CSV compressé (cf. write_csv_files), et les CSV
+    par année sont écrits en une lecture de df (cf. write_csv_by_year). Ces
+    écritures sont faites en parallèle, les writers Polars libèrent le GIL. Chaque
+    fichier n'apparaît qu'une fois complètement écrit.
+
+    Retourne le dataframe partagé par les writers : df, ou le scan du fichier
+    Parquet si df est un LazyFrame.
+    """
     if file_format is None:
-        file_format = ["csv", "parquet"]
-    if "csv" in file_format:
-        df.write_csv(f"{path}.csv")
-    if "parquet" in file_format:
-        df.write_parquet(f"{path}.parquet")
+        file_format = ["csv", "parquet"] + DECP_CSV_COMPRESSED_FORMATS
+
+    if DECP_CSV_SPLIT_BY_YEAR:
+        file_format = file_format + [
+            f"{format_name}_par_annee"
+            for format_name in file_format
+            if format_name.startswith("csv")
+        ]
+
+    if DECP_PARQUET_OPTIMIZED and "parquet" in file_format:
+        # Une seule fois, avant l'écriture de tous les formats
+        df = sort_for_parquet(df)
+
+    if isinstance(df, pl.LazyFrame) and "parquet" in file_format:
+        duration = write_file(df, path, "parquet")
+        print(f"{os.path.basename(path)}.parquet : {duration:.1f} s")
+        df = pl.scan_parquet(f"{path}.parquet")
+        file_format = [
+            format_name for format_name in file_format if format_name != "parquet"
+        ]
+
+    # Formats CSV écrits ensemble, et autres formats
+    writers = {}
+    csv_formats = [name for name in file_format if name in ["csv", *CSV_COMPRESSIONS]]
+    if csv_formats:
+        writers[", ".join(csv_formats)] = (write_csv_files, csv_formats)
+    year_formats = [
+        name.removesuffix("_par_annee")
+        for name in file_format
+        if name.endswith("_par_annee")
+    ]
+    if year_formats:
+        writers[", ".join(f"{name}_par_annee" for name in year_formats)] = (
+            write_csv_by_year,
+            year_formats,
+        )
+    for format_name in file_format:
+        if format_name not in csv_formats and not format_name.endswith("_par_annee"):
+            writers[format_name] = (write_file, format_name)
+
+    if not writers:
+        return df
+
+    with ThreadPoolExecutor(max_workers=len(writers)) as executor:
+        # Une copie (sans copie des données) par writer : certains writers
+        # empruntent le DataFrame en écriture, ce qui interdit l'accès simultané
+        futures = {
+            name: executor.submit(writer, df.clone(), path, formats)
+            for name, (writer, formats) in writers.items()
+        }
+        for name, future in futures.items():
+            duration = future.result()
+            print(f"{os.path.basename(path)} ({name}) : {duration:.1f} s")
+
+    return df
+
+
+def write_file(df: pl.DataFrame, path: str, file_format: str) -> float:
+    """Écriture dans un fichier temporaire puis renommage. Retourne la durée."""
+    start = time.perf_counter()
+    tmp_path = f"{path}.{file_format}.tmp"
+
+    # Les LazyFrame sont écrits en streaming, sans être chargés en mémoire
+    if file_format == "parquet" and DECP_PARQUET_OPTIMIZED:
+        write_optimized_parquet(df, tmp_path, f"{path}_par_annee")
+    elif file_format == "parquet":
+        if isinstance(df, pl.LazyFrame):
+            df.sink_parquet(tmp_path)
+        else:
+            df.write_parquet(tmp_path)
+    else:
+        raise ValueError(f"Format de fichier inconnu : {file_format}")
+
+    os.replace(tmp_path, f"{path}.{file_format}")
+    return time.perf_counter() - start
+
+
+def write_csv_files(df: pl.DataFrame, path: str, file_formats: list) -> float:
+    """Écriture de {path}.csv et de ses versions compressées ({path}.csv.gz...).
+
+    Le CSV n'est produit qu'une fois (en streaming pour un LazyFrame), puis
+    compressé dans chaque format. Il n'est gardé que si "csv" est dans
+    file_formats. Retourne la durée.
+    """
+    start = time.perf_counter()
+    for file_format in file_formats:
+        if file_format != "csv" and file_format not in CSV_COMPRESSIONS:
+            raise ValueError(f"Format de fichier inconnu : {file_format}")
+
+    if isinstance(df, pl.LazyFrame):
+        df.sink_csv(f"{path}.csv.tmp")
+    else:
+        df.write_csv(f"{path}.csv.tmp")
+    compress_csv(f"{path}.csv.tmp", path, file_formats)
+
+    if "csv" in file_formats:
+        os.replace(f"{path}.csv.tmp", f"{path}.csv")
+    else:
+        os.remove(f"{path}.csv.tmp")
+    return time.perf_counter() - start
+
+
+def compress_csv(csv_path: str, path: str, file_formats: list):
+    """Compression de csv_path dans chaque format CSV compressé de file_formats
+    ({path}.csv.gz, {path}.csv.zst), en une seule lecture par blocs de
+    CSV_CHUNK_BYTES."""
+    streams = {
+        file_format: pa.CompressedOutputStream(
+            f"{path}.{file_format}.tmp", CSV_COMPRESSIONS[file_format]
+        )
+        for file_format in file_formats
+        if file_format in CSV_COMPRESSIONS
+    }
+    try:
+        with open(csv_path, "rb") as f:
+            while chunk := f.read(CSV_CHUNK_BYTES):
+                for stream in streams.values():
+                    stream.write(chunk)
+    finally:
+        for stream in streams.values():
+            stream.close()
+
+    for file_format in streams:
+        os.replace(f"{path}.{file_format}.tmp", f"{path}.{file_format}")
+
+
+def write_csv_by_year(df: pl.DataFrame, path: str, file_formats: list) -> float:
+    """Un fichier CSV par année de notification et par format :
+    {path}_csv_par_annee/{nom}_2024.csv(.gz, .zst), {nom}_sans_date.csv...
+
+    df est lu une seule fois, par tranches de CSV_BATCH_SIZE lignes (slice d'un
+    LazyFrame, qui ne lit que ses groupes de lignes du fichier Parquet) : les lignes
+    de chaque tranche sont ajoutées au CSV de leur année, ouvert pendant toute la
+    lecture. Chaque CSV est ensuite compressé (cf. compress_csv). Retourne la
+    durée.
+    """
+    start = time.perf_counter()
+    directory = f"{path}_csv_par_annee"
+    os.makedirs(directory, exist_ok=True)
+    name = os.path.basename(path)
+
+    if isinstance(df, pl.LazyFrame):
+        height = df.select(pl.len()).collect().item()
+        batches = (
+            df.slice(offset, CSV_BATCH_SIZE).collect()
+            for offset in range(0, height, CSV_BATCH_SIZE)
+        )
+    else:
+        batches = df.iter_slices(CSV_BATCH_SIZE)
+
+    year_files = {}
+    try:
+        for batch in batches:
+            years = batch.select(pl.col("dateNotification").dt.year().alias("annee"))
+            for (year,), rows in (
+                batch.with_columns(years)
+                .partition_by("annee", as_dict=True, include_key=False)
+                .items()
+            ):
+                new_file = year not in year_files
+                if new_file:
+                    year_path = f"{directory}/{name}_{year or 'sans_date'}"
+                    year_files[year] = (year_path, open(f"{year_path}.csv.tmp", "wb"))
+                rows.write_csv(year_files[year][1], include_header=new_file)
+    finally:
+        for _, f in year_files.values():
+            f.close()
+
+    for year_path, _ in year_files.values():
+        compress_csv(f"{year_path}.csv.tmp", year_path, file_formats)
+        if "csv" in file_formats:
+            os.replace(f"{year_path}.csv.tmp", f"{year_path}.csv")
+        else:
+            os.remove(f"{year_path}.csv.tmp")
+    return time.perf_counter() - start
+
 
+def sort_for_parquet(df: pl.DataFrame) -> pl.DataFrame:
+    """Tri des lignes par acheteur puis date de notification (PARQUET_SORT_COLUMNS)."""
+    columns = df.collect_schema().names()
+    sort_columns = [column for column in PARQUET_SORT_COLUMNS if column in columns]
+    if not sort_columns:
+        return df
+    return df.sort(sort_columns, nulls_last=True)
 
-def save_to_sqlite(df: pl.DataFrame, database: str, table_name: str, primary_key: str):
-    # Création de la table, avec les définitions de colonnes et de la ou des clés primaires
+
+def write_optimized_parquet(df: pl.DataFrame, path: str, dataset_path: str):
+    """Écriture d'un fichier Parquet optimisé pour les requêtes distantes.
+
+    Les lignes, triées par acheteur puis date de notification (cf. save_to_files),
+    sont écrites par groupes avec statistiques (min, max) et index de pages : les
+    lecteurs (decp.info, DuckDB, Polars...) ne téléchargent que les groupes qui
+    correspondent à leurs filtres. Un seul groupe de lignes à la fois est converti
+    en Arrow. Un LazyFrame est d'abord écrit en streaming dans un fichier Arrow IPC
+    temporaire, lu ensuite sans copie en mémoire (memory map).
+
+    Avec DECP_PARQUET_PARTITION_BY_YEAR, un jeu de données partitionné par année de
+    notification (hive : {dataset_path}/annee=2024/part-0.parquet) est aussi écrit.
+    """
+    if isinstance(df, pl.LazyFrame):
+        df.sink_ipc(f"{path}.arrow", compression=None)
+        df = pl.read_ipc(f"{path}.arrow", memory_map=True)
+        os.remove(f"{path}.arrow")
+
+    schema = df.head(0).to_arrow().schema
+    options = dict(
+        compression="zstd",
+        compression_level={
+            column: PARQUET_ZSTD_LEVELS.get(column, PARQUET_ZSTD_LEVEL)
+            for column in schema.names
+        },
+        write_statistics=True,
+        write_page_index=True,
+    )
+    partition_by_year = (
+        DECP_PARQUET_PARTITION_BY_YEAR and "dateNotification" in schema.names
+    )
+    if partition_by_year:
+        shutil.rmtree(f"{dataset_path}.tmp", ignore_errors=True)
+
+    year_writers = {}
+    with pq.ParquetWriter(path, schema, **options) as writer:
+        for batch in df.iter_slices(PARQUET_ROW_GROUP_SIZE):
+            table = batch.to_arrow()
+            writer.write_table(table, row_group_size=PARQUET_ROW_GROUP_SIZE)
+            if partition_by_year:
+                write_year_partitions(
+                    table, f"{dataset_path}.tmp", year_writers, schema, options
+                )
+
+    for year_writer in year_writers.values():
+        year_writer.close()
+    if partition_by_year:
+        shutil.rmtree(dataset_path, ignore_errors=True)
+        os.makedirs(f"{dataset_path}.tmp", exist_ok=True)
+        os.replace(f"{dataset_path}.tmp", dataset_path)
+
+
+def write_year_partitions(
+    table: pa.Table, directory: str, year_writers: dict, schema, options: dict
+):
+    """Ajout des lignes de table au fichier de leur année de notification."""
+    years = pc.year(table["dateNotification"])
+    for year in pc.unique(years).to_pylist():
+        if year is None:
+            rows = table.filter(pc.is_null(years))
+            partition = "__HIVE_DEFAULT_PARTITION__"
+        else:
+            rows = table.filter(pc.equal(years, year))
+            partition = year
+        if partition not in year_writers:
+            os.makedirs(f"{directory}/annee={partition}", exist_ok=True)
+            year_writers[partition] = pq.ParquetWriter(
+                f"{directory}/annee={partition}/part-0.parquet", schema, **options
+            )
+        year_writers[partition].write_table(rows, row_group_size=PARQUET_ROW_GROUP_SIZE)
+
+
+@contextmanager
+def open_sqlite_database(database: str):
+    """Connexion à une base SQLite pour un chargement en masse.
+
+    Toutes les tables sont chargées dans une seule transaction, avec une
+    journalisation et une synchronisation désactivées : en cas d'erreur, la base
+    est à reconstruire. Les statistiques (ANALYZE) sont calculées et la base
+    compactée (VACUUM) à la fermeture.
+    """
+    connection = sqlite3.connect(f"{DIST_DIR}/{database}.sqlite", isolation_level=None)
+    for pragma in SQLITE_LOAD_PRAGMAS:
+        connection.execute(f"PRAGMA {pragma}")
+
+    connection.execute("BEGIN")
+    try:
+        yield connection
+    except Exception:
+        connection.execute("ROLLBACK")
+        connection.close()
+        raise
+
+    connection.execute("COMMIT")
+    print(f"Optimisation de la base {database}.sqlite...")
+    connection.execute("ANALYZE")
+    connection.execute("VACUUM")
+    connection.close()
+
+
+def save_to_sqlite(
+    df: pl.DataFrame,
+    connection: sqlite3.Connection,
+    table_name: str,
+    primary_key: str,
+    unique_key: str = None,
+):
+    # Création de la table, avec les définitions de colonnes. Une clé primaire
+    # entière (clé de substitution "cle") est un alias du rowid SQLite.
+    integer_primary_key = (
+        primary_key in df.columns and df.schema[primary_key].is_integer()
+    )
     column_definitions = []
     for column_name, column_type in zip(df.columns, df.dtypes):
-        sql_type = "TEXT"  # Default
-        if column_type in [pl.Int16, pl.Int64, pl.Boolean]:
-            sql_type = "INTEGER"
-        elif column_type in [pl.Float32, pl.Float64]:
-            sql_type = "REAL"
+        sql_type = sqlite_type(column_name, column_type)
+        if integer_primary_key and column_name == primary_key:
+            sql_type = "INTEGER PRIMARY KEY"
         column_definitions.append(f'"{column_name}" {sql_type}')
 
     if "." in primary_key and not '"' in primary_key:
@@ -29,69 +390,135 @@ def save_to_sqlite(df: pl.DataFrame, database: str, table_name: str, primary_key
             f"Les noms de colonnes contenant un point doivent être entre guillemets : {primary_key}"
         )
 
-    primary_key_definition = (
-        f"PRIMARY KEY({primary_key})"  # Peut être une clé composite. Ex : id, type
+    create_table_sql = (
+        f"CREATE TABLE \"{table_name}\" ({', '.join(column_definitions)})"
     )
-    create_table_sql = f"CREATE TABLE \"{table_name}\" ({', '.join(column_definitions)}, {primary_key_definition})"  # Add quotes
-
-    # Éxecution de la requête
-    connection = sqlite3.connect(f"{DIST_DIR}/{database}.sqlite")
-    cursor = connection.cursor()
-    cursor.execute(f'DROP TABLE IF EXISTS "{table_name}"')
-    cursor.execute(create_table_sql)
-    connection.commit()
-    connection.close()
 
-    df.write_database(
-        f'"{table_name}"',
-        f"sqlite:///{DIST_DIR}/{database}.sqlite",
-        if_table_exists="append",
-    )
+    connection.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+    connection.execute(create_table_sql)
 
+    # Chargement par lots Arrow, les dates sont enregistrées au format ISO (texte)
+    df = df.with_columns(pl.col(pl.Date, pl.Datetime).dt.to_string())
+    insert_sql = f"INSERT INTO \"{table_name}\" VALUES ({', '.join(['?'] * df.width)})"
+    for batch in df.to_arrow().to_batches(max_chunksize=SQLITE_BATCH_SIZE):
+        connection.executemany(
+            insert_sql, zip(*(column.to_pylist() for column in batch.columns))
+        )
+
+    # La ou les clés primaires (Ex : id, type) sont indexées une fois la table
+    # remplie, ce qui est plus rapide qu'à chaque insertion
+    if not integer_primary_key:
+        connection.execute(
+            f'CREATE UNIQUE INDEX "{table_name}_pk" ON "{table_name}" ({primary_key})'
+        )
+    if unique_key:
+        connection.execute(
+            f'CREATE UNIQUE INDEX "{table_name}_unique" ON "{table_name}" ({unique_key})'
+        )
+    for column in SQLITE_INDEXED_COLUMNS:
+        if column in df.columns:
+            connection.execute(
+                f'CREATE INDEX "{table_name}_{column}" ON "{table_name}" ("{column}")'
+            )
 
-def make_data_package():
-    from frictionless import Package, Resource, steps
 
-    common_steps = [
-        steps.field_update(name="id", descriptor={"type": "string"}),
-        steps.field_update(name="uid", descriptor={"type": "string"}),
-        steps.field_update(name="acheteur_id", descriptor={"type": "string"}),
-    ]
+def save_fts_index(
+    connection: sqlite3.Connection, table_name: str, key: str, column: str
+):
+    """Index de recherche plein texte (FTS5) sur une colonne de texte.
 
-    outputs = [
-        {
-            "csv": f"{DIST_DIR}/decp.csv",
-            "steps": common_steps
-            + [
-                steps.field_update(name="titulaire_id", descriptor={"type": "string"}),
-            ],
-        },
-        {
-            "csv": f"{DIST_DIR}/decp-sans-titulaires.csv",
-            "steps": common_steps,
-        },
-        # {
-        #     "csv": f"{DIST_DIR}/decp-titulaires.csv",
-        #     "steps": common_steps
-        #     + [
-        #         steps.field_update(name="departement", descriptor={"type": "string"}),
-        #         steps.field_update(name="titulaire_id", descriptor={"type": "string"}),
-        #     ],
-        # },
-    ]
+    La table virtuelle {table_name}_{column}_fts contient la clé (non indexée) et le
+    texte. Les accents sont ignorés : "marche" trouve "marché". Exemple :
+
+    SELECT m.* FROM marches m JOIN marches_objet_fts f ON f.uid = m.uid
+    WHERE marches_objet_fts MATCH 'travaux voirie'
+    """
+    fts_table = f"{table_name}_{column}_fts"
+    connection.execute(f'DROP TABLE IF EXISTS "{fts_table}"')
+    connection.execute(
+        f'CREATE VIRTUAL TABLE "{fts_table}" USING fts5("{key}" UNINDEXED, "{column}", '
+        f"tokenize = 'unicode61 remove_diacritics 2')"
+    )
+    connection.execute(
+        f'INSERT INTO "{fts_table}" ("{key}", "{column}") '
+        f'SELECT "{key}", "{column}" FROM "{table_name}" WHERE "{column}" IS NOT NULL'
+    )
+    connection.execute(
+        f'INSERT INTO "{fts_table}" ("{fts_table}") VALUES (\'optimize\')'
+    )
+
+
+def make_data_package(frames: dict, tableschema: dict):
+    """Création de {DIST_DIR}/datapackage.json pour les CSV {nom: dataframe}.
+
+    Les champs sont décrits par le TableSchema des DECP, ou à défaut d'après les
+    types Polars. Les tailles et empreintes des fichiers sont calculées en les
+    lisant par blocs, sans les analyser.
+    """
+    tableschema_fields = {field["name"]: field for field in tableschema["fields"]}
 
     resources = []
+    for name, df in frames.items():
+        path = f"{DIST_DIR}/{name}.csv"
+        file_hash, file_bytes = file_sha256(path)
+        fields = [
+            tableschema_fields.get(column)
+            or {"name": column, "type": tableschema_type(dtype)}
+            for column, dtype in df.schema.items()
+        ]
+        resources.append(
+            {
+                "name": name,
+                "path": f"{name}.csv",
+                "profile": "tabular-data-resource",
+                "scheme": "file",
+                "format": "csv",
+                "mediatype": "text/csv",
+                "encoding": "utf-8",
+                "bytes": file_bytes,
+                "hash": f"sha256:{file_hash}",
+                "schema": {"fields": fields},
+                "stats": {
+                    "hash": file_hash,
+                    "bytes": file_bytes,
+                    "fields": df.width,
+                    "rows": df.height,
+                },
+            }
+        )
+
+    data_package = {
+        "name": "decp",
+        "title": "DECP tabulaire",
+        "description": "Données essentielles de la commande publique (FR) au format tabulaire v2.",
+        "profile": "tabular-data-package",
+        "resources": resources,
+    }
+    with open(f"{DIST_DIR}/datapackage.json.tmp", "w", encoding="utf8") as f:
+        json.dump(data_package, f, indent=2, ensure_ascii=False)
+    os.replace(f"{DIST_DIR}/datapackage.json.tmp", f"{DIST_DIR}/datapackage.json")
+
 
-    for output in outputs:
-        resource: Resource = Resource(path=output["csv"])
+def tableschema_type(dtype: pl.DataType) -> str:
+    if dtype.is_integer():
+        return "integer"
+    if dtype.is_float():
+        return "number"
+    if dtype == pl.Boolean:
+        return "boolean"
+    if dtype == pl.Date:
+        return "date"
+    if dtype == pl.Datetime:
+        return "datetime"
+    return "string"
 
-        # Cette méthode détecte les caractéristiques du CSV et tente de deviner les datatypes
-        resources.append(Resource.transform(steps=output["steps"], resource=resource))
 
-    Package(
-        name="decp",
-        title="DECP tabulaire",
-        description="Données essentielles de la commande publique (FR) au format tabulaire v2.",
-        resources=resources,
-        # it's possible to provide all the official properties like homepage, version, etc
-    ).to_json(f"{DIST_DIR}/datapackage.json")
+def file_sha256(path: str) -> tuple:
+    """Empreinte sha256 et taille d'un fichier, lu par blocs."""
+    file_hash = hashlib.sha256()
+    file_bytes = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            file_hash.update(chunk)
+            file_bytes += len(chunk)
+    return file_hash.hexdigest(), file_bytes
@@ -1,7 +1,7 @@
 from httpx import post
 import json
 from os import getenv
-from config import DIST_DIR
+from config import DIST_DIR, DATAGOUVFR_API
 
 from jedi.api import project
 
@@ -28,7 +28,7 @@ def publish_to_datagouv(context: str):
         ],
     }
     api_key = getenv("DATAGOUVFR_API_KEY")
-    api = "https://www.data.gouv.fr/api/1"
+    api = DATAGOUVFR_API
     dataset_id = "608c055b35eb4e6ee20eb325"
 
     uploads = [
@@ -0,0 +1,128 @@
+import json
+from functools import lru_cache
+
+import polars as pl
+
+from config import DECP_SOURCE_SCHEMA_PATH
+
+# Schéma déclaratif des DECP 2022 sources (data/schema_source_decp_2022.json) :
+# pour chaque champ, son chemin dans le JSON ("acheteur.id"), son nom une fois
+# aplati ("acheteur_id") et son type Polars cible. Les types sont appliqués dès la
+# lecture du JSON, ce qui garantit les mêmes types pour tous les fichiers source.
+#
+# Les colonnes à faible cardinalité (nature, procédure, etc.) sont de type
+# Categorical : chaque valeur distincte n'est stockée qu'une fois en mémoire et les
+# fichiers Parquet utilisent un encodage par dictionnaire. Les "derivedFields" sont
+# des colonnes ajoutées pendant le traitement (titulaire_typeIdentifiant,
+# source_open_data), absentes du JSON.
+
+SQLITE_TYPES = {
+    pl.Int8: "INTEGER",
+    pl.Int16: "INTEGER",
+    pl.Int32: "INTEGER",
+    pl.Int64: "INTEGER",
+    pl.UInt8: "INTEGER",
+    pl.UInt16: "INTEGER",
+    pl.UInt32: "INTEGER",
+    pl.UInt64: "INTEGER",
+    pl.Boolean: "INTEGER",
+    pl.Float32: "REAL",
+    pl.Float64: "REAL",
+}
+
+
+def parse_dtype(spec) -> pl.DataType:
+    """Conversion d'un type du schéma ("Int16", {"List": ...}, {"Struct": {...}})
+    en type Polars."""
+    if isinstance(spec, str):
+        return getattr(pl, spec)()
+    if "List" in spec:
+        return pl.List(parse_dtype(spec["List"]))
+    if "Struct" in spec:
+        return pl.Struct(
+            {name: parse_dtype(field) for name, field in spec["Struct"].items()}
+        )
+    raise ValueError(f"Type inconnu dans le schéma source : {spec}")
+
+
+@lru_cache
+def load_source_schema() -> dict:
+    with open(DECP_SOURCE_SCHEMA_PATH, encoding="utf8") as f:
+        schema = json.load(f)
+
+    for field in schema["fields"] + schema.get("derivedFields", []):
+        field["dtype"] = parse_dtype(field["type"])
+
+    print(f"Schéma source {schema['name']} v{schema['version']}")
+    return schema
+
+
+def get_target_dtypes() -> dict:
+    """Types cibles des colonnes aplaties, après nettoyage."""
+    schema = load_source_schema()
+    return {
+        field["name"]: field["dtype"]
+        for field in schema["fields"] + schema.get("derivedFields", [])
+    }
+
+
+def get_ingest_schema() -> dict:
+    """Types des colonnes à la lecture du JSON.
+
+    Les dates n'existent pas en JSON, elles sont lues en texte puis converties
+    pendant le nettoyage, comme les colonnes Categorical.
+    """
+    return {
+        field["name"]: (
+            pl.String if field["dtype"] in (pl.Date, pl.Categorical) else field["dtype"]
+        )
+        for field in load_source_schema()["fields"]
+    }
+
+
+def get_nested_fields() -> list:
+    """Champs imbriqués (listes) extraits dans des tables filles (cf. tasks.nested).
+
+    Les titulaires, aussi imbriqués, sont extraits pendant le nettoyage.
+    """
+    return [
+        field["name"]
+        for field in load_source_schema()["fields"]
+        if field["dtype"].is_nested() and field["name"] != "titulaires"
+    ]
+
+
+@lru_cache
+def get_nested_paths() -> list:
+    """Chemins dans le JSON (["typesPrix", "typePrix"]) et types des champs
+    imbriqués (listes), titulaires compris."""
+    return [
+        (field["path"].split("."), field["dtype"])
+        for field in load_source_schema()["fields"]
+        if field["dtype"].is_nested()
+    ]
+
+
+def get_ignored_fields() -> list:
+    return [field["name"] for field in load_source_schema()["ignoredFields"]]
+
+
+def find_unknown_fields(columns) -> list:
+    """Colonnes aplaties qui ne sont ni décrites ni ignorées par le schéma."""
+    known_fields = get_target_dtypes()
+    ignored_fields = get_ignored_fields()
+    return sorted(
+        column
+        for column in columns
+        if column not in known_fields
+        and not any(
+            column == ignored or column.startswith(f"{ignored}_")
+            for ignored in ignored_fields
+        )
+    )
+
+
+def sqlite_type(column_name: str, dtype: pl.DataType) -> str:
+    """Type SQLite d'une colonne, d'après le schéma source s'il la décrit."""
+    dtype = get_target_dtypes().get(column_name, dtype)
+    return SQLITE_TYPES.get(dtype.base_type(), "TEXT")
@@ -0,0 +1,130 @@
+import json
+import os
+
+import polars as pl
+
+from config import (
+    SIRENE_ETABLISSEMENTS_PATH,
+    SIRENE_UNITES_LEGALES_PATH,
+    DECP_SIRENE_STORE_DIR,
+)
+
+# Copie locale des fichiers stock SIRENE utilisée par l'enrichissement
+# (tasks.enrich) : un fichier Parquet par stock, avec les seules colonnes utilisées,
+# trié par SIRET ou SIREN et découpé en groupes de lignes avec statistiques (min,
+# max). Une recherche de SIRET ne lit que les groupes qui peuvent les contenir.
+#
+# {DECP_SIRENE_STORE_DIR}/store.json garde, pour chaque stock, la taille et la date
+# de modification du CSV dont il est issu : la copie n'est refaite que lorsqu'un
+# nouveau stock est fourni (chaque mois).
+
+SIRENE_ROW_GROUP_SIZE = 100000
+
+# Stock: (clé de tri, colonnes gardées)
+SIRENE_STORES = {
+    "etablissements": (
+        "siret",
+        [
+            "siret",
+            "siren",
+            "enseigne1Etablissement",
+            "longitude",
+            "latitude",
+            "activitePrincipaleEtablissement",
+            "codeCommuneEtablissement",
+            "etatAdministratifEtablissement",
+        ],
+    ),
+    "unites_legales": (
+        "siren",
+        [
+            "siren",
+            "denominationUniteLegale",
+            "categorieEntreprise",
+            "etatAdministratifUniteLegale",
+            "economieSocialeSolidaireUniteLegale",
+            "categorieJuridiqueUniteLegale",
+        ],
+    ),
+}
+
+
+def source_paths() -> dict:
+    return {
+        "etablissements": SIRENE_ETABLISSEMENTS_PATH,
+        "unites_legales": SIRENE_UNITES_LEGALES_PATH,
+    }
+
+
+def store_path(name: str) -> str:
+    return f"{DECP_SIRENE_STORE_DIR}/{name}.parquet"
+
+
+def load_store_index() -> dict:
+    path = f"{DECP_SIRENE_STORE_DIR}/store.json"
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf8") as f:
+        return json.load(f)
+
+
+def save_store_index(index: dict):
+    path = f"{DECP_SIRENE_STORE_DIR}/store.json"
+    with open(f"{path}.tmp", "w", encoding="utf8") as f:
+        json.dump(index, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def source_fingerprint(name: str) -> dict:
+    """Identification d'un stock sans le relire : chemin, taille, date de
+    modification, et colonnes gardées."""
+    path = source_paths()[name]
+    stat = os.stat(path)
+    return {
+        "path": os.path.abspath(path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "columns": SIRENE_STORES[name][1],
+    }
+
+
+def build_store(name: str):
+    """Conversion d'un stock CSV en Parquet trié."""
+    key, columns = SIRENE_STORES[name]
+    path = store_path(name)
+
+    # Tout en texte : les identifiants (SIRET, SIREN, codes) gardent leurs zéros
+    df = pl.scan_csv(source_paths()[name], infer_schema=False).select(columns)
+    if "longitude" in columns:
+        df = df.with_columns(
+            pl.col("longitude", "latitude").cast(pl.Float64, strict=False)
+        )
+
+    df.sort(key).sink_parquet(
+        f"{path}.tmp",
+        compression="zstd",
+        statistics=True,
+        row_group_size=SIRENE_ROW_GROUP_SIZE,
+    )
+    os.replace(f"{path}.tmp", path)
+
+
+def update_sirene_store():
+    """Création ou mise à jour de la copie locale des stocks qui ont changé."""
+    os.makedirs(DECP_SIRENE_STORE_DIR, exist_ok=True)
+    index = load_store_index()
+
+    for name in SIRENE_STORES:
+        fingerprint = source_fingerprint(name)
+        if index.get(name) == fingerprint and os.path.exists(store_path(name)):
+            print(f"Stock SIRENE {name} inchangé, copie locale utilisée")
+            continue
+
+        print(f"Conversion du stock SIRENE {name} en Parquet...")
+        build_store(name)
+        index[name] = fingerprint
+        save_store_index(index)
+
+
+def scan_sirene_store(name: str, columns: list) -> pl.LazyFrame:
+    return pl.scan_parquet(store_path(name)).select(columns)
@@ -0,0 +1,56 @@
+import os
+
+import polars as pl
+
+from config import DECP_SURROGATE_KEYS_DIR
+
+# Clés entières (colonne "cle") des tables normalisées de datalab.sqlite. La
+# correspondance entre clé naturelle (uid, id d'acheteur, id + typeIdentifiant
+# d'entreprise) et clé entière est enregistrée dans
+# {DECP_SURROGATE_KEYS_DIR}/{table}.parquet : une clé attribuée ne change plus d'un
+# traitement à l'autre, les nouvelles valeurs reçoivent les clés suivantes.
+
+
+def load_surrogate_keys(table_name: str, natural_key: list) -> pl.DataFrame:
+    path = f"{DECP_SURROGATE_KEYS_DIR}/{table_name}.parquet"
+    if not os.path.exists(path):
+        return pl.DataFrame(
+            schema={**{column: pl.String for column in natural_key}, "cle": pl.Int64}
+        )
+    return pl.read_parquet(path)
+
+
+def save_surrogate_keys(table_name: str, keys: pl.DataFrame):
+    os.makedirs(DECP_SURROGATE_KEYS_DIR, exist_ok=True)
+    path = f"{DECP_SURROGATE_KEYS_DIR}/{table_name}.parquet"
+    keys.write_parquet(f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+
+def add_surrogate_keys(df: pl.DataFrame, table_name: str, natural_key: list):
+    """Ajout de la colonne "cle" à df, d'après sa clé naturelle.
+
+    Les clés des valeurs encore inconnues sont attribuées dans l'ordre de la clé
+    naturelle, puis enregistrées.
+    """
+    df = df.with_columns(pl.col(natural_key).cast(pl.String))
+    keys = load_surrogate_keys(table_name, natural_key)
+
+    new_keys = (
+        df.select(natural_key)
+        .unique()
+        .join(keys, on=natural_key, how="anti", nulls_equal=True)
+        .sort(natural_key, nulls_last=True)
+    )
+    if new_keys.height > 0:
+        next_key = (keys["cle"].max() or 0) + 1
+        new_keys = new_keys.with_columns(
+            pl.int_range(next_key, next_key + new_keys.height, dtype=pl.Int64).alias(
+                "cle"
+            )
+        )
+        keys = pl.concat([keys, new_keys])
+        save_surrogate_keys(table_name, keys)
+        print(f"{new_keys.height} nouvelles clés ({table_name})")
+
+    return df.join(keys, on=natural_key, how="left", nulls_equal=True)
@@ -0,0 +1,84 @@
+import json
+import os
+from functools import lru_cache
+
+import httpx
+
+from tasks.cache import file_sha1
+from config import (
+    DECP_TABLESCHEMA_PATH,
+    DECP_TABLESCHEMA_URL,
+    DECP_TABLESCHEMA_REFRESH,
+)
+
+# Le TableSchema des DECP tabulaires (https://github.com/ColinMaudry/decp-table-schema)
+# est conservé dans le dépôt (DECP_TABLESCHEMA_PATH). Le fichier .lock.json qui
+# l'accompagne en garde l'origine et l'empreinte :
+#
+# {"url": "...", "version": "...", "sha1": "<empreinte du schéma>"}
+#
+# "url" et "version" ne sont renseignés que pour un schéma téléchargé (cf.
+# refresh_tableschema). Sinon (null), la copie locale est un schéma provisoire :
+# les colonnes produites par le traitement et leurs types, sans contraintes.
+#
+# Le schéma n'est téléchargé à nouveau qu'avec DECP_TABLESCHEMA_REFRESH. Il n'est lu
+# qu'une fois par exécution : la sélection des colonnes, la validation et le data
+# package utilisent la même version.
+
+
+def lock_path() -> str:
+    return f"{os.path.splitext(DECP_TABLESCHEMA_PATH)[0]}.lock.json"
+
+
+def write_json(path: str, content: dict):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf8") as f:
+        json.dump(content, f, indent=2, ensure_ascii=False)
+        f.write("\n")
+    os.replace(tmp_path, path)
+
+
+def refresh_tableschema(url: str = DECP_TABLESCHEMA_URL):
+    """Téléchargement du TableSchema et mise à jour de la copie locale."""
+    tableschema = httpx.get(url, follow_redirects=True).raise_for_status().json()
+    if not tableschema.get("fields"):
+        raise ValueError(f"Le TableSchema {url} n'a pas de champs")
+
+    write_json(DECP_TABLESCHEMA_PATH, tableschema)
+    lock = {
+        "url": url,
+        "version": tableschema.get("version"),
+        "sha1": file_sha1(DECP_TABLESCHEMA_PATH),
+    }
+    write_json(lock_path(), lock)
+    print(f"TableSchema mis à jour (version {lock['version']}, {lock['sha1'][:12]})")
+
+
+@lru_cache
+def get_tableschema() -> dict:
+    """TableSchema des DECP tabulaires, lu une fois par exécution.
+
+    Le fichier local doit correspondre à l'empreinte du .lock.json. Un schéma
+    provisoire (sans url d'origine) est signalé.
+    """
+    if DECP_TABLESCHEMA_REFRESH:
+        try:
+            refresh_tableschema()
+        except httpx.HTTPError as error:
+            print(f"TableSchema non mis à jour, copie locale utilisée ({error})")
+
+    with open(lock_path(), encoding="utf8") as f:
+        lock = json.load(f)
+    if file_sha1(DECP_TABLESCHEMA_PATH) != lock["sha1"]:
+        raise ValueError(
+            f"{DECP_TABLESCHEMA_PATH} ne correspond pas à l'empreinte de {lock_path()}"
+        )
+
+    if lock["url"] is None:
+        print(
+            f"{DECP_TABLESCHEMA_PATH} est un TableSchema provisoire, pas le schéma "
+            "publié : lancer le traitement avec DECP_TABLESCHEMA_REFRESH=True"
+        )
+
+    with open(DECP_TABLESCHEMA_PATH, encoding="utf8") as f:
+        return json.load(f)
@@ -1,17 +1,219 @@
-from tableschema import Table
-from config import DIST_DIR
+import polars as pl
 
+from config import DIST_DIR, DECP_VALIDATION_SHARDS
 
-def validate_decp_against_tableschema():
-    table = Table(
-        f"{DIST_DIR}/decp.csv",
-        schema="https://raw.githubusercontent.com/ColinMaudry/decp-table-schema/main/schema.json",
+# Validation des DECP avec le TableSchema : chaque contrainte des champs (type,
+# required, pattern, enum, minimum, maximum, minLength, maxLength, unique) est
+# traduite en une expression Polars qui vaut True pour les valeurs en erreur.
+# Toutes les expressions sont évaluées en une seule lecture du fichier Parquet.
+
+# Nombre d'uid donnés en exemple pour chaque règle en erreur
+SAMPLE_SIZE = 5
+
+TABLESCHEMA_TYPES = {
+    "string": pl.String,
+    "integer": pl.Int64,
+    "number": pl.Float64,
+    "boolean": pl.Boolean,
+    "date": pl.Date,
+    "datetime": pl.Datetime,
+}
+
+REPORT_SCHEMA = {
+    "field": pl.String,
+    "rule": pl.String,
+    "errors": pl.UInt32,
+    "uids": pl.List(pl.String),
+}
+
+
+def type_error(column: str, dtype: pl.DataType, field_type: str):
+    """Valeurs qui ne sont pas du type du champ, ou None si tout le type convient."""
+    target = TABLESCHEMA_TYPES.get(field_type)
+    value = pl.col(column)
+
+    if target is None or target == pl.String or dtype == target:
+        return None
+    if dtype.is_integer() and target in (pl.Int64, pl.Float64):
+        return None
+    if dtype.is_float() and target == pl.Int64:
+        return value != value.floor()
+
+    if dtype in (pl.String, pl.Categorical):
+        value = value.cast(pl.String)
+        if target == pl.Boolean:
+            parsed = pl.when(value.str.to_lowercase().is_in(["true", "false"])).then(
+                True
+            )
+        elif target == pl.Date:
+            parsed = value.str.to_date("%Y-%m-%d", strict=False)
+        elif target == pl.Datetime:
+            parsed = value.str.to_datetime(strict=False)
+        else:
+            parsed = value.cast(target, strict=False)
+        return value.is_not_null() & parsed.is_null()
+
+    # Types incompatibles (ex : booléen au lieu de date)
+    return value.is_not_null()
+
+
+def literal(value, dtype: pl.DataType):
+    """Valeur d'une contrainte (minimum, maximum) au type de la colonne."""
+    if dtype == pl.Date and isinstance(value, str):
+        return pl.lit(value).str.to_date("%Y-%m-%d")
+    return pl.lit(value)
+
+
+def is_valid_regex(pattern: str) -> bool:
+    try:
+        pl.select(pl.lit("").str.contains(pattern))
+        return True
+    except pl.exceptions.ComputeError:
+        return False
+
+
+def compile_tableschema(tableschema: dict, schema: pl.Schema) -> list:
+    """Règles du TableSchema applicables aux colonnes de schema.
+
+    Retourne une liste de (champ, règle, expression d'erreur, règle par ligne). Les
+    règles qui ne sont pas "par ligne" (unique) portent sur toutes les lignes, celles
+    des champs absents n'ont pas d'expression.
+    """
+    rules = []
+    for field in tableschema["fields"]:
+        name = field["name"]
+        if name not in schema:
+            rules.append((name, "absent", None, False))
+            continue
+
+        dtype = schema[name]
+        value = pl.col(name)
+        text = value.cast(pl.String)
+        constraints = field.get("constraints", {})
+
+        error = type_error(name, dtype, field.get("type", "string"))
+        if error is not None:
+            rules.append((name, f"type:{field['type']}", error, True))
+
+        if constraints.get("required"):
+            missing = value.is_null()
+            if dtype in (pl.String, pl.Categorical):
+                missing = missing | (text == "")
+            rules.append((name, "required", missing, True))
+
+        if "pattern" in constraints:
+            pattern = f"^(?:{constraints['pattern']})$"
+            if is_valid_regex(pattern):
+                rules.append(
+                    (name, "pattern", ~text.str.contains(pattern).fill_null(True), True)
+                )
+            else:
+                print(f"Motif non pris en charge ({name}) : {constraints['pattern']}")
+
+        if "enum" in constraints:
+            enum = [str(item) for item in constraints["enum"]]
+            rules.append((name, "enum", value.is_not_null() & ~text.is_in(enum), True))
+
+        for rule, operator in [("minimum", "lt"), ("maximum", "gt")]:
+            if rule in constraints and (dtype.is_numeric() or dtype == pl.Date):
+                bound = literal(constraints[rule], dtype)
+                rules.append(
+                    (name, rule, getattr(value, operator)(bound).fill_null(False), True)
+                )
+
+        for rule, operator in [("minLength", "lt"), ("maxLength", "gt")]:
+            if rule in constraints:
+                length = text.str.len_chars()
+                rules.append(
+                    (
+                        name,
+                        rule,
+                        getattr(length, operator)(constraints[rule]).fill_null(False),
+                        True,
+                    )
+                )
+
+        if constraints.get("unique"):
+            rules.append(
+                (name, "unique", value.is_not_null() & value.is_duplicated(), False)
+            )
+
+    return rules
+
+
+def count_errors(df: pl.LazyFrame, rules: list) -> pl.LazyFrame:
+    """Nombre d'erreurs et exemples d'uid pour chaque règle, en une seule lecture."""
+    uid = pl.col("uid").cast(pl.String)
+    return df.select(
+        pl.struct(
+            errors=error.sum().cast(pl.UInt32),
+            uids=uid.filter(error).head(SAMPLE_SIZE).implode(),
+        ).alias(str(i))
+        for i, (_, _, error, _) in enumerate(rules)
     )
 
-    errors = []
 
-    def exc_handler(exc, row_number=None, row_data=None, error_data=None):
-        errors.append((exc.errors, f"row {row_number}", error_data))
+def validate_decp_against_tableschema(df: pl.DataFrame, tableschema: dict):
+    """Validation des DECP, colonnes du TableSchema ajoutées (cf.
+    setup_tableschema_columns), et rapport des erreurs par champ et par règle
+    ({DIST_DIR}/validation.json et validation.parquet).
+
+    Avec DECP_VALIDATION_SHARDS > 1, les lignes sont découpées en autant de tranches
+    évaluées en parallèle.
+    """
+    df = df.lazy()
+    rules = compile_tableschema(tableschema, df.collect_schema())
+
+    # Les règles par ligne sont évaluées sur chaque tranche, les autres sur le tout
+    row_rules = [i for i, rule in enumerate(rules) if rule[3]]
+    table_rules = [
+        i for i, rule in enumerate(rules) if rule[2] is not None and not rule[3]
+    ]
+
+    height = df.select(pl.len()).collect().item()
+    shard_size = -(-height // max(1, DECP_VALIDATION_SHARDS)) or 1
+    plans = [
+        count_errors(df.slice(offset, shard_size), [rules[i] for i in row_rules])
+        for offset in range(0, max(height, 1), shard_size)
+    ]
+    plans.append(count_errors(df, [rules[i] for i in table_rules]))
+    results = pl.collect_all(plans)
+
+    report = []
+    for indices, shard_results in [
+        (row_rules, results[:-1]),
+        (table_rules, results[-1:]),
+    ]:
+        for position, i in enumerate(indices):
+            counts = [result[str(position)][0] for result in shard_results]
+            report.append(
+                {
+                    "field": rules[i][0],
+                    "rule": rules[i][1],
+                    "errors": sum(count["errors"] for count in counts),
+                    "uids": [uid for count in counts for uid in count["uids"]][
+                        :SAMPLE_SIZE
+                    ],
+                }
+            )
+
+    # Un champ absent est en erreur pour toutes les lignes
+    report.extend(
+        {"field": name, "rule": rule, "errors": height, "uids": []}
+        for name, rule, error, _ in rules
+        if error is None
+    )
+
+    report = (
+        pl.DataFrame(report, schema=REPORT_SCHEMA)
+        .filter(pl.col("errors") > 0)
+        .sort(["errors", "field"], descending=[True, False])
+    )
+    report.write_parquet(f"{DIST_DIR}/validation.parquet")
+    report.write_json(f"{DIST_DIR}/validation.json")
+
+    print(f"Erreurs de validation : {report['errors'].sum()}")
+    for field, rule, errors, uids in report.head(20).iter_rows():
+        print(f"-- {field} ({rule}) : {errors} erreurs, ex. {', '.join(uids)}")
 
-    table.read(exc_handler=exc_handler)
-    print(f"Erreurs de validation : {len(errors)}")
+    return report
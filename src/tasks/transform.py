@@ -1,7 +1,31 @@
+import os
+from glob import glob
+
 import polars as pl
-from httpx import get
 
-from tasks.output import save_to_sqlite
+from tasks.output import save_to_sqlite, save_fts_index
+from tasks.surrogate_keys import add_surrogate_keys
+from tasks.manifest import get_artifact, record_artifact
+from tasks.uid_index import (
+    UID_INDEX_KEYS,
+    update_uid_index,
+    latest_marches,
+    load_latest_marches,
+    count_indexed_rows,
+    rows_fingerprint,
+    source_version,
+)
+from tasks.tableschema import get_tableschema
+from tasks.schema import get_nested_fields
+from config import (
+    DIST_DIR,
+    DECP_SQLITE_FTS,
+    DECP_SQLITE_SURROGATE_KEYS,
+    DECP_CHECK_SANS_TITULAIRES,
+)
+
+# Libellés des catégories juridiques (colonnes Code, Libellé)
+CATEGORIES_JURIDIQUES_PATH = "data/cj.csv"
 
 
 def explode_titulaires(df: pl.DataFrame):
@@ -45,76 +69,146 @@ def explode_titulaires(df: pl.DataFrame):
     return df
 
 
-def normalize_tables(df):
-    # MARCHES
+def make_normalized_tables(df: pl.LazyFrame) -> dict:
+    """Calcul des tables normalisées de datalab.sqlite.
 
-    df_marches: pl.DataFrame = pl.DataFrame(df.to_arrow()).drop(
-        "titulaire_id", "titulaire_typeIdentifiant"
-    )
-    df_marches = df_marches.unique("uid").sort(
-        by="datePublicationDonnees", descending=True
-    )
-    save_to_sqlite(df_marches, "datalab", "marches", "uid")
-    del df_marches
+    Les plans des quatre tables partagent la lecture de df et sont exécutés ensemble,
+    en parallèle, par pl.collect_all. df peut être un scan_parquet de decp.parquet.
 
-    # ACHETEURS
+    En mode DECP_SQLITE_SURROGATE_KEYS, chaque table a pour clé primaire une clé
+    entière "cle" (cf. tasks.surrogate_keys), sa clé naturelle reste unique, et les
+    références entre tables sont des clés entières (acheteur_cle, marche_cle,
+    titulaire_cle).
 
-    df_acheteurs: pl.DataFrame = df.select("acheteur_id")
-    df_acheteurs = df_acheteurs.rename({"acheteur_id": "id"})
-    df_acheteurs = df_acheteurs.unique().sort(by="id")
-    save_to_sqlite(df_acheteurs, "datalab", "acheteurs", "id")
-    del df_acheteurs
+    Retourne {nom de la table: (dataframe, clé primaire, clé unique)}.
+    """
+    df = df.lazy()
 
-    # TITULAIRES
+    # ACHETEURS
+    plan_acheteurs = df.select(pl.col("acheteur_id").alias("id")).unique().sort(by="id")
 
+    # TITULAIRES
     ## Table entreprises
-    df_titulaires: pl.DataFrame = df.select("titulaire_id", "titulaire_typeIdentifiant")
-
     ### On garde les champs id et typeIdentifiant en clé primaire composite
-    df_titulaires = df_titulaires.rename(
-        {"titulaire_id": "id", "titulaire_typeIdentifiant": "typeIdentifiant"}
+    plan_titulaires = (
+        df.select(
+            pl.col("titulaire_id").alias("id"),
+            pl.col("titulaire_typeIdentifiant").alias("typeIdentifiant"),
+        )
+        .unique()
+        .sort(by=["id"])
+    )
+
+    # MARCHES
+    ## La version retenue de chaque marché par la fusion est gardée
+    plan_marches = select_latest_marches(df).drop(
+        "titulaire_id", "titulaire_typeIdentifiant"
     )
-    df_titulaires = df_titulaires.unique().sort(by=["id"])
-    save_to_sqlite(df_titulaires, "datalab", "entreprises", "id, typeIdentifiant")
-    del df_titulaires
 
     ## Table marches_titulaires
-    df_marches_titulaires: pl.DataFrame = df.select(
+    plan_marches_titulaires = df.select(
         "uid", "titulaire_id", "titulaire_typeIdentifiant"
     )
-    df_marches_titulaires = df_marches_titulaires.rename({"uid": "marche_uid"})
-    save_to_sqlite(
-        df_marches_titulaires,
-        "datalab",
-        "marches_titulaires",
-        '"marche_uid", "titulaire_id", "titulaire_typeIdentifiant"',
-    )
-    del df_marches_titulaires
 
-    # TODO ajouter les sous-traitants quand ils seront ajoutés aux données
+    df_acheteurs, df_titulaires, df_marches, df_marches_titulaires = pl.collect_all(
+        [plan_acheteurs, plan_titulaires, plan_marches, plan_marches_titulaires]
+    )
 
+    if not DECP_SQLITE_SURROGATE_KEYS:
+        return {
+            "marches": (df_marches, "uid", None),
+            "acheteurs": (df_acheteurs, "id", None),
+            "entreprises": (df_titulaires, "id, typeIdentifiant", None),
+            "marches_titulaires": (
+                df_marches_titulaires.rename({"uid": "marche_uid"}),
+                '"marche_uid", "titulaire_id", "titulaire_typeIdentifiant"',
+                None,
+            ),
+        }
+
+    df_acheteurs = add_surrogate_keys(df_acheteurs, "acheteurs", ["id"])
+    df_acheteurs = df_acheteurs.select("cle", "id")
+
+    df_titulaires = add_surrogate_keys(
+        df_titulaires, "entreprises", ["id", "typeIdentifiant"]
+    )
+    df_titulaires = df_titulaires.select("cle", "id", "typeIdentifiant")
+
+    df_marches = add_surrogate_keys(df_marches, "marches", ["uid"])
+    df_marches = df_marches.join(
+        df_acheteurs.select(
+            pl.col("id").alias("acheteur_id"), pl.col("cle").alias("acheteur_cle")
+        ),
+        on="acheteur_id",
+        how="left",
+        nulls_equal=True,
+    )
+    df_marches = df_marches.select(
+        "cle",
+        "uid",
+        pl.exclude("cle", "uid", "acheteur_id", "acheteur_cle"),
+        "acheteur_cle",
+    )
 
-def merge_decp_json(files: list) -> pl.DataFrame:
-    dfs = []
-    for file in files:
-        df: pl.DataFrame = pl.read_parquet(f"{file}.parquet")
-        dfs.append(df)
+    df_marches_titulaires = (
+        df_marches_titulaires.with_columns(
+            pl.col("titulaire_typeIdentifiant").cast(pl.String)
+        )
+        .join(
+            df_marches.select("uid", pl.col("cle").alias("marche_cle")),
+            on="uid",
+            how="left",
+        )
+        .join(
+            df_titulaires.select(
+                pl.col("id").alias("titulaire_id"),
+                pl.col("typeIdentifiant").alias("titulaire_typeIdentifiant"),
+                pl.col("cle").alias("titulaire_cle"),
+            ),
+            on=["titulaire_id", "titulaire_typeIdentifiant"],
+            how="left",
+            nulls_equal=True,
+        )
+        .select("marche_cle", "titulaire_cle")
+    )
 
-    df = pl.concat(dfs, how="diagonal")
+    return {
+        "marches": (df_marches, "cle", "uid"),
+        "acheteurs": (df_acheteurs, "cle", "id"),
+        "entreprises": (df_titulaires, "cle", "id, typeIdentifiant"),
+        "marches_titulaires": (
+            df_marches_titulaires,
+            "marche_cle, titulaire_cle",
+            None,
+        ),
+    }
 
-    print(
-        "Suppression des lignes en doublon par UID + titulaire ID + titulaire type ID"
-    )
-    # Exemple : 20005584600014157140791205100
-    index_size_before = df.height
-    df = df.unique(
-        subset=["uid", "titulaire_id", "titulaire_typeIdentifiant"],
-        maintain_order=False,
-    )
-    print("-- ", index_size_before - df.height, " doublons supprimés")
 
+def save_normalized_tables(tables: dict, connection):
+    """Enregistrement des tables calculées par make_normalized_tables."""
+    for table_name, (df_table, primary_key, unique_key) in tables.items():
+        save_to_sqlite(
+            df_table, connection, table_name, primary_key, unique_key=unique_key
+        )
+        if table_name == "marches" and DECP_SQLITE_FTS:
+            save_fts_index(connection, "marches", "uid", "objet")
+
+
+def merge_decp_json(files: list, manifest: dict) -> pl.LazyFrame:
+    """Fusion et dédoublonnage des fichiers clean/, sans les charger en mémoire.
+
+    Pour chaque UID + titulaire ID + titulaire type ID, seule la version la plus
+    récente (datePublicationDonnees) est gardée, d'après l'index des clés
+    (cf. tasks.uid_index) mis à jour avec les seuls fichiers clean/ nouveaux. Les
+    lignes retenues de chaque fichier sont écrites en streaming dans
+    {DIST_DIR}/merge/, et les champs imbriqués (modifications, actes de
+    sous-traitance...) de la ligne retenue pour chaque marché (cf. latest_marches)
+    dans {DIST_DIR}/nested/ (cf. tasks.nested). Ces fichiers ne
+    sont écrits à nouveau que si les lignes retenues de leur source ont changé,
+    sinon ceux du précédent traitement sont réutilisés (cf. manifeste).
+    """
     # Ordre des colonnes
-    df = df.select(
+    columns = [
         "uid",
         "id",
         "nature",
@@ -141,107 +235,243 @@ def merge_decp_json(files: list) -> pl.DataFrame:
         "lieuExecution_code",
         "lieuExecution_typeCode",
         "idAccordCadre",
+    ]
+
+    sources = {}
+    nested_sources = {}
+    for file in files:
+        df = pl.scan_parquet(f"{file}.parquet")
+        nested_columns = [
+            column for column in get_nested_fields() if column in df.collect_schema()
+        ]
+        source, version = source_version(file, manifest)
+        if nested_columns:
+            nested_sources[version] = df.select("uid", *nested_columns)
+        df = df.select(
+            pl.col(column)
+            if column in df.collect_schema()
+            else pl.lit(None).alias(column)
+            for column in columns
+        )
+        sources[version] = (source, df)
+
+    print(
+        "Suppression des lignes en doublon par UID + titulaire ID + titulaire type ID"
     )
-    return df
+    # Exemple : 20005584600014157140791205100
+    index = update_uid_index(sources)
+    # Lignes retenues pour merge/, et pour nested/ une seule ligne par marché
+    selected_rows = {"merge": index, "nested": latest_marches(index)}
+    fingerprints = {
+        step: rows_fingerprint(rows) for step, rows in selected_rows.items()
+    }
+
+    os.makedirs(f"{DIST_DIR}/merge", exist_ok=True)
+    os.makedirs(f"{DIST_DIR}/nested", exist_ok=True)
+    merged_files = []
+    for version, (source, df) in sources.items():
+        steps = {"merge": df}
+        if version in nested_sources:
+            steps["nested"] = nested_sources[version]
+
+        for step, df_step in steps.items():
+            fingerprint = fingerprints[step].get(version, "0")
+            merged_file = merged_artifact(manifest, source, step, fingerprint)
+            if merged_file is None:
+                merged_file = f"{DIST_DIR}/{step}/{source}"
+                rows = (
+                    selected_rows[step]
+                    .filter(pl.col("source_version") == version)
+                    .select("row_nr")
+                )
+                df_step.with_row_index("row_nr").join(
+                    rows.lazy(), on="row_nr", how="semi"
+                ).drop("row_nr").sink_parquet(f"{merged_file}.parquet")
+                record_merged_artifact(manifest, source, step, merged_file, fingerprint)
+            merged_files.append(f"{merged_file}.parquet")
+
+    # Fichiers des sources qui ne sont plus traitées
+    for file in glob(f"{DIST_DIR}/merge/*.parquet") + glob(
+        f"{DIST_DIR}/nested/*.parquet"
+    ):
+        if file not in merged_files:
+            os.remove(file)
+
+    print("-- ", count_indexed_rows() - index.height, " doublons supprimés")
+
+    return pl.concat(
+        [pl.scan_parquet(file) for file in merged_files if "/merge/" in file],
+        how="diagonal_relaxed",
+    )
+
+
+def merged_artifact(manifest: dict, source: str, step: str, fingerprint: str):
+    """Fichier merge/ ou nested/ d'une source écrit lors d'un précédent traitement
+    avec les mêmes lignes retenues (cf. rows_fingerprint), ou None."""
+    entry = manifest["sources"].get(source)
+    if entry is None or entry.get(step, {}).get("rows") != fingerprint:
+        return None
+    return get_artifact(manifest, source, entry["sha1"], step)
+
+
+def record_merged_artifact(
+    manifest: dict, source: str, step: str, path: str, fingerprint: str
+):
+    entry = manifest["sources"].get(source)
+    if entry is None:
+        return
+    record_artifact(manifest, source, entry["sha1"], step, path)
+    entry[step]["rows"] = fingerprint
 
 
 def setup_tableschema_columns(df: pl.DataFrame):
-    # Ajout colonnes manquantes
-    df = df.with_columns(pl.lit("").alias("acheteur_nom"))  # TODO
-    df = df.with_columns(pl.lit("").alias("titulaire_denominationSociale"))  # TODO
-    df = df.with_columns(pl.lit("").alias("lieuExecution_nom"))  # TODO
-    df = df.with_columns(pl.lit("").alias("objetModification"))  # TODO
-    df = df.with_columns(pl.lit("").alias("donneesActuelles"))  # TODO
-    df = df.with_columns(pl.lit("").alias("anomalies"))  # TODO
-
-    tableschema = get(
-        "https://raw.githubusercontent.com/ColinMaudry/decp-table-schema/refs/heads/main/schema.json",
-        follow_redirects=True,
-    ).json()
-    fields = [field["name"] for field in tableschema["fields"]]
+    # Ajout colonnes manquantes (acheteur_nom et titulaire_denominationSociale
+    # sont ajoutés par l'enrichissement SIRENE)
+    for column in [
+        "acheteur_nom",
+        "titulaire_denominationSociale",
+        "lieuExecution_nom",  # TODO
+        "objetModification",  # TODO
+        "donneesActuelles",  # TODO
+        "anomalies",  # TODO
+    ]:
+        if column not in df.columns:
+            df = df.with_columns(pl.lit("").alias(column))
+
+    fields = [field["name"] for field in get_tableschema()["fields"]]
     df = df.select(fields)
 
     return df
 
 
+def select_latest_marches(df: pl.DataFrame) -> pl.DataFrame:
+    """Une ligne par marché (uid) : celle retenue par la fusion pour ses champs
+    imbriqués (cf. tasks.uid_index.latest_marches).
+
+    Les lignes d'un même uid peuvent venir de versions différentes (un titulaire
+    absent de la version la plus récente garde la ligne d'une version plus
+    ancienne) : le choix ne dépend pas de l'ordre des lignes.
+    """
+    keys = load_latest_marches()
+    return df.join(
+        keys if isinstance(df, pl.DataFrame) else keys.lazy(),
+        left_on=[pl.col(key).cast(pl.String) for key in UID_INDEX_KEYS],
+        right_on=UID_INDEX_KEYS,
+        how="semi",
+        nulls_equal=True,
+    )
+
+
 def make_decp_sans_titulaires(df: pl.DataFrame):
-    df_decp_sans_titulaires = df.drop(
+    """Une ligne par marché (uid), sans les colonnes des titulaires, celle retenue
+    par la fusion (cf. select_latest_marches).
+
+    Avec DECP_CHECK_SANS_TITULAIRES, les uid dont les lignes diffèrent par d'autres
+    colonnes que celles des titulaires sont signalés.
+    """
+    if DECP_CHECK_SANS_TITULAIRES:
+        check_decp_sans_titulaires(
+            df.drop(["titulaire_id", "titulaire_typeIdentifiant"])
+        )
+
+    return select_latest_marches(df).drop(
         [
             "titulaire_id",
             "titulaire_typeIdentifiant",
         ]
     )
-    df_decp_sans_titulaires = df_decp_sans_titulaires.unique()
-    return df_decp_sans_titulaires
+
+
+def check_decp_sans_titulaires(df: pl.DataFrame) -> pl.DataFrame:
+    """uid dont les lignes sans titulaire ne sont pas identiques, et colonnes qui
+    diffèrent."""
+    columns = [column for column in df.columns if column != "uid"]
+    differences = (
+        df.group_by("uid")
+        .agg(pl.col(columns).n_unique() > 1)
+        .filter(pl.any_horizontal(columns))
+        .select(
+            "uid",
+            pl.concat_list(
+                pl.when(pl.col(column)).then(pl.lit(column)) for column in columns
+            )
+            .list.drop_nulls()
+            .alias("colonnes"),
+        )
+        .sort("uid")
+    )
+
+    print(f"Marchés dont les lignes diffèrent hors titulaires : {differences.height}")
+    for uid, colonnes in differences.head(20).iter_rows():
+        print(f"-- {uid} : {', '.join(colonnes)}")
+
+    return differences
 
 
 #
-# ⬇️⬇️⬇️ Fonctions à refactorer avec Polars et le format DECP 2022 ⬇️⬇️⬇️
+# Enrichissement avec les données SIRENE (cf. tasks.enrich)
 #
 
 
 def extract_unique_acheteurs_siret(df: pl.DataFrame):
     # Extraction des SIRET des DECP
-    decp_acheteurs_df = df[["acheteur_id"]]
-    decp_acheteurs_df = decp_acheteurs_df.drop_duplicates().loc[
-        decp_acheteurs_df["acheteur_id"] != ""
-    ]
-    print(f"{decp_acheteurs_df.index.size} acheteurs uniques")
+    decp_acheteurs_df = (
+        df.select("acheteur_id")
+        .unique()
+        .filter(pl.col("acheteur_id").is_not_null() & (pl.col("acheteur_id") != ""))
+        .sort("acheteur_id")
+    )
+    print(f"{decp_acheteurs_df.height} acheteurs uniques")
 
     return decp_acheteurs_df
 
 
 def extract_unique_titulaires_siret(df: pl.DataFrame):
     # Extraction des SIRET des DECP
-    df_sirets_titulaires = df[["titulaire_id", "titulaire_typeIdentifiant"]]
-
-    df_sirets_titulaires = df_sirets_titulaires.drop_duplicates()
-    df_sirets_titulaires = df_sirets_titulaires[
-        df_sirets_titulaires["titulaire_typeIdentifiant"] == "SIRET"
-    ]
-    print(f"{len(df_sirets_titulaires)} titulaires uniques")
+    df_sirets_titulaires = (
+        df.select("titulaire_id", "titulaire_typeIdentifiant")
+        .unique()
+        .filter(pl.col("titulaire_typeIdentifiant") == "SIRET")
+        .sort("titulaire_id")
+    )
+    print(f"{df_sirets_titulaires.height} titulaires uniques")
 
     return df_sirets_titulaires
 
 
 def make_acheteur_nom(decp_acheteurs_df: pl.DataFrame):
-    # Construction du champ acheteur_id
-
-    from numpy import nan as NaN
-
-    def construct_nom(row):
-        if row["enseigne1Etablissement"] is NaN:
-            return row["denominationUniteLegale"]
-        else:
-            return f'{row["denominationUniteLegale"]} - {row["enseigne1Etablissement"]}'
-
-    decp_acheteurs_df["acheteur_id"] = decp_acheteurs_df.apply(construct_nom, axis=1)
-
-    # TODO: ne garder que les colonnes acheteur_id et acheteur_id
+    # Construction du champ acheteur_nom
+    decp_acheteurs_df = decp_acheteurs_df.with_columns(
+        pl.when(pl.col("enseigne1Etablissement").is_null())
+        .then(pl.col("denominationUniteLegale"))
+        .otherwise(
+            pl.concat_str(
+                "denominationUniteLegale",
+                pl.lit(" - "),
+                "enseigne1Etablissement",
+            )
+        )
+        .alias("acheteur_nom")
+    )
 
-    return decp_acheteurs_df
+    return decp_acheteurs_df.select("acheteur_id", "acheteur_nom")
 
 
 def improve_titulaire_unite_legale_data(df_sirets_titulaires: pl.DataFrame):
     # Raccourcissement du code commune
-    df_sirets_titulaires["departement"] = df_sirets_titulaires[
-        "codeCommuneEtablissement"
-    ].str[:2]
-    df_sirets_titulaires = df_sirets_titulaires.drop(
-        columns=["codeCommuneEtablissement"]
-    )
+    df_sirets_titulaires = df_sirets_titulaires.with_columns(
+        pl.col("codeCommuneEtablissement").str.slice(0, 2).alias("departement")
+    ).drop("codeCommuneEtablissement")
 
     # # Raccourcissement de l'activité principale
     # pas sûr de pourquoi je voulais raccourcir le code NAF/APE. Pour récupérérer des libellés ?
     # decp_titulaires_sirets_df['activitePrincipaleEtablissement'] = decp_titulaires_sirets_df['activitePrincipaleEtablissement'].str[:-3]
 
     # Correction des données ESS et état
-    df_sirets_titulaires["etatAdministratifUniteLegale"] = df_sirets_titulaires[
-        "etatAdministratifUniteLegale"
-    ].cat.rename_categories({"A": "Active", "C": "Cessée"})
-    df_sirets_titulaires["economieSocialeSolidaireUniteLegale"] = df_sirets_titulaires[
-        "economieSocialeSolidaireUniteLegale"
-    ].replace({"O": "Oui", "N": "Non"})
+    df_sirets_titulaires = df_sirets_titulaires.with_columns(
+        pl.col("etatAdministratifUniteLegale").replace({"A": "Active", "C": "Cessée"}),
+        pl.col("economieSocialeSolidaireUniteLegale").replace({"O": "Oui", "N": "Non"}),
+    )
 
     df_sirets_titulaires = improve_categories_juridiques(df_sirets_titulaires)
 
@@ -250,23 +480,21 @@ def improve_titulaire_unite_legale_data(df_sirets_titulaires: pl.DataFrame):
 
 def improve_categories_juridiques(df_sirets_titulaires: pl.DataFrame):
     # Récupération et raccourcissement des categories juridiques du fichier SIREN
-    df_sirets_titulaires["categorieJuridiqueUniteLegale"] = (
-        df_sirets_titulaires["categorieJuridiqueUniteLegale"].astype(str).str[:2]
+    df_sirets_titulaires = df_sirets_titulaires.with_columns(
+        pl.col("categorieJuridiqueUniteLegale").str.slice(0, 2)
     )
 
-    # Récupération des libellés des catégories juridiques
-    cj_df = pl.read_csv("data/cj.csv", index_col=None, dtype="object")
-    df_sirets_titulaires = pl.merge(
-        df_sirets_titulaires,
-        cj_df,
+    # Récupération des libellés des catégories juridiques (niveau II de la
+    # nomenclature INSEE)
+    cj_df = pl.read_csv(CATEGORIES_JURIDIQUES_PATH, infer_schema=False)
+    df_sirets_titulaires = df_sirets_titulaires.join(
+        cj_df.select(
+            pl.col("Code").alias("categorieJuridiqueUniteLegale"),
+            pl.col("Libellé").alias("categorieJuridique"),
+        ),
+        on="categorieJuridiqueUniteLegale",
         how="left",
-        left_on="categorieJuridiqueUniteLegale",
-        right_on="Code",
-    )
-    df_sirets_titulaires["categorieJuridique"] = df_sirets_titulaires["Libellé"]
-    df_sirets_titulaires = df_sirets_titulaires.drop(
-        columns=["Code", "categorieJuridiqueUniteLegale", "Libellé"]
-    )
+    ).drop("categorieJuridiqueUniteLegale")
     return df_sirets_titulaires
 
 
@@ -274,11 +502,12 @@ def rename_titulaire_sirene_columns(df_sirets_titulaires: pl.DataFrame):
     # Renommage des colonnes
 
     renaming = {
+        "denominationUniteLegale": "titulaire_denominationSociale",
         "activitePrincipaleEtablissement": "codeAPE",
         "etatAdministratifUniteLegale": "etatEntreprise",
         "etatAdministratifEtablissement": "etatEtablissement",
     }
 
-    df_sirets_titulaires = df_sirets_titulaires.rename(columns=renaming)
+    df_sirets_titulaires = df_sirets_titulaires.rename(renaming)
 
     return df_sirets_titulaires
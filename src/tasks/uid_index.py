@@ -0,0 +1,227 @@
+import json
+import os
+
+import polars as pl
+
+from tasks.cache import file_sha1
+from config import DECP_UID_INDEX_PATH
+
+# L'index des clés garde, d'un traitement à l'autre, la ligne retenue pour chaque
+# marché et titulaire :
+#
+# uid | titulaire_id | titulaire_typeIdentifiant | source | source_version | row_nr
+#     | datePublicationDonnees | row_hash
+#
+# Pour chaque clé, la version retenue est celle dont la date de publication est la
+# plus récente, puis, à date égale, celle de la source, de l'empreinte de contenu et
+# du numéro de ligne les plus grands : le résultat ne dépend pas de l'ordre de
+# lecture des fichiers.
+#
+# Seules les lignes des fichiers clean/ qui n'ont pas encore été indexés (nouvelle
+# version, cf. source_version) sont lues, et comparées aux seules lignes retenues
+# des mêmes clés. Le fichier {DECP_UID_INDEX_PATH sans extension}.json garde le
+# nombre de lignes de chaque version indexée.
+
+UID_INDEX_KEYS = ["uid", "titulaire_id", "titulaire_typeIdentifiant"]
+
+UID_INDEX_SCHEMA = {
+    "uid": pl.String,
+    "titulaire_id": pl.String,
+    "titulaire_typeIdentifiant": pl.String,
+    "source": pl.String,
+    "source_version": pl.String,
+    "row_nr": pl.UInt32,
+    "datePublicationDonnees": pl.Date,
+    "row_hash": pl.UInt64,
+}
+
+# Ordre de préférence des lignes d'une même clé
+UID_INDEX_ORDER = ["datePublicationDonnees", "source", "row_hash", "row_nr"]
+
+
+def indexed_sources_path() -> str:
+    return f"{os.path.splitext(DECP_UID_INDEX_PATH)[0]}.json"
+
+
+def load_uid_index() -> pl.DataFrame:
+    if not os.path.exists(DECP_UID_INDEX_PATH) or not os.path.exists(
+        indexed_sources_path()
+    ):
+        return pl.DataFrame(schema=UID_INDEX_SCHEMA)
+    return pl.read_parquet(DECP_UID_INDEX_PATH)
+
+
+def load_indexed_sources() -> dict:
+    """Nombre de lignes de chaque version de fichier clean/ indexée."""
+    if not os.path.exists(DECP_UID_INDEX_PATH) or not os.path.exists(
+        indexed_sources_path()
+    ):
+        return {}
+    with open(indexed_sources_path(), encoding="utf8") as f:
+        return json.load(f)["sources"]
+
+
+def save_uid_index(index: pl.DataFrame, indexed_sources: dict):
+    os.makedirs(os.path.dirname(DECP_UID_INDEX_PATH), exist_ok=True)
+    tmp_path = f"{DECP_UID_INDEX_PATH}.tmp"
+    index.write_parquet(tmp_path)
+    os.replace(tmp_path, DECP_UID_INDEX_PATH)
+
+    with open(f"{indexed_sources_path()}.tmp", "w", encoding="utf8") as f:
+        json.dump({"sources": indexed_sources}, f, indent=2)
+    os.replace(f"{indexed_sources_path()}.tmp", indexed_sources_path())
+
+
+def hash_rows(df: pl.LazyFrame) -> pl.Expr:
+    """Empreinte du contenu de chaque ligne.
+
+    Les colonnes Categorical sont converties en texte, leurs codes dépendant de
+    l'ordre de lecture des valeurs.
+    """
+    return pl.struct(
+        pl.col(column).cast(pl.String) if dtype == pl.Categorical else pl.col(column)
+        for column, dtype in df.collect_schema().items()
+    ).hash(seed=0)
+
+
+def index_entries(
+    df: pl.LazyFrame, source: str, version: str, keys: pl.DataFrame = None
+) -> pl.DataFrame:
+    """Lignes de l'index pour un fichier clean/ (colonnes déjà sélectionnées), ou
+    pour ses seules lignes des clés keys."""
+    df = (
+        df.with_row_index("row_nr")
+        .with_columns(
+            hash_rows(df).alias("row_hash"),
+            pl.lit(source).alias("source"),
+            pl.lit(version).alias("source_version"),
+            pl.col(UID_INDEX_KEYS).cast(pl.String),
+        )
+        .select(UID_INDEX_SCHEMA.keys())
+    )
+    if keys is not None:
+        df = df.join(keys.lazy(), on=UID_INDEX_KEYS, how="semi", nulls_equal=True)
+    return df.collect()
+
+
+def latest_versions(entries: pl.DataFrame) -> pl.DataFrame:
+    """Ligne retenue pour chaque clé parmi entries."""
+    return entries.sort(UID_INDEX_ORDER, descending=True, nulls_last=True).unique(
+        subset=UID_INDEX_KEYS, keep="first"
+    )
+
+
+def latest_marches(index: pl.DataFrame) -> pl.DataFrame:
+    """Ligne retenue pour chaque marché (uid) parmi les lignes retenues de ses
+    titulaires, dans le même ordre de préférence : les champs imbriqués du marché
+    (cf. tasks.nested) sont ceux de cette ligne."""
+    return index.sort(UID_INDEX_ORDER, descending=True, nulls_last=True).unique(
+        subset="uid", keep="first"
+    )
+
+
+def load_latest_marches() -> pl.DataFrame:
+    """Clés (UID_INDEX_KEYS) de la ligne retenue pour chaque marché par la dernière
+    fusion (cf. latest_marches)."""
+    return latest_marches(load_uid_index()).select(UID_INDEX_KEYS)
+
+
+def update_uid_index(sources: dict) -> pl.DataFrame:
+    """Mise à jour de l'index avec les fichiers clean/ {version: (nom, LazyFrame)}.
+
+    Les lignes des fichiers qui ne font plus partie des sources sont supprimées.
+    Les clés dont la ligne retenue est supprimée, et qu'une nouvelle ligne ne
+    remplace pas, sont recalculées avec les lignes des autres fichiers.
+    """
+    index = load_uid_index()
+    indexed_sources = load_indexed_sources()
+    removed_versions = [
+        version for version in indexed_sources if version not in sources
+    ]
+    new_versions = [version for version in sources if version not in indexed_sources]
+    if not removed_versions and not new_versions:
+        return index
+
+    entries = [
+        index_entries(sources[version][1], sources[version][0], version)
+        for version in new_versions
+    ]
+    print("Lignes ajoutées à l'index des clés :", sum(e.height for e in entries))
+    for version, entry in zip(new_versions, entries):
+        indexed_sources[version] = entry.height
+    entries = pl.concat(entries) if entries else pl.DataFrame(schema=UID_INDEX_SCHEMA)
+
+    if removed_versions:
+        for version in removed_versions:
+            del indexed_sources[version]
+        removed = index.filter(pl.col("source_version").is_in(removed_versions))
+        index = index.filter(~pl.col("source_version").is_in(removed_versions))
+
+        # Une nouvelle ligne qui l'emporte sur la ligne supprimée l'emporte aussi
+        # sur les lignes des autres fichiers, sinon elles sont relues
+        contest = latest_versions(
+            pl.concat(
+                [
+                    removed.with_columns(removed=True),
+                    entries.join(
+                        removed, on=UID_INDEX_KEYS, how="semi", nulls_equal=True
+                    ).with_columns(removed=False),
+                ]
+            )
+        )
+        orphan_keys = contest.filter(pl.col("removed")).select(UID_INDEX_KEYS)
+        if orphan_keys.height > 0:
+            print("Clés recalculées après suppression de sources :", orphan_keys.height)
+            entries = pl.concat(
+                [entries]
+                + [
+                    index_entries(df, source, version, orphan_keys)
+                    for version, (source, df) in sources.items()
+                    if version not in new_versions
+                ]
+            )
+
+    current = index.join(entries, on=UID_INDEX_KEYS, how="semi", nulls_equal=True)
+    index = pl.concat(
+        [
+            index.join(entries, on=UID_INDEX_KEYS, how="anti", nulls_equal=True),
+            latest_versions(pl.concat([current, entries])),
+        ]
+    )
+
+    save_uid_index(index, indexed_sources)
+    return index
+
+
+def count_indexed_rows() -> int:
+    """Nombre de lignes des fichiers clean/ indexés, doublons compris."""
+    return sum(load_indexed_sources().values())
+
+
+def rows_fingerprint(index: pl.DataFrame) -> dict:
+    """Empreinte des lignes retenues de chaque version : {version: empreinte}.
+
+    Les fichiers merge/ et nested/ d'une version dont l'empreinte n'a pas changé
+    n'ont pas à être écrits à nouveau.
+    """
+    fingerprints = index.group_by("source_version").agg(
+        pl.len().alias("rows"), pl.col("row_nr").hash(seed=0).sum().alias("hash")
+    )
+    return {
+        version: f"{rows}-{row_hash}"
+        for version, rows, row_hash in fingerprints.iter_rows()
+    }
+
+
+def source_version(file: str, manifest: dict) -> tuple:
+    """Nom et version d'un fichier clean/.
+
+    La version est faite des empreintes du code de traitement et du fichier JSON
+    source d'après le manifeste, sinon de l'empreinte du fichier lui-même.
+    L'empreinte du fichier clean/ ne suffit pas : l'encodage des colonnes
+    Categorical varie d'une exécution à l'autre pour un même contenu.
+    """
+    for source_name, entry in manifest["sources"].items():
+        if "clean" in entry and entry["clean"]["path"] == file:
+            return source_name, f"{manifest['pipeline']}-{entry['sha1']}"
+    return os.path.basename(file), file_sha1(f"{file}.parquet")
@@ -0,0 +1,153 @@
+import datetime
+import os
+
+import polars as pl
+
+import tasks.clean
+import tasks.get
+from tasks.clean import normalize_dates, fix_data_types
+
+
+def read_clean_file(file: str) -> pl.DataFrame:
+    """Fichier clean/, colonnes Categorical en texte pour comparer deux fichiers."""
+    return pl.read_parquet(f"{file}.parquet").with_columns(
+        pl.col(pl.Categorical).cast(pl.String)
+    )
+
+
+class TestClean:
+    def test_normalize_dates(self):
+        df = pl.LazyFrame(
+            {
+                "dateNotification": [
+                    "2022-04-29",
+                    "0222-04-29",
+                    "0022-04-29",
+                    "5021-02-18",
+                    "2022-04-29+02:00",
+                    "29/04/2022",
+                    "September, 16 2021 00:00:00",
+                    "2027-03-01",
+                    "2027-03-05",
+                    "2921-11-19",
+                    "pas une date",
+                    "",
+                    None,
+                ]
+            }
+        )
+
+        # Dates plausibles jusqu'à la date de la source plus un jour
+        df = normalize_dates(df, ["dateNotification"], "2027-03-03").collect()
+
+        assert df["dateNotification"].to_list() == [
+            datetime.date(2022, 4, 29),
+            datetime.date(2022, 4, 29),
+            datetime.date(2022, 4, 29),
+            datetime.date(2021, 2, 18),
+            datetime.date(2022, 4, 29),
+            datetime.date(2022, 4, 29),
+            datetime.date(2021, 9, 16),
+            datetime.date(2027, 3, 1),
+            None,
+            None,
+            None,
+            None,
+            None,
+        ]
+        assert df["dateNotification_regle"].to_list() == [
+            "iso",
+            "annee_02XX+iso",
+            "annee_00XX+iso",
+            "annee_50XX+iso",
+            "iso_suffixe",
+            "jj/mm/aaaa",
+            "mois_en_lettres",
+            "iso",
+            "hors_periode",
+            "hors_periode",
+            "invalide",
+            None,
+            None,
+        ]
+
+    def test_fix_data_types_categorical(self):
+        df = pl.LazyFrame(
+            {
+                "nature": ["Marché", "Marché subséquent", None],
+                "titulaire_typeIdentifiant": ["SIRET", "SIRET", "TVA"],
+                "dureeMois": ["12", "x", None],
+            }
+        )
+
+        with pl.StringCache():
+            df = fix_data_types(df).collect()
+            other = fix_data_types(
+                pl.LazyFrame({"nature": ["Accord-cadre", "Marché"]})
+            ).collect()
+            df = pl.concat([df, other], how="diagonal")
+
+        assert df.schema["nature"] == pl.Categorical
+        assert df.schema["titulaire_typeIdentifiant"] == pl.Categorical
+        assert df.schema["dureeMois"] == pl.Int16
+        assert df["nature"].cast(pl.String).to_list() == [
+            "Marché",
+            "Marché subséquent",
+            None,
+            "Accord-cadre",
+            "Marché",
+        ]
+
+    def test_get_clean_source(self, tmp_path, monkeypatch):
+        def clean_source(file_name: str) -> pl.DataFrame:
+            source = {
+                "file_name": file_name,
+                "json": "data/decp_test.json",
+                "sha1": "sha1",
+                "date_source": "2030-01-01",
+                "get": None,
+                "clean": None,
+                "artifact": {},
+            }
+            source = tasks.clean.get_clean_source(source)
+            return read_clean_file(source["clean"])
+
+        # Normalisation et nettoyage en un seul plan, ou en deux étapes
+        monkeypatch.setattr(tasks.clean, "DIST_DIR", str(tmp_path / "fused"))
+        monkeypatch.setattr(tasks.get, "DIST_DIR", str(tmp_path / "fused"))
+        monkeypatch.setattr(tasks.clean, "DECP_PROCESSING_FUSED", True)
+        df_fused = clean_source("decp_test")
+        monkeypatch.setattr(tasks.clean, "DIST_DIR", str(tmp_path / "get"))
+        monkeypatch.setattr(tasks.get, "DIST_DIR", str(tmp_path / "get"))
+        monkeypatch.setattr(tasks.clean, "DECP_PROCESSING_FUSED", False)
+        assert clean_source("decp_test").equals(df_fused)
+        assert df_fused.height == 3
+
+    def test_process_sources(self, tmp_path, monkeypatch):
+        # Les processus sont lancés depuis tmp_path et y écrivent leurs fichiers
+        for path in ["data", "template.env"]:
+            (tmp_path / path).symlink_to(os.path.abspath(path))
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(tasks.clean, "DECP_PROCESSING_WORKERS", 2)
+
+        sources = [
+            {
+                "file_name": file_name,
+                "json": "data/decp_test.json",
+                "sha1": "sha1",
+                "date_source": "2030-01-01",
+                "get": None,
+                "clean": None,
+                "artifact": {},
+            }
+            for file_name in ["decp-a", "decp-b"]
+        ]
+        processed_sources = tasks.clean.process_sources(sources)
+
+        assert [source["file_name"] for source in processed_sources] == [
+            "decp-a",
+            "decp-b",
+        ]
+        df_a, df_b = (read_clean_file(source["clean"]) for source in processed_sources)
+        assert df_a.height == 3
+        assert df_a.drop("source_open_data").equals(df_b.drop("source_open_data"))
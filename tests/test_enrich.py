@@ -0,0 +1,107 @@
+import os
+
+import polars as pl
+
+import tasks.enrich
+import tasks.sirene
+import tasks.transform
+
+
+class TestEnrich:
+    def test_enrich_from_sirene(self, tmp_path, monkeypatch):
+        pl.DataFrame(
+            {
+                "siren": ["000000001", "000000002", "000000003"],
+                "siret": ["00000000100011", "00000000200011", "00000000300011"],
+                "enseigne1Etablissement": ["Mairie", None, None],
+                "longitude": ["2.35", "", "1.5"],
+                "latitude": ["48.85", "", "43.6"],
+                "activitePrincipaleEtablissement": ["84.11Z", "43.21A", "62.01Z"],
+                "codeCommuneEtablissement": ["75056", "35238", "31555"],
+                "etatAdministratifEtablissement": ["A", "A", "F"],
+            }
+        ).write_csv(tmp_path / "etablissements.csv")
+        pl.DataFrame(
+            {
+                "siren": ["000000001", "000000002", "000000003"],
+                "denominationUniteLegale": ["Commune", "Électricité SA", "Inutilisée"],
+                "categorieEntreprise": [None, "PME", "PME"],
+                "etatAdministratifUniteLegale": ["A", "C", "A"],
+                "economieSocialeSolidaireUniteLegale": ["N", "O", "N"],
+                "categorieJuridiqueUniteLegale": ["7210", "5710", "5710"],
+            }
+        ).write_csv(tmp_path / "unites_legales.csv")
+        monkeypatch.setattr(
+            tasks.sirene,
+            "SIRENE_ETABLISSEMENTS_PATH",
+            str(tmp_path / "etablissements.csv"),
+        )
+        monkeypatch.setattr(
+            tasks.sirene,
+            "SIRENE_UNITES_LEGALES_PATH",
+            str(tmp_path / "unites_legales.csv"),
+        )
+        monkeypatch.setattr(tasks.sirene, "DECP_SIRENE_STORE_DIR", str(tmp_path))
+        tasks.sirene.update_sirene_store()
+
+        # Copie locale triée, non refaite tant que les stocks ne changent pas
+        store = pl.read_parquet(tmp_path / "etablissements.parquet")
+        assert store["siret"].is_sorted()
+        assert store["longitude"].dtype == pl.Float64
+        mtime = os.stat(tmp_path / "etablissements.parquet").st_mtime_ns
+        tasks.sirene.update_sirene_store()
+        assert os.stat(tmp_path / "etablissements.parquet").st_mtime_ns == mtime
+
+        df = pl.DataFrame(
+            {
+                "uid": ["1", "1", "2"],
+                "acheteur_id": ["00000000100011", "00000000100011", "99999999999999"],
+                "titulaire_id": ["00000000200011", "FR123", "00000000200011"],
+                "titulaire_typeIdentifiant": ["SIRET", "TVA", "SIRET"],
+            }
+        )
+
+        acheteurs = tasks.transform.extract_unique_acheteurs_siret(df)
+        acheteurs = tasks.enrich.add_etablissement_data_to_acheteurs(acheteurs)
+        acheteurs = tasks.enrich.add_unite_legale_data_to_acheteurs(acheteurs)
+        acheteurs = tasks.transform.make_acheteur_nom(acheteurs)
+        df = tasks.enrich.merge_sirets_acheteurs(df, acheteurs)
+        assert df["acheteur_nom"].to_list() == [
+            "Commune - Mairie",
+            "Commune - Mairie",
+            None,
+        ]
+
+        titulaires = tasks.transform.extract_unique_titulaires_siret(df)
+        titulaires = tasks.enrich.add_etablissement_data_to_titulaires(titulaires)
+        titulaires = tasks.enrich.add_unite_legale_data_to_titulaires(titulaires)
+        titulaires = tasks.transform.improve_titulaire_unite_legale_data(titulaires)
+        titulaires = tasks.transform.rename_titulaire_sirene_columns(titulaires)
+        df_titulaires = tasks.enrich.merge_sirets_titulaires(df, titulaires)
+
+        assert df_titulaires.select(
+            "titulaire_id",
+            "titulaire_denominationSociale",
+            "departement",
+            "categorieJuridique",
+            "etatEntreprise",
+            "longitude",
+        ).rows() == [
+            (
+                "00000000200011",
+                "Électricité SA",
+                "35",
+                "Société par actions simplifiée",
+                "Cessée",
+                None,
+            ),
+            ("FR123", None, None, None, None, None),
+            (
+                "00000000200011",
+                "Électricité SA",
+                "35",
+                "Société par actions simplifiée",
+                "Cessée",
+                None,
+            ),
+        ]
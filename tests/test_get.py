@@ -0,0 +1,191 @@
+import hashlib
+import json
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import polars as pl
+import pytest
+
+import tasks.get
+
+
+@pytest.fixture
+def datagouvfr_server():
+    """Serveur HTTP local qui imite les ressources et l'API de data.gouv.fr"""
+    with open("data/decp_test.json", "rb") as f:
+        decp_json = f.read()
+
+    routes = {}
+    for resource_id in ["resource-1", "resource-2"]:
+        routes[f"/fr/datasets/r/{resource_id}"] = decp_json
+        routes[
+            f"/api/1/datasets/5cd57bf68b4c4179299eb0e9/resources/{resource_id}/"
+        ] = json.dumps(
+            {
+                "title": f"{resource_id}.json",
+                "id": resource_id,
+                "checksum": {
+                    "type": "sha1",
+                    "value": hashlib.sha1(decp_json).hexdigest(),
+                },
+                "created_at": "2025-01-01T00:00:00",
+                "last_modified": "2025-01-01T00:00:00",
+                "filesize": len(decp_json),
+                "metrics": {"views": 0},
+            }
+        ).encode()
+
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            if self.path not in routes:
+                self.send_error(404)
+                return
+            body = routes[self.path]
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}", requests
+    server.shutdown()
+
+
+class TestGet:
+    def test_fetch_decp_json_files(self, datagouvfr_server, tmp_path, monkeypatch):
+        datagouvfr_server, requests = datagouvfr_server
+        monkeypatch.chdir(tmp_path)
+        (tmp_path / "data").mkdir()
+        monkeypatch.setattr(tasks.get, "DATAGOUVFR_API", f"{datagouvfr_server}/api/1")
+
+        json_files = [
+            {
+                "file_name": f"decp-{i}",
+                "url": f"{datagouvfr_server}/fr/datasets/r/resource-{i}",
+                "process": True,
+            }
+            for i in [1, 2]
+        ]
+        json_files.append(
+            {"file_name": "decp-3", "url": "data/absent.json", "process": False}
+        )
+
+        fetched_files = tasks.get.fetch_decp_json_files.fn(json_files)
+
+        assert [f["json_file"]["file_name"] for f in fetched_files] == [
+            "decp-1",
+            "decp-2",
+        ]
+        for fetched_file in fetched_files:
+            with open(fetched_file["path"]) as f:
+                assert len(json.load(f)["marches"]["marche"]) == 2
+            assert fetched_file["path"].name == (
+                fetched_file["metadata"]["checksum"]["value"] + ".json"
+            )
+
+        # Les ressources inchangées sont lues depuis le cache
+        requests.clear()
+        tasks.get.fetch_decp_json_files.fn(json_files)
+        assert not any(path.startswith("/fr/datasets/r/") for path in requests)
+
+    def test_normalize_batch_schema(self):
+        null_values = Counter()
+        df = tasks.get.normalize_batch(
+            [
+                {"id": "a", "montant": "NC", "dureeMois": "12", "acheteur": {"id": 1}},
+                {"id": 2, "montant": 3, "attributionAvance": True, "inconnu": "x"},
+                {"id": "c", "dureeMois": 12.7, "attributionAvance": "oui"},
+            ],
+            null_values,
+        )
+
+        assert df.schema == tasks.get.get_ingest_schema()
+        assert df["montant"].to_list() == [None, 3.0, None]
+        assert df["dureeMois"].to_list() == [12, None, None]
+        assert df["attributionAvance"].to_list() == [None, True, None]
+        assert df["acheteur_id"].to_list() == ["1", None, None]
+        # Comme pour les champs imbriqués (cf. coerce_scalar)
+        assert null_values == {"montant": 1, "dureeMois": 1, "attributionAvance": 1}
+        assert tasks.get.find_unknown_fields(["id", "inconnu", "_type"]) == ["inconnu"]
+
+    def test_coerce_nested_fields(self):
+        listed_values, null_values = Counter(), Counter()
+        batch = [
+            {
+                "id": "a",
+                "montant": "NC",
+                "typesPrix": {"typePrix": "Forfaitaire"},
+                "modifications": [
+                    {"modification": {"id": 1, "montant": "NC", "dureeMois": "12"}}
+                ],
+            },
+            {
+                "id": "b",
+                "titulaires": {"titulaire": {"id": "1", "typeIdentifiant": "SIRET"}},
+            },
+        ]
+        for marche in batch:
+            tasks.get.coerce_nested_fields(marche, listed_values, null_values)
+        df = tasks.get.normalize_batch(batch, null_values)
+
+        assert df["typesPrix_typePrix"].to_list() == [["Forfaitaire"], None]
+        modification = df["modifications"][0][0]["modification"]
+        assert (modification["id"], modification["montant"]) == ("1", None)
+        assert modification["dureeMois"] == 12
+        assert df["titulaires"][1].to_list() == [
+            {"titulaire": {"typeIdentifiant": "SIRET", "id": "1"}}
+        ]
+        assert listed_values == {"typesPrix.typePrix": 1, "titulaires": 1}
+        assert null_values == {"modifications.modification.montant": 1, "montant": 1}
+
+    def test_get_source_date(self, monkeypatch):
+        monkeypatch.setattr(tasks.get, "DATE_NOW", "2027-02-01")
+        manifest = {
+            "pipeline": "p",
+            "sources": {"decp": {"sha1": "a", "date_source": "2026-12-15"}},
+        }
+        metadata = {"last_modified": "2027-01-10T08:00:00.000000+00:00"}
+
+        # Même version : date gardée dans le manifeste
+        assert tasks.get.get_source_date(manifest, "decp", "a", None) == "2026-12-15"
+        # Nouvelle version : date de data.gouv.fr, ou du téléchargement
+        assert tasks.get.get_source_date(manifest, "decp", "b", metadata) == (
+            "2027-01-10"
+        )
+        assert tasks.get.get_source_date(manifest, "decp", "b", None) == "2027-02-01"
+
+    def test_json_stream_to_parquet(self, tmp_path, monkeypatch):
+        # Un lot par marché
+        monkeypatch.setattr(tasks.get, "DECP_JSON_BATCH_SIZE", 1)
+        parts = tasks.get.json_to_parquet_parts(
+            "data/decp_test.json", "decp_test", str(tmp_path / "parts")
+        )
+        assert len(parts) == 2
+        shape = tasks.get.json_stream_to_parquet(
+            "data/decp_test.json", "decp_test", str(tmp_path / "lots")
+        )
+        assert not (tmp_path / "lots_parts").exists()
+
+        monkeypatch.setattr(tasks.get, "DECP_JSON_BATCH_SIZE", 10000)
+        tasks.get.json_stream_to_parquet(
+            "data/decp_test.json", "decp_test", str(tmp_path / "un_lot")
+        )
+        df = pl.read_parquet(tmp_path / "un_lot.parquet")
+        assert shape == df.shape == (2, len(tasks.get.get_ingest_schema()) + 1)
+        assert pl.read_parquet(tmp_path / "lots.parquet").equals(df)
+
+        # Fichier sans marché : aucune ligne, mais toutes les colonnes
+        (tmp_path / "vide.json").write_text('{"marches": {"marche": []}}')
+        assert tasks.get.json_stream_to_parquet(
+            str(tmp_path / "vide.json"), "vide", str(tmp_path / "vide")
+        ) == (0, df.width)
+        assert pl.read_parquet(tmp_path / "vide.parquet").schema == df.schema
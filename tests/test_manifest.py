@@ -0,0 +1,29 @@
+import polars as pl
+
+import tasks.manifest
+
+
+class TestManifest:
+    def test_get_artifact(self, tmp_path, monkeypatch):
+        previous_dir = tmp_path / "2024-01-01"
+        (previous_dir / "clean").mkdir(parents=True)
+        path = str(previous_dir / "clean" / "decp-2024")
+        pl.DataFrame({"uid": ["1"]}).write_parquet(f"{path}.parquet")
+
+        manifest = {"pipeline": "p", "sources": {}}
+        tasks.manifest.record_artifact(manifest, "decp-2024", "sha1", "clean", path)
+
+        monkeypatch.setattr(tasks.manifest, "DIST_DIR", str(tmp_path / "2024-01-02"))
+        dist_path = tasks.manifest.get_artifact(manifest, "decp-2024", "sha1", "clean")
+        assert dist_path == f"{tmp_path}/2024-01-02/clean/decp-2024"
+
+        # Le manifeste pointe vers la copie, l'ancien dossier peut être supprimé
+        assert manifest["sources"]["decp-2024"]["clean"]["path"] == dist_path
+        previous_dir.joinpath("clean", "decp-2024.parquet").unlink()
+        assert (
+            tasks.manifest.get_artifact(manifest, "decp-2024", "sha1", "clean")
+            == dist_path
+        )
+        assert (
+            tasks.manifest.get_artifact(manifest, "decp-2024", "autre", "clean") is None
+        )
@@ -0,0 +1,86 @@
+import datetime
+
+import polars as pl
+
+import tasks.manifest
+import tasks.nested
+from tasks.schema import get_target_dtypes
+
+
+class TestNested:
+    def test_make_nested_tables(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(tasks.nested, "DIST_DIR", str(tmp_path))
+        monkeypatch.setattr(
+            tasks.manifest, "DECP_MANIFEST_PATH", str(tmp_path / "manifest.json")
+        )
+        (tmp_path / "nested").mkdir()
+        dtypes = get_target_dtypes()
+        schema = {
+            "uid": pl.String,
+            "datePublicationDonnees": pl.Date,
+            "modifications": dtypes["modifications"],
+            "actesSousTraitance": dtypes["actesSousTraitance"],
+            "typesPrix_typePrix": dtypes["typesPrix_typePrix"],
+        }
+
+        acte = {
+            "id": "1",
+            "sousTraitant": {"id": "123", "typeIdentifiant": "SIRET"},
+            "dureeMois": 12,
+            "dateNotification": "2023-10-11",
+            "datePublicationDonnees": None,
+            "montant": 100.0,
+            "variationPrix": "Ferme",
+        }
+        pl.DataFrame(
+            [
+                {
+                    "uid": "1",
+                    "datePublicationDonnees": datetime.date(2024, 1, 1),
+                    "modifications": [
+                        {"modification": {"id": "1", "montant": 10.0}},
+                        {"modification": {"id": "2", "dureeMois": 3}},
+                    ],
+                    "actesSousTraitance": [{"acteSousTraitance": acte}],
+                    "typesPrix_typePrix": ["Ferme", "Ferme", "Révisable"],
+                },
+                {
+                    "uid": "2",
+                    "datePublicationDonnees": datetime.date(2024, 1, 1),
+                    "modifications": [],
+                    "actesSousTraitance": None,
+                    "typesPrix_typePrix": None,
+                },
+            ],
+            schema=schema,
+        ).write_parquet(tmp_path / "nested" / "a.parquet")
+
+        pl.DataFrame(
+            [{"uid": "3", "datePublicationDonnees": datetime.date(2023, 1, 1)}],
+            schema=schema,
+        ).write_parquet(tmp_path / "nested" / "b.parquet")
+
+        tables = tasks.nested.make_nested_tables()
+        assert list(tables) == [
+            "sous_traitants",
+            "modifications",
+            "actes_sous_traitance",
+            "marches_typesPrix",
+        ]
+
+        modifications, primary_key = tables["modifications"]
+        assert primary_key == "marche_uid, rang"
+        assert modifications.select("marche_uid", "rang", "id", "montant").rows() == [
+            ("1", 1, "1", 10.0),
+            ("1", 2, "2", None),
+        ]
+
+        actes = tables["actes_sous_traitance"][0]
+        assert actes.select(
+            "marche_uid", "dateNotification", "sousTraitant_id"
+        ).rows() == [("1", datetime.date(2023, 10, 11), "123")]
+        assert tables["sous_traitants"][0].rows() == [("123", "SIRET")]
+        assert tables["marches_typesPrix"][0].rows() == [
+            ("1", "Ferme"),
+            ("1", "Révisable"),
+        ]
@@ -0,0 +1,179 @@
+import datetime
+import hashlib
+import json
+import sqlite3
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import tasks.output
+
+
+class TestOutput:
+    def test_save_to_sqlite(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(tasks.output, "DIST_DIR", str(tmp_path))
+        df = pl.DataFrame(
+            {
+                "uid": ["1", "2"],
+                "montant": [10.5, None],
+                "dateNotification": [datetime.date(2024, 1, 31), None],
+                "attributionAvance": [True, False],
+            }
+        )
+
+        with tasks.output.open_sqlite_database("test") as connection:
+            tasks.output.save_to_sqlite(df, connection, "marches", "uid")
+
+        connection = sqlite3.connect(tmp_path / "test.sqlite")
+        assert connection.execute("SELECT * FROM marches ORDER BY uid").fetchall() == [
+            ("1", 10.5, "2024-01-31", 1),
+            ("2", None, None, 0),
+        ]
+        # La clé primaire est indexée après le chargement
+        with pytest.raises(sqlite3.IntegrityError):
+            connection.execute("INSERT INTO marches (uid) VALUES ('1')")
+
+    def test_save_fts_index(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(tasks.output, "DIST_DIR", str(tmp_path))
+        df = pl.DataFrame(
+            {
+                "uid": ["1", "2", "3"],
+                "objet": ["Travaux de voirie", "Marché de nettoyage", None],
+                "acheteur_id": ["a", "a", "b"],
+            }
+        )
+
+        with tasks.output.open_sqlite_database("test") as connection:
+            tasks.output.save_to_sqlite(df, connection, "marches", "uid")
+            tasks.output.save_fts_index(connection, "marches", "uid", "objet")
+
+        connection = sqlite3.connect(tmp_path / "test.sqlite")
+        search = "SELECT uid FROM marches_objet_fts WHERE marches_objet_fts MATCH ?"
+        assert connection.execute(search, ["marche"]).fetchall() == [("2",)]
+        assert connection.execute(search, ["VOIRIE"]).fetchall() == [("1",)]
+        assert "marches_acheteur_id" in [
+            row[0]
+            for row in connection.execute("SELECT name FROM sqlite_master").fetchall()
+        ]
+
+    def test_save_to_files(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(
+            tasks.output, "DECP_CSV_COMPRESSED_FORMATS", ["csv.gz", "csv.zst"]
+        )
+        monkeypatch.setattr(tasks.output, "DECP_CSV_SPLIT_BY_YEAR", True)
+        # Plusieurs tranches pour un même CSV par année
+        monkeypatch.setattr(tasks.output, "CSV_BATCH_SIZE", 1)
+        df = pl.DataFrame(
+            {
+                "uid": ["1", "2", "4", "3"],
+                "montant": [10.5, None, 2.0, 1.0],
+                "dateNotification": [
+                    datetime.date(2023, 1, 1),
+                    datetime.date(2024, 1, 1),
+                    datetime.date(2024, 6, 1),
+                    None,
+                ],
+            }
+        )
+
+        df_saved = tasks.output.save_to_files(df.lazy(), str(tmp_path / "decp"))
+
+        assert sorted(path.name for path in tmp_path.iterdir()) == [
+            "decp.csv",
+            "decp.csv.gz",
+            "decp.csv.zst",
+            "decp.parquet",
+            "decp_csv_par_annee",
+        ]
+        assert pl.read_parquet(tmp_path / "decp.parquet").equals(df)
+        # Les autres formats sont écrits à partir du fichier Parquet
+        assert df_saved.collect().equals(df)
+        for file_format in ["csv", "csv.gz", "csv.zst"]:
+            with pa.input_stream(tmp_path / f"decp.{file_format}") as f:
+                df_csv = pl.read_csv(
+                    f.read(), schema_overrides={"uid": pl.String}, try_parse_dates=True
+                )
+            assert df_csv.equals(df)
+        assert len(list((tmp_path / "decp_csv_par_annee").iterdir())) == 9
+        with pa.input_stream(
+            tmp_path / "decp_csv_par_annee" / "decp_2024.csv.gz", compression="gzip"
+        ) as f:
+            assert pl.read_csv(f.read())["uid"].to_list() == [2, 4]
+
+        # CSV compressé seul : les CSV intermédiaires ne sont pas gardés
+        tasks.output.save_to_files(df, str(tmp_path / "seul"), ["csv.zst"])
+        assert sorted(path.name for path in tmp_path.glob("seul*")) == [
+            "seul.csv.zst",
+            "seul_csv_par_annee",
+        ]
+        assert sorted(
+            path.name for path in (tmp_path / "seul_csv_par_annee").iterdir()
+        ) == ["seul_2023.csv.zst", "seul_2024.csv.zst", "seul_sans_date.csv.zst"]
+
+    def test_write_optimized_parquet(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(tasks.output, "DECP_PARQUET_PARTITION_BY_YEAR", True)
+        monkeypatch.setattr(tasks.output, "PARQUET_ROW_GROUP_SIZE", 2)
+        df = pl.DataFrame(
+            {
+                "acheteur_id": ["b", "a", "a"],
+                "dateNotification": [
+                    datetime.date(2023, 5, 1),
+                    datetime.date(2024, 1, 1),
+                    datetime.date(2022, 1, 1),
+                ],
+                "objet": ["x", "y", "z"],
+            }
+        )
+
+        tasks.output.save_to_files(df.lazy(), str(tmp_path / "decp"), ["parquet"])
+
+        assert pl.read_parquet(tmp_path / "decp.parquet")["objet"].to_list() == [
+            "z",
+            "y",
+            "x",
+        ]
+        metadata = pq.ParquetFile(tmp_path / "decp.parquet").metadata
+        assert metadata.num_row_groups == 2
+        assert metadata.row_group(0).column(0).statistics.has_min_max
+        assert sorted(
+            path.name for path in (tmp_path / "decp_par_annee").iterdir()
+        ) == [
+            "annee=2022",
+            "annee=2023",
+            "annee=2024",
+        ]
+        assert pl.scan_parquet(
+            tmp_path / "decp_par_annee", hive_partitioning=True
+        ).filter(pl.col("annee") == 2024).collect()["objet"].to_list() == ["y"]
+
+    def test_make_data_package(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(tasks.output, "DIST_DIR", str(tmp_path))
+        df = pl.DataFrame(
+            {
+                "uid": ["1", "2"],
+                "montant": [10.5, None],
+                "dureeMois": pl.Series([12, None], dtype=pl.Int16),
+            }
+        )
+        df.write_csv(tmp_path / "decp.csv")
+        tableschema = {
+            "fields": [{"name": "uid", "type": "string", "title": "Identifiant"}]
+        }
+
+        tasks.output.make_data_package({"decp": df}, tableschema)
+
+        with open(tmp_path / "datapackage.json") as f:
+            resource = json.load(f)["resources"][0]
+        assert resource["path"] == "decp.csv"
+        assert resource["bytes"] == (tmp_path / "decp.csv").stat().st_size
+        assert resource["hash"] == (
+            "sha256:" + hashlib.sha256((tmp_path / "decp.csv").read_bytes()).hexdigest()
+        )
+        assert resource["stats"]["rows"] == 2
+        assert resource["schema"]["fields"] == [
+            {"name": "uid", "type": "string", "title": "Identifiant"},
+            {"name": "montant", "type": "number"},
+            {"name": "dureeMois", "type": "integer"},
+        ]
@@ -0,0 +1,33 @@
+import json
+import shutil
+
+import pytest
+
+import tasks.tableschema
+
+
+class TestTableSchema:
+    def test_get_tableschema(self, tmp_path, monkeypatch):
+        path = tmp_path / "tableschema_decp.json"
+        shutil.copyfile("data/tableschema_decp.json", path)
+        shutil.copyfile(
+            "data/tableschema_decp.lock.json", tmp_path / "tableschema_decp.lock.json"
+        )
+        monkeypatch.setattr(tasks.tableschema, "DECP_TABLESCHEMA_PATH", str(path))
+        tasks.tableschema.get_tableschema.cache_clear()
+
+        tableschema = tasks.tableschema.get_tableschema()
+        assert tableschema["fields"][0]["name"] == "uid"
+        assert tasks.tableschema.get_tableschema() is tableschema
+        # Schéma provisoire : pas d'origine ni de contraintes inventées
+        with open(tmp_path / "tableschema_decp.lock.json") as f:
+            assert json.load(f)["url"] is None
+        assert all(set(field) == {"name", "type"} for field in tableschema["fields"])
+
+        # Copie locale modifiée sans mise à jour du .lock.json
+        with open(path, "a") as f:
+            f.write(" ")
+        tasks.tableschema.get_tableschema.cache_clear()
+        with pytest.raises(ValueError):
+            tasks.tableschema.get_tableschema()
+        tasks.tableschema.get_tableschema.cache_clear()
@@ -0,0 +1,72 @@
+import datetime
+import json
+
+import polars as pl
+
+import tasks.test
+
+
+class TestValidation:
+    def test_validate_decp_against_tableschema(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(tasks.test, "DIST_DIR", str(tmp_path))
+        monkeypatch.setattr(tasks.test, "DECP_VALIDATION_SHARDS", 2)
+        df = pl.DataFrame(
+            {
+                "uid": ["1", "2", "2", "4", "5"],
+                "nature": ["Marché", "Marché", "Autre", None, "Marché"],
+                "montant": [10.0, -1.0, 20.0, 30.0, 40.0],
+                "dureeMois": ["12", "douze", "6", None, "3"],
+                "codeCPV": ["45000000-7", "45000000", "", "4500000-1", None],
+                "dateNotification": [
+                    datetime.date(2024, 1, 1),
+                    datetime.date(2010, 1, 1),
+                    None,
+                    datetime.date(2024, 1, 1),
+                    datetime.date(2024, 1, 1),
+                ],
+            }
+        )
+
+        tableschema = {
+            "fields": [
+                {"name": "uid", "type": "string", "constraints": {"unique": True}},
+                {
+                    "name": "nature",
+                    "type": "string",
+                    "constraints": {"required": True, "enum": ["Marché"]},
+                },
+                {"name": "montant", "type": "number", "constraints": {"minimum": 0}},
+                {"name": "dureeMois", "type": "integer"},
+                {
+                    "name": "codeCPV",
+                    "type": "string",
+                    "constraints": {"pattern": "[0-9]{8}-[0-9]", "maxLength": 10},
+                },
+                {
+                    "name": "dateNotification",
+                    "type": "date",
+                    "constraints": {"minimum": "2015-01-01"},
+                },
+                {"name": "objet", "type": "string"},
+            ]
+        }
+
+        report = tasks.test.validate_decp_against_tableschema(df, tableschema)
+        errors = {
+            (field, rule): (count, uids)
+            for field, rule, count, uids in report.iter_rows()
+        }
+        assert errors == {
+            ("uid", "unique"): (2, ["2", "2"]),
+            ("nature", "required"): (1, ["4"]),
+            ("nature", "enum"): (1, ["2"]),
+            ("montant", "minimum"): (1, ["2"]),
+            ("dureeMois", "type:integer"): (1, ["2"]),
+            ("codeCPV", "pattern"): (3, ["2", "2", "4"]),
+            ("dateNotification", "minimum"): (1, ["2"]),
+            ("objet", "absent"): (5, []),
+        }
+
+        with open(tmp_path / "validation.json") as f:
+            assert len(json.load(f)) == len(errors)
+        assert pl.read_parquet(tmp_path / "validation.parquet").equals(report)
@@ -0,0 +1,246 @@
+import datetime
+import sqlite3
+
+import polars as pl
+
+import tasks.manifest
+import tasks.output
+import tasks.surrogate_keys
+import tasks.transform
+import tasks.uid_index
+from tasks.schema import get_target_dtypes
+
+
+def make_clean_file(path, rows: list):
+    """Fichier clean/ minimal, avec toutes les colonnes du schéma source."""
+    schema = {"uid": pl.String, "titulaire_id": pl.String}
+    schema.update(
+        (name, dtype)
+        for name, dtype in get_target_dtypes().items()
+        if name != "titulaires"
+    )
+    pl.DataFrame(rows, schema=schema).write_parquet(f"{path}.parquet")
+    return str(path)
+
+
+def save_uid_index(tmp_path, monkeypatch, rows: list):
+    """Index des clés d'un seul fichier, comme après la fusion de rows."""
+    monkeypatch.setattr(
+        tasks.uid_index, "DECP_UID_INDEX_PATH", str(tmp_path / "uid_index.parquet")
+    )
+    df = pl.LazyFrame(rows).select(
+        "uid",
+        "titulaire_id",
+        "titulaire_typeIdentifiant",
+        pl.lit(None, dtype=pl.Date).alias("datePublicationDonnees"),
+    )
+    entries = tasks.uid_index.index_entries(df, "decp", "v")
+    tasks.uid_index.save_uid_index(
+        tasks.uid_index.latest_versions(entries), {"v": entries.height}
+    )
+
+
+class TestTransform:
+    def test_merge_decp_json(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(tasks.transform, "DIST_DIR", str(tmp_path))
+        monkeypatch.setattr(tasks.manifest, "DIST_DIR", str(tmp_path))
+        monkeypatch.setattr(
+            tasks.uid_index, "DECP_UID_INDEX_PATH", str(tmp_path / "uid_index.parquet")
+        )
+
+        marche = {
+            "uid": "1",
+            "id": "1",
+            "acheteur_id": "a",
+            "titulaire_id": "t1",
+            "titulaire_typeIdentifiant": "SIRET",
+            "nature": "Marché",
+            "datePublicationDonnees": datetime.date(2024, 1, 1),
+        }
+        files = [
+            make_clean_file(
+                tmp_path / "decp-1",
+                [
+                    {**marche, "typesPrix_typePrix": ["Ferme"]},
+                    {**marche, "titulaire_id": "t2", "typesPrix_typePrix": ["Ferme"]},
+                    {**marche, "uid": "2", "montant": 20.0},
+                ],
+            ),
+            make_clean_file(
+                tmp_path / "decp-2",
+                [
+                    {
+                        **marche,
+                        "montant": 10.0,
+                        "datePublicationDonnees": datetime.date(2024, 6, 1),
+                        "typesPrix_typePrix": ["Révisable"],
+                    },
+                    {**marche, "uid": "2", "montant": 30.0},
+                    {**marche, "uid": "3"},
+                ],
+            ),
+        ]
+        manifest = {"pipeline": "p", "sources": {}}
+        tasks.manifest.record_artifact(manifest, "decp-1", "a", "clean", files[0])
+
+        with pl.StringCache():
+            df = tasks.transform.merge_decp_json(files, manifest).collect()
+
+        assert df.columns[:3] == ["uid", "id", "nature"]
+        assert len(df.columns) == 26
+        assert df.schema["nature"] == pl.Categorical
+        # La version la plus récente est gardée, puis celle de la source la plus
+        # grande à date de publication égale
+        assert sorted(df.select("uid", "titulaire_id", "montant").rows()) == [
+            ("1", "t1", 10.0),
+            ("1", "t2", None),
+            ("2", "t1", 30.0),
+            ("3", "t1", None),
+        ]
+        # Une ligne par clé dans l'index
+        assert tasks.uid_index.load_uid_index().height == 4
+        # Champs imbriqués de la ligne retenue pour chaque marché, même si un de
+        # ses titulaires n'est que dans une version plus ancienne
+        nested = pl.read_parquet(tmp_path / "nested" / "*.parquet")
+        assert sorted(nested.select("uid", "typesPrix_typePrix").rows()) == [
+            ("1", ["Révisable"]),
+            ("2", None),
+            ("3", None),
+        ]
+
+        # Sans nouveau fichier, l'index et les fichiers merge/ sont réutilisés
+        merged_file = tmp_path / "merge" / "decp-1.parquet"
+        mtime = merged_file.stat().st_mtime_ns
+        with pl.StringCache():
+            df_again = tasks.transform.merge_decp_json(files[::-1], manifest).collect()
+        assert sorted(df_again.rows()) == sorted(df.rows())
+        assert merged_file.stat().st_mtime_ns == mtime
+
+        # Les clés retenues dans un fichier supprimé sont recalculées
+        with pl.StringCache():
+            df = tasks.transform.merge_decp_json(files[:1], manifest).collect()
+        assert sorted(df.select("uid", "titulaire_id", "montant").rows()) == [
+            ("1", "t1", None),
+            ("1", "t2", None),
+            ("2", "t1", 20.0),
+        ]
+        assert not (tmp_path / "merge" / "decp-2.parquet").exists()
+
+    def test_latest_marche_rows(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(tasks.transform, "DIST_DIR", str(tmp_path))
+        monkeypatch.setattr(
+            tasks.uid_index, "DECP_UID_INDEX_PATH", str(tmp_path / "uid_index.parquet")
+        )
+        marche = {
+            "uid": "1",
+            "id": "1",
+            "acheteur_id": "a",
+            "titulaire_typeIdentifiant": "SIRET",
+            "datePublicationDonnees": datetime.date(2024, 1, 1),
+            "montant": 1.0,
+        }
+        files = [
+            make_clean_file(
+                tmp_path / "decp-1",
+                [
+                    {**marche, "titulaire_id": "t1"},
+                    {**marche, "titulaire_id": "t2"},
+                ],
+            ),
+            # Le titulaire t2 n'est plus dans la version la plus récente
+            make_clean_file(
+                tmp_path / "decp-2",
+                [
+                    {
+                        **marche,
+                        "titulaire_id": "t1",
+                        "datePublicationDonnees": datetime.date(2024, 6, 1),
+                        "montant": 99.0,
+                    }
+                ],
+            ),
+        ]
+        with pl.StringCache():
+            df = tasks.transform.merge_decp_json(
+                files, {"pipeline": "p", "sources": {}}
+            ).collect()
+        assert sorted(df.select("titulaire_id", "montant").rows()) == [
+            ("t1", 99.0),
+            ("t2", 1.0),
+        ]
+
+        # La version la plus récente du marché, quel que soit l'ordre des lignes
+        for rows in [df, df.reverse()]:
+            sans_titulaires = tasks.transform.make_decp_sans_titulaires(rows)
+            assert sans_titulaires["montant"].to_list() == [99.0]
+            marches = tasks.transform.make_normalized_tables(rows.lazy())["marches"]
+            assert marches[0]["montant"].to_list() == [99.0]
+
+    def test_normalized_tables_surrogate_keys(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(tasks.output, "DIST_DIR", str(tmp_path))
+        monkeypatch.setattr(tasks.transform, "DECP_SQLITE_SURROGATE_KEYS", True)
+        monkeypatch.setattr(
+            tasks.surrogate_keys, "DECP_SURROGATE_KEYS_DIR", str(tmp_path / "keys")
+        )
+        marche = {
+            "uid": "a1",
+            "acheteur_id": "a",
+            "titulaire_id": "t1",
+            "titulaire_typeIdentifiant": "SIRET",
+            "objet": "Travaux",
+            "datePublicationDonnees": datetime.date(2024, 1, 1),
+        }
+
+        def normalize(rows):
+            save_uid_index(tmp_path, monkeypatch, rows)
+            with tasks.output.open_sqlite_database("datalab") as connection:
+                tasks.transform.save_normalized_tables(
+                    tasks.transform.make_normalized_tables(pl.LazyFrame(rows)),
+                    connection,
+                )
+            return sqlite3.connect(tmp_path / "datalab.sqlite")
+
+        normalize([marche, {**marche, "titulaire_id": "t2"}])
+        # Un nouveau marché et un nouveau titulaire : les clés existantes ne changent pas
+        connection = normalize(
+            [
+                {**marche, "uid": "a0", "titulaire_id": "t0"},
+                marche,
+                {**marche, "titulaire_id": "t2"},
+            ]
+        )
+
+        assert sorted(
+            connection.execute("SELECT cle, uid, acheteur_cle FROM marches").fetchall()
+        ) == [(1, "a1", 1), (2, "a0", 1)]
+        assert sorted(
+            connection.execute("SELECT cle, id FROM entreprises").fetchall()
+        ) == [(1, "t1"), (2, "t2"), (3, "t0")]
+        assert sorted(
+            connection.execute("SELECT * FROM marches_titulaires").fetchall()
+        ) == [(1, 1), (1, 2), (2, 3)]
+
+    def test_make_decp_sans_titulaires(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(tasks.transform, "DECP_CHECK_SANS_TITULAIRES", True)
+        df = pl.DataFrame(
+            {
+                "uid": ["1", "1", "2", "2", "3"],
+                "titulaire_id": ["a", "b", "a", "b", "a"],
+                "titulaire_typeIdentifiant": ["SIRET"] * 5,
+                "objet": ["x", "x", "y", "z", "w"],
+                "montant": [1.0, 1.0, 2.0, 2.0, None],
+            }
+        )
+        save_uid_index(tmp_path, monkeypatch, df.rows(named=True))
+
+        df_sans_titulaires = tasks.transform.make_decp_sans_titulaires(df)
+        assert df_sans_titulaires.to_dicts() == [
+            {"uid": "1", "objet": "x", "montant": 1.0},
+            {"uid": "2", "objet": "y", "montant": 2.0},
+            {"uid": "3", "objet": "w", "montant": None},
+        ]
+
+        differences = tasks.transform.check_decp_sans_titulaires(
+            df.drop("titulaire_id", "titulaire_typeIdentifiant")
+        )
+        assert differences.to_dicts() == [{"uid": "2", "colonnes": ["objet"]}]